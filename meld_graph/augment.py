@@ -89,11 +89,13 @@ class Augment:
 
     def add_brightness_scaling(self, feat_tr):
         multipliers = np.random.uniform(0.75, 1.25, size=feat_tr.shape[1])
-        feat_tr *= multipliers[None, :]
+        # not in place: feat_tr can be a read-only view of the dataset
+        feat_tr = feat_tr * multipliers[None, :]
         return feat_tr
 
     def adjust_contrast(self, feat_tr):
         """adjust contrast"""
+        feat_tr = feat_tr.copy()
         for c in range(feat_tr.shape[1]):
             factor = np.random.uniform(0.65, 1.5)
             mn = feat_tr[:, c].mean()
@@ -132,12 +134,7 @@ class Augment:
         n_vert_low = len(self.gt.icospheres.icospheres[2]["coords"])
         noise = np.random.normal(0, noise_std, n_vert_low)
         # upsample noise to high res
-        for level in range(2, 7):
-            unpool_ind = self.gt.unpool(level=level + 1)
-            noise_upsampled = unpool_ind(torch.from_numpy(noise.reshape(-1, 1)), device=None)
-            # TODO Q Hannah why do we pass noise_upsampled to the CPU?
-            noise_upsampled = noise_upsampled.detach().cpu().numpy().ravel()
-            noise = noise_upsampled.copy()
+        noise_upsampled = self.gt.upsample(noise, source_level=2, target_level=7)
         # add noise to distance normalised
         new_mask = (new_dist_norm + noise_upsampled) <= 0
         # print(f'no lesion before: {sum(tdd["labels"])}, no lesion after {sum(new_mask)}')
@@ -147,13 +144,16 @@ class Augment:
     def recompute_distance_and_smoothed(self, tdd):
         """recompute distances from augmented lesion masks"""
         tdd["distances"] = self.gt.fast_geodesics(tdd["labels"]).astype(np.float32)
-        tdd["smooth_labels"] = self.gt.smoothing(tdd["labels"], iteration=10).astype(np.float32)
+        tdd["smooth_labels"] = self.gt.smooth_labels(tdd["labels"], iteration=10)
         return
 
     def apply_indices(self, indices, tdd):
         """TODO"""
         # spin features
         for field in tdd.keys():
+            # only spin fields of the full resolution mesh (e.g. not precomputed pooled labels)
+            if len(tdd[field]) != len(indices):
+                continue
             # no point in spinning empty labels
             if field == "labels" or field == "smooth_labels":
                 # TODO Q Hannah: potential bug here: smooth_labels could result in labels <1 everywhere. Better to do (tdd[field]==0).all()
@@ -163,16 +163,21 @@ class Augment:
                 tdd[field] = tdd[field][indices]
         return tdd
 
+    def apply_lesion_augmentation(self, tdd):
+        """randomly augment lesion of lesional data dict tdd, and recompute distances and smoothed labels"""
+        if (tdd["labels"] == 1).any():
+            if np.random.rand() < self.get_p_param("augment_lesion"):
+                tdd = self.augment_lesion(tdd)
+                self.recompute_distance_and_smoothed(tdd)
+        return tdd
+
     def apply(self, subject_data_dict):
         """TODO"""
         # create a transformed data dict
         tdd = subject_data_dict.copy()
         # randomly augment lesion using distances and noise
         # NOTE lesion augmentation needs to happen before spinning, as medial wall is re-masked after new distances were calculated
-        if (tdd["labels"] == 1).any():
-            if np.random.rand() < self.get_p_param("augment_lesion"):
-                tdd = self.augment_lesion(tdd)
-                self.recompute_distance_and_smoothed(tdd)
+        tdd = self.apply_lesion_augmentation(tdd)
 
         mesh_transform = False
         indices = np.arange(tdd["features"].shape[0], dtype=int)
@@ -219,3 +224,178 @@ class Augment:
             tdd["features"] = -self.add_gamma_scale(-tdd["features"])
 
         return tdd
+
+
+class BatchAugment:
+    """
+    Augment collated batches of data with torch operations.
+
+    Applies the same augmentations as Augment.apply (except lesion augmentation, which needs geodesic distances
+    and stays per sample in Augment.apply_lesion_augmentation), in the same order and with the same probabilities,
+    but to a whole batch at once: random parameters are drawn as vectors with one entry per sample,
+    and spinning, warping and flipping are composed per sample and applied with a single gather.
+    Runs on the device of the batch, and uses torch intra-op threads on CPU.
+
+    Args:
+        params (dict): augment_data parameters, as for Augment.
+        icospheres (IcoSpheres): icospheres, used to recompute deep supervision labels and object detection targets.
+        output_levels (list): deep supervision levels of the batch. Labels of these levels are recomputed
+            from the augmented labels, distance maps are sliced from the augmented distance map.
+    """
+
+    def __init__(self, params, icospheres, output_levels=[]):
+        self.log = logging.getLogger(__name__)
+        self.params = params
+        self.icospheres = icospheres
+        self.output_levels = sorted(output_levels)
+        # precalculated transformations, as (n_transforms, n_vertices) arrays
+        self.transforms = {
+            name: Transform(self.params[name]) for name in ["spinning", "warping", "flipping"] if name in self.params
+        }
+        self.pool_indices = {
+            level: self.icospheres.get_downsample(target_level=level)
+            for level in range(min(self.output_levels, default=7), 7)
+        }
+        # transforms and pooling indices, moved to device when first used
+        self._device_tensors = {}
+
+    def get_p_param(self, param):
+        """check pvalue, set to zero if not found"""
+        if param not in self.params:
+            return 0
+        return self.params[param]["p"]
+
+    def _to_device(self, name, array, device):
+        key = (name, str(device))
+        if key not in self._device_tensors:
+            self._device_tensors[key] = torch.as_tensor(np.asarray(array), dtype=torch.long, device=device)
+        return self._device_tensors[key]
+
+    @staticmethod
+    def _sample(p, n_samples, device):
+        """boolean mask selecting each of n_samples with probability p"""
+        return torch.rand(n_samples, device=device) < p
+
+    def get_indices(self, n_samples, n_vertices, device):
+        """
+        Compose spinning, warping and flipping for each sample.
+
+        Returns:
+            (n_samples, n_vertices) tensor of vertex indices per sample (identity for samples that are not transformed),
+            and boolean mask of transformed samples.
+        """
+        indices = torch.arange(n_vertices, device=device).repeat(n_samples, 1)
+        transformed = torch.zeros(n_samples, dtype=torch.bool, device=device)
+        for name, transform in self.transforms.items():
+            selected = self._sample(transform.p, n_samples, device)
+            if not selected.any():
+                continue
+            transform_indices = self._to_device(name, transform.indices, device)
+            choice = torch.randint(len(transform_indices), (int(selected.sum()),), device=device)
+            # as indices = indices[transform] in Augment.apply
+            indices[selected] = torch.gather(indices[selected], 1, transform_indices[choice])
+            transformed |= selected
+        return indices, transformed
+
+    def add_gaussian_noise(self, x):
+        """add gaussian noise, with std U(0, 0.1) per sample"""
+        std = torch.rand(len(x), 1, 1, device=x.device) * 0.1
+        return x + torch.randn_like(x) * std
+
+    def add_brightness_scaling(self, x):
+        """scale features by U(0.75, 1.25) per sample and feature"""
+        multipliers = 0.75 + 0.5 * torch.rand(len(x), 1, x.shape[2], device=x.device)
+        return x * multipliers
+
+    def add_gamma_scale(self, x):
+        """add gamma scaling, with gamma U(0.7, 1.5) per sample and feature"""
+        epsilon = 1e-7
+        mn = x.mean(dim=1, keepdim=True)
+        sd = x.std(dim=1, unbiased=False, keepdim=True)
+        minm = x.min(dim=1, keepdim=True)[0]
+        rnge = x.max(dim=1, keepdim=True)[0] - minm
+        gamma = 0.7 + 0.8 * torch.rand(len(x), 1, x.shape[2], device=x.device)
+        x = torch.pow((x - minm) / (rnge + epsilon), gamma) * (rnge + epsilon) + minm
+        return (x - mn) / (sd + epsilon)
+
+    def _apply_selected(self, func, x, p):
+        """apply func in place to the samples of (n_samples, n_vertices, n_features) x selected with probability p"""
+        selected = self._sample(p, len(x), x.device)
+        if selected.any():
+            x[selected] = func(x[selected])
+        return x
+
+    def apply_features(self, x):
+        """apply intensity augmentations to (n_samples, n_vertices, n_features) features x"""
+        x = x.clone()
+        x = self._apply_selected(self.add_gaussian_noise, x, self.get_p_param("noise"))
+        # blur and low res do not change the features (see Augment)
+        x = self._apply_selected(self.add_brightness_scaling, x, self.get_p_param("brightness"))
+        # contrast is brightness scaling, as in Augment.apply
+        x = self._apply_selected(self.add_brightness_scaling, x, self.get_p_param("contrast"))
+        x = self._apply_selected(self.add_gamma_scale, x, self.get_p_param("gamma") / 2)
+        x = self._apply_selected(lambda x: -self.add_gamma_scale(-x), x, self.get_p_param("gamma") / 2)
+        return x
+
+    def pool_labels(self, y):
+        """max pool (n_samples, n_vertices) labels to all output levels"""
+        labels_pooled = {7: y.t()}
+        for level in range(min(self.output_levels), 7)[::-1]:
+            neigh_indices = self._to_device(f"pool{level}", self.pool_indices[level], y.device)
+            labels_pooled[level] = labels_pooled[level + 1][neigh_indices].max(dim=1)[0]
+        return {level: labels_pooled[level].t() for level in self.output_levels}
+
+    def object_detection_targets(self, y):
+        """center of mass and radius of lesions in (n_samples, n_vertices) labels, as GraphDataset.add_object_detection"""
+        coords = torch.as_tensor(self.icospheres.icospheres[7]["coords"] / 100, dtype=torch.float32, device=y.device)
+        lesion = (y >= 0.5).float()
+        n_lesional = lesion.sum(dim=1, keepdim=True)
+        center_of_mass = (lesion @ coords) / n_lesional.clamp(min=1)
+        distances = torch.linalg.norm(coords[None] - center_of_mass[:, None], dim=2)
+        radius = (distances * lesion).max(dim=1, keepdim=True)[0]
+        xyzr = torch.cat([center_of_mass, radius], dim=1)
+        no_lesion = n_lesional[:, 0] == 0
+        xyzr[no_lesion] = torch.tensor([1.0, 0, 0, -1], device=y.device)
+        return xyzr
+
+    def apply(self, data):
+        """
+        Augment collated batch data (torch_geometric Batch of GraphDataset samples).
+
+        Returns:
+            batch with augmented x, y, distance_map, output_level<level>, output_level<level>_distance_map and xyzr.
+        """
+        n_samples = data.num_graphs
+        n_vertices = data.x.shape[0] // n_samples
+        device = data.x.device
+        x = data.x.view(n_samples, n_vertices, -1)
+        y = data.y.view(n_samples, n_vertices)
+        distance_map = data.distance_map.view(n_samples, n_vertices)
+
+        # mesh augmentations, as a single gather of all fields
+        indices, transformed = self.get_indices(n_samples, n_vertices, device)
+        if transformed.any():
+            # index rows of the flattened batch, faster than a gather of the expanded indices
+            flat_indices = (indices + n_vertices * torch.arange(n_samples, device=device)[:, None]).view(-1)
+            x = data.x.index_select(0, flat_indices).view(n_samples, n_vertices, -1)
+            y = data.y.index_select(0, flat_indices).view(n_samples, n_vertices)
+            distance_map = data.distance_map.index_select(0, flat_indices).view(n_samples, n_vertices)
+            data.y = y.reshape(-1)
+            data.distance_map = distance_map.reshape(-1)
+            if len(self.output_levels) != 0:
+                for level, labels in self.pool_labels(y).items():
+                    setattr(data, f"output_level{level}", labels.reshape(-1))
+                    if hasattr(data, f"output_level{level}_distance_map"):
+                        n_level_vertices = len(self.pool_indices[level])
+                        setattr(
+                            data,
+                            f"output_level{level}_distance_map",
+                            distance_map[:, :n_level_vertices].reshape(-1),
+                        )
+            if hasattr(data, "xyzr"):
+                xyzr = data.xyzr.view(n_samples, 4).clone()
+                xyzr[transformed] = self.object_detection_targets(y[transformed])
+                data.xyzr = xyzr.reshape(-1)
+
+        data.x = self.apply_features(x).reshape(-1, x.shape[2])
+        return data
@@ -19,6 +19,7 @@ import pickle
 import random
 from itertools import chain
 from meld_graph.meld_cohort import MeldSubject, MeldCohort
+from meld_graph.feature_store import is_feature_store_root
 from neuroCombat import neuroCombat, neuroCombatFromTraining
 import meld_graph.distributedCombat as dc
 import meld_graph.mesh_tools as mt
@@ -56,7 +57,10 @@ class Preprocess:
         self._subject_ids = None
         self.log = logging.getLogger(__name__)
         self._lobes = None
-        self.initialise_distances()
+        # SyntheticLesionBank used by add_lesion instead of create_lesion_mask, if set
+        self.lesion_bank = None
+        # lat-long grid of create_lesion_mask, initialised on first use
+        self.distances = None
         self.icospheres = icospheres
         if self.params["zscore"] != False:
             self.load_z_params(os.path.join(MELD_PARAMS_PATH,self.params["zscore"]))
@@ -93,14 +97,14 @@ class Preprocess:
 
     def save_cohort_features(self, feature_name, features, subject_ids, hemis=["lh", "rh"]):
         assert len(features) == len(subject_ids)
-        for s, subject in enumerate(subject_ids):
-            subj = MeldSubject(subject, cohort=self.cohort)
-            subj.write_feature_values(
-                feature_name,
-                features[s],
-                hemis=hemis,
-                hdf5_file_root=self.write_output_file,
-            )
+        # write all subjects of a site and group with one open file, using self.cohort.storage_policy
+        self.cohort.write_cohort_features(
+            feature_name,
+            features,
+            subject_ids,
+            hemis=hemis,
+            hdf5_file_root=self.write_output_file,
+        )
 
     # def correct_sulc_freesurfer(self, vals):
     #     """this function normalized sulcul feature in cm when values are in mm (depending on Freesurfer version used)"""
@@ -127,6 +131,7 @@ class Preprocess:
         lesion_bias=False,
         distance_maps=False,
         combine_hemis=None,
+        hemis=("lh", "rh"),
     ):
         """
         Preprocess features data for a single subject depending on params.
@@ -140,19 +145,21 @@ class Preprocess:
                 NOTE: this is an old flag, not in use anymore.
                 Distance are now calulated on the fly (because of lesion augmentation).
             combine_hemis: combine hemispheres to one sample by stacking.
+            hemis: hemispheres to load. By default both.
 
         Returns:
             features_left, features_right, lesion_left, lesion_right
         """
         subj = MeldSubject(subject, cohort=self.cohort)
         subject_data = []
-        # load data & lesion
-        for hemi in ("lh", "rh"):
-            vals_array, lesion = subj.load_feature_lesion_data(features, hemi=hemi)
+        # load data & lesion of all requested hemispheres
+        vals_block, lesion_block = subj.load_feature_block(features, hemis=hemis)
+        for h, hemi in enumerate(hemis):
+            vals_array, lesion = vals_block[h], lesion_block[h]
             subject_data_dict = {}
             # z-score data
             if self.params["zscore"]:
-                if hemi == "lh":
+                if h == 0:
                     self.log.info(f"Z-scoring data for {subject}")
                 vals_array = self.zscore_data(vals_array.T, features).T
             if distance_maps:
@@ -221,7 +228,6 @@ class Preprocess:
         # Give warning if list of subjects empty
         if len(self.subject_ids) == 0:
             print("WARNING: there is no subject in this cohort")
-        vals_array = []
         included_subj = []
         for id_sub in self.subject_ids:
             # create subject object
@@ -312,27 +318,51 @@ class Preprocess:
         histo_type_seed - randomly generate different histologies.
         proportion_features_abnormal - proportion of features abnormal
         smooth_lesion - smooth edge of lesions"""
-        # create a histological signature of -1,0,1 on which features are abnormal
+        if features is not None:
+            features = features[None]
+        return self.generate_synthetic_data_batch(
+            coords, n_features, synth_params, histo_type_seeds=[histo_type_seed], features=features
+        )[0]
+
+    def generate_synthetic_data_batch(
+        self,
+        coords,
+        n_features,
+        synth_params,
+        histo_type_seeds,
+        features=None,
+    ):
+        """
+        Generate synthetic data for a batch of hemispheres, see generate_synthetic_data.
+
+        Args:
+            coords: coordinates of the icosphere vertices.
+            n_features: number of input features.
+            synth_params: synthetic_data parameters.
+            histo_type_seeds: histological subtype of each hemisphere.
+            features (optional): array of shape (batch, n_vertices, n_features) to add lesions to.
+                By default, white noise features are generated.
+
+        Returns:
+            list of synth dicts with "features" and "labels", one per hemisphere
+        """
         n_verts = len(coords)
-        lesion = np.zeros(n_verts, dtype=int)
+        batch = len(histo_type_seeds)
         if features is None:
-            features = np.random.normal(0, 1, (n_verts, n_features))
-
-        if np.random.random() < synth_params["proportion_hemispheres_lesional"]:
-            synth_dict = self.add_lesion(
-                features,
+            features = np.random.normal(0, 1, (batch, n_verts, n_features))
+        synth_dicts = [{"features": features[i], "labels": np.zeros(n_verts, dtype=int)} for i in range(batch)]
+        lesional = np.where(np.random.random(batch) < synth_params["proportion_hemispheres_lesional"])[0]
+        if len(lesional) > 0:
+            lesion_dicts = self.add_lesion_batch(
+                features[lesional],
                 coords,
                 n_features,
                 synth_params,
-                histo_type_seed,
+                np.asarray(histo_type_seeds)[lesional],
             )
-        else:
-            synth_dict = {
-                "features": features,
-                "labels": lesion,
-            }
-
-        return synth_dict
+            for i, synth_dict in zip(lesional, lesion_dicts):
+                synth_dicts[i] = synth_dict
+        return synth_dicts
 
     def clip_spherical_coords(self, coordinates):
         """make sure spherical coords in range"""
@@ -368,6 +398,8 @@ class Preprocess:
         from meld_graph.resampling_meshes import spinning_coords
         from meld_graph import mesh_tools as mt
 
+        if self.distances is None:
+            self.initialise_distances()
         spun_coords = spinning_coords(cartesian_coords)
         spherical_coords = mt.spherical_np(spun_coords)[:, 1:]
         spherical_coords[:, 0] = spherical_coords[:, 0] - np.pi / 2
@@ -435,13 +467,104 @@ class Preprocess:
         return fingerprint
 
     def sample_fingerprint(self, fingerprint, jitter_factor):
-        """use fingerprint as starting point for generating a slightly jittered individual fingerprint"""
+        """use fingerprint (or array of fingerprints) as starting point for generating a slightly jittered individual fingerprint"""
         sampled_fingerprint = np.zeros_like(fingerprint)
-        for fi, f in enumerate(fingerprint):
-            if f != 0:
-                sampled_fingerprint[fi] = np.random.normal(f, np.abs(f) / jitter_factor)
+        abnormal = fingerprint != 0
+        sampled_fingerprint[abnormal] = np.random.normal(fingerprint[abnormal], np.abs(fingerprint[abnormal]) / jitter_factor)
         return sampled_fingerprint
 
+    def create_lesion_masks_sphere(self, radius, coords, n_lesions, chunk_size=16):
+        """
+        Create irregular lesion masks directly on the sphere, vectorised over lesions and vertices.
+
+        Alternative to create_lesion_mask without the lat-long grid. Each lesion has a random centre and
+        a star-shaped boundary: its angular radius around the centre is f_radius * (0.35 + 3 random cosine harmonics)
+        of the azimuth, with f_radius ~ N(radius, radius/2) in radians as in create_lesion_mask.
+        Smoothed masks approximate the gaussian smoothing of create_lesion_mask with an erfc profile across the boundary.
+        Lesions without cortex vertices are regenerated.
+
+        Returns:
+            lesions, smoothed: arrays of shape (n_lesions, n_vertices)
+        """
+        from scipy.special import erfc
+
+        # width of the gaussian filter of create_lesion_mask: 10 pixels of pi / 1000 radians
+        sigma = 10 * np.pi / 1000
+        harmonics = np.arange(1, 4)
+        unit_coords = coords / np.linalg.norm(coords, axis=1, keepdims=True)
+        cortex_mask = self.cohort.cortex_mask
+        lesions = np.zeros((n_lesions, len(coords)))
+        smoothed = np.zeros((n_lesions, len(coords)))
+        todo = np.arange(n_lesions)
+        while len(todo) > 0:
+            for chunk in np.array_split(todo, int(np.ceil(len(todo) / chunk_size))):
+                n = len(chunk)
+                # random centres and tangent bases
+                centres = np.random.normal(size=(n, 3))
+                centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+                helper = np.where(np.abs(centres[:, :1]) < 0.9, [[1.0, 0, 0]], [[0, 1.0, 0]])
+                e1 = np.cross(centres, helper)
+                e1 /= np.linalg.norm(e1, axis=1, keepdims=True)
+                e2 = np.cross(centres, e1)
+                # star-shaped boundaries
+                f_radius = np.clip(np.random.normal(radius, radius / 2, size=n), 0.05, 2)
+                amplitudes = np.random.uniform(0, 0.15 / harmonics, size=(n, len(harmonics)))
+                phases = np.random.uniform(0, 2 * np.pi, size=(n, len(harmonics)))
+                # only evaluate vertices closer to the centre than the largest possible boundary (plus smoothing)
+                max_angle = np.minimum(f_radius * (0.35 + amplitudes.sum(axis=1)) + 5 * sigma, np.pi)
+                rows, cols = np.nonzero(centres @ unit_coords.T > np.cos(max_angle)[:, None])
+                # angular distance from and azimuth around the centre
+                angle = np.arccos(np.clip(np.einsum("ij,ij->i", centres[rows], unit_coords[cols]), -1, 1))
+                azimuth = np.arctan2(
+                    np.einsum("ij,ij->i", e2[rows], unit_coords[cols]),
+                    np.einsum("ij,ij->i", e1[rows], unit_coords[cols]),
+                )
+                boundary = 0.35 + (amplitudes[rows] * np.cos(harmonics * azimuth[:, None] + phases[rows])).sum(axis=1)
+                boundary = f_radius[rows] * np.clip(boundary, 0.1, None)
+                chunk_lesions = np.zeros((n, len(coords)))
+                chunk_lesions[rows, cols] = angle < boundary
+                chunk_smoothed = np.zeros((n, len(coords)))
+                chunk_smoothed[rows, cols] = 0.5 * erfc((angle - boundary) / (np.sqrt(2) * sigma))
+                lesions[chunk] = chunk_lesions
+                smoothed[chunk] = chunk_smoothed
+            todo = todo[~lesions[todo][:, cortex_mask].any(axis=1)]
+        return lesions, smoothed
+
+    def create_lesion_masks(self, synth_params, coords, n_lesions):
+        """
+        Create n_lesions lesion masks restricted to cortex.
+
+        Lesions are sampled from self.lesion_bank if set, otherwise created with
+        create_lesion_masks_sphere (synth_params["lesion_shape"] == "sphere")
+        or create_lesion_mask (synth_params["lesion_shape"] == "polygon", default).
+
+        Returns:
+            lesions, smoothed_lesions: arrays of shape (n_lesions, n_vertices)
+            bank_lesions: list of lesions sampled from the bank (containing distances and smoothed labels), or None
+        """
+        bank_lesions = None
+        if self.lesion_bank is not None:
+            bank_lesions = [self.lesion_bank.sample() for _ in range(n_lesions)]
+            lesions = np.stack([bank_lesion["labels"] for bank_lesion in bank_lesions])
+            smoothed_lesions = np.stack([bank_lesion["smoothed"] for bank_lesion in bank_lesions])
+        elif synth_params.get("lesion_shape", "polygon") == "sphere":
+            lesions, smoothed_lesions = self.create_lesion_masks_sphere(synth_params["radius"], coords, n_lesions)
+        else:
+            masks = [
+                self.create_lesion_mask(synth_params["radius"], coords, return_smoothed=synth_params["smooth_lesion"])
+                for _ in range(n_lesions)
+            ]
+            if synth_params["smooth_lesion"]:
+                lesions = np.stack([mask[0] for mask in masks])
+                smoothed_lesions = np.stack([mask[1] for mask in masks])
+            else:
+                lesions = np.stack(masks)
+        if not synth_params["smooth_lesion"]:
+            smoothed_lesions = lesions
+        lesions[:, ~self.cohort.cortex_mask] = 0
+        smoothed_lesions[:, ~self.cohort.cortex_mask] = 0
+        return lesions, smoothed_lesions, bank_lesions
+
     def add_lesion(
         self,
         features,
@@ -451,37 +574,64 @@ class Preprocess:
         histo_type_seed,
     ):
         """superimpose a synthetic lesion on input data"""
-        # create lesion mask
-        if synth_params["smooth_lesion"]:
-            lesion, smoothed_lesion = self.create_lesion_mask(synth_params["radius"], coords, return_smoothed=True)
-        else:
-            lesion = smoothed_lesion = self.create_lesion_mask(synth_params["radius"], coords, return_smoothed=False)
-        lesion[~self.cohort.cortex_mask] = 0
-        smoothed_lesion[~self.cohort.cortex_mask] = 0
+        return self.add_lesion_batch(features[None], coords, n_features, synth_params, [histo_type_seed])[0]
+
+    def add_lesion_batch(
+        self,
+        features,
+        coords,
+        n_features,
+        synth_params,
+        histo_type_seeds,
+    ):
+        """
+        Superimpose synthetic lesions on input data of a batch of hemispheres.
+
+        Args:
+            features: array of shape (batch, n_vertices, n_features).
+            histo_type_seeds: histological subtype of each hemisphere.
+            see add_lesion for other args.
+
+        Returns:
+            list of synth dicts, one per hemisphere
+        """
+        batch = len(features)
+        # create lesion masks
+        lesions, smoothed_lesions, bank_lesions = self.create_lesion_masks(synth_params, coords, batch)
         # bias is sampled from a normal dist so that some subjects are easier than others.
         sampled_bias = np.clip(
             np.random.normal(
                 synth_params["bias"],
                 synth_params["bias"] / synth_params["jitter_factor"],
+                size=batch,
             ),
             0,
             100,
         )
         # histo_signature - controls which features, how important and what sign
-        fingerprint = self.create_fingerprint(n_features, histo_type_seed, synth_params["proportion_features_abnormal"])
-
-        sampled_fingerprint = self.sample_fingerprint(fingerprint, synth_params["jitter_factor"])
-        lesion_tiled = np.tile(smoothed_lesion.reshape(-1, 1), n_features)
-        synth_bias_features = lesion_tiled * sampled_fingerprint * sampled_bias
+        fingerprints = np.stack(
+            [
+                self.create_fingerprint(n_features, seed, synth_params["proportion_features_abnormal"])
+                for seed in histo_type_seeds
+            ]
+        )
+        sampled_fingerprints = self.sample_fingerprint(fingerprints, synth_params["jitter_factor"])
         # apply synthetic lesion only on non-null feature
-        apply = np.array([1 if feature.any() != 0 else 0 for feature in features.T])
-        features = features + synth_bias_features * apply
-        synth_dict = {
-            "features": features.astype("float32"),
-            "labels": lesion.astype("int32"),
-        }
-
-        return synth_dict
+        apply = features.any(axis=1)
+        synth_bias = sampled_fingerprints * sampled_bias[:, None] * apply
+        features = features + smoothed_lesions[:, :, None] * synth_bias[:, None, :]
+        synth_dicts = []
+        for i in range(batch):
+            synth_dict = {
+                "features": features[i].astype("float32"),
+                "labels": lesions[i].astype("int32"),
+            }
+            if bank_lesions is not None:
+                # no need to recompute distances and smoothed labels
+                synth_dict["distances"] = bank_lesions[i]["distances"]
+                synth_dict["smooth_labels"] = bank_lesions[i]["smooth_labels"]
+            synth_dicts.append(synth_dict)
+        return synth_dicts
 
     @property
     def covars(self):
@@ -648,9 +798,8 @@ class Preprocess:
             subj = MeldSubject(subject, cohort=self.cohort)
             # exclude outliers and subject without feature
             if (subj.has_features(feature_name)) & (subject not in outliers):
-                lh = subj.load_feature_values(feature_name, hemi="lh")[self.cohort.cortex_mask]
-                rh = subj.load_feature_values(feature_name, hemi="rh")[self.cohort.cortex_mask]
-                combined_hemis = np.hstack([lh, rh])
+                vals, _ = subj.load_feature_block([feature_name], cortex_only=True)
+                combined_hemis = vals[:, :, 0].ravel()
                 precombat_features.append(combined_hemis)
                 combat_subject_include[k] = True
             else:
@@ -913,8 +1062,8 @@ class Preprocess:
             # smooth data only if the feature exist
             if subj.has_features(feature):
                 # load feature's value for this subject
-                vals_lh = subj.load_feature_values(feature, hemi="lh")
-                vals_rh = subj.load_feature_values(feature, hemi="rh")
+                vals, _ = subj.load_feature_block([feature])
+                vals_lh, vals_rh = vals[0, :, 0], vals[1, :, 0]
                 # harmonise sulcus data from freesurfer v5 and v6
                 if feature == ".on_lh.sulc.mgh":
                     vals_lh = self.correct_sulc_freesurfer(vals_lh, self.cohort.cortex_mask)
@@ -1175,9 +1324,8 @@ class Preprocess:
                 else:
                     controls_subjects[k] = False
                 # load feature's value for this subject
-                vals_lh = subj.load_feature_values(feature, hemi="lh")
-                vals_rh = subj.load_feature_values(feature, hemi="rh")
-                vals = np.array(np.hstack([vals_lh[self.cohort.cortex_mask], vals_rh[self.cohort.cortex_mask]]))
+                vals, _ = subj.load_feature_block([feature], cortex_only=True)
+                vals = vals[:, :, 0].ravel()
                 # intra subject normalisation asym
                 intra_norm = np.array(self.normalise(vals))
                 vals_array.append(intra_norm)
@@ -1286,7 +1434,6 @@ class Preprocess:
         # Give warning if list of controls empty
         if len(cohort_ids) == 0:
             print("WARNING: there is no subject in this cohort")
-        vals_array = []
         included_subj = []
         for id_sub in cohort_ids:
             # create subject object
@@ -1296,17 +1443,36 @@ class Preprocess:
                 pass 
                 print('feature {} does not exist for subject {}'.format(feature,id_sub))
             else:
-                # load feature's value for this subject
-                vals_lh = subj.load_feature_values(feature, hemi="lh")
-                vals_rh = subj.load_feature_values(feature, hemi="rh")
-                vals = np.array(np.hstack([vals_lh[cohort.cortex_mask], vals_rh[cohort.cortex_mask]]))
-                vals_array.append(vals)
-                included_subj.append(id_sub)                
+                included_subj.append(id_sub)
         print("Compute mean and std from {} subject".format(len(included_subj)))
-        # get mean and std
-        vals_array = np.matrix(vals_array)
-        mean = (vals_array.flatten()).mean()
-        std = (vals_array.flatten()).std()
+        # get mean and std one chunk of the cohort at a time, so that the cohort does not need to fit into memory.
+        # FeatureStores are read one vertex range at a time, hdf5 files one batch of subjects at a time
+        n_cortex = len(cohort.cortex_label)
+        if is_feature_store_root(cohort.hdf5_file_root):
+            chunks = (
+                cohort.get_feature_matrix(feature, included_subj, vertices=slice(start, start + 10000))
+                for start in range(0, n_cortex, 10000)
+            )
+        else:
+            chunks = (
+                cohort.get_feature_matrix(feature, included_subj[start : start + 8])
+                for start in range(0, len(included_subj), 8)
+            )
+        # merge mean and sum of squared differences (M2) of each chunk (Chan et al.),
+        # which is numerically stable unlike E[x^2] - E[x]^2
+        n_vals, mean, m2 = 0, 0.0, 0.0
+        for vals in chunks:
+            if vals.size == 0:
+                continue
+            chunk_mean = vals.mean(dtype=np.float64)
+            chunk_m2 = np.square(np.subtract(vals, chunk_mean, dtype=np.float64)).sum()
+            delta = chunk_mean - mean
+            n_total = n_vals + vals.size
+            mean += delta * vals.size / n_total
+            m2 += chunk_m2 + delta**2 * n_vals * vals.size / n_total
+            n_vals = n_total
+        mean = mean if n_vals > 0 else np.nan
+        std = np.sqrt(m2 / n_vals) if n_vals > 0 else np.nan
         # save in json
         data = {}
         data["{}".format(feature)] = {
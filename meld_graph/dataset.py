@@ -1,13 +1,22 @@
 import torch_geometric.data
 from meld_graph.data_preprocessing import Preprocess
-from meld_graph.icospheres import IcoSpheres
-from meld_graph.graph_tools import GraphTools
+from meld_graph.icospheres import get_icospheres
+from meld_graph.graph_tools import get_graph_tools
 
 from meld_graph.models import HexPool
-from meld_graph.augment import Augment
+from meld_graph.augment import Augment, BatchAugment
+from meld_graph.dataset_cache import PreprocessedDataCache
+from meld_graph.lesion_bank import SyntheticLesionBank
+from meld_graph.meld_cohort import MeldSubject
+from meld_graph.paths import BASE_PATH, MELD_PARAMS_PATH
 import numpy as np
+import os
 import torch
 import logging
+import multiprocessing
+import mmap
+from collections import OrderedDict
+from collections.abc import Sequence
 
 
 class Oversampler(torch.utils.data.Sampler):
@@ -52,6 +61,281 @@ class Oversampler(torch.utils.data.Sampler):
         return self.num_samples
 
 
+# number of subjects for which synthetic lesions are generated at once
+SYNTHETIC_BATCH_SUBJECTS = 16
+
+# storage dtypes of data_list fields when packing with compact=True
+COMPACT_DTYPES = {"features": np.float16, "labels": np.uint8, "smooth_labels": np.uint8, "distances": np.uint16}
+# compact distances are stored as (distance + DISTANCE_OFFSET) * DISTANCE_SCALE, clipped to +-DISTANCE_OFFSET
+DISTANCE_OFFSET = 300
+DISTANCE_SCALE = 100
+# compact smooth labels are stored as smooth_label * SMOOTH_LABEL_SCALE
+SMOOTH_LABEL_SCALE = 255
+
+
+def _base_field(field):
+    """field of which field is a pooled version, e.g. labels for labels_level6"""
+    return field.split("_level")[0]
+
+
+def fits_compact(field, values):
+    """True if values of field can be stored in COMPACT_DTYPES[field] without overflow"""
+    field = _base_field(field)
+    if field not in COMPACT_DTYPES:
+        return False
+    if field == "features":
+        return bool(np.abs(values).max(initial=0) <= np.finfo(np.float16).max)
+    if field == "labels":
+        return bool(((values >= 0) & (values <= 255) & (values == np.round(values))).all())
+    if field == "smooth_labels":
+        return bool(((values >= 0) & (values <= 1)).all())
+    # distances are clipped
+    return True
+
+
+def encode_compact(field, values):
+    """values of field converted to COMPACT_DTYPES[field]"""
+    field = _base_field(field)
+    if field == "smooth_labels":
+        values = np.round(values * SMOOTH_LABEL_SCALE)
+    elif field == "distances":
+        values = np.round((np.clip(values, -DISTANCE_OFFSET, DISTANCE_OFFSET) + DISTANCE_OFFSET) * DISTANCE_SCALE)
+    return values.astype(COMPACT_DTYPES[field])
+
+
+def decode_compact(field, values, dtype):
+    """inverse of encode_compact, returns values of field as dtype"""
+    field = _base_field(field)
+    if field == "smooth_labels":
+        return (values / SMOOTH_LABEL_SCALE).astype(dtype)
+    if field == "distances":
+        return (values / DISTANCE_SCALE - DISTANCE_OFFSET).astype(dtype)
+    return values.astype(dtype)
+
+
+class SharedDataList(Sequence):
+    """
+    Read-only list of hemisphere data dicts, packed into one contiguous array per field.
+
+    Arrays have shape (n_hemis, ...) and live in shared anonymous memory maps, so that forked
+    DataLoader workers read the same physical pages instead of duplicating the dataset through
+    copy-on-write. Items are dicts of read-only views into these arrays.
+
+    With compact=True, fields are stored in COMPACT_DTYPES (float16 features, uint8 labels and smooth labels,
+    uint16 distances in steps of 1 / DISTANCE_SCALE mm) and converted back to their original dtype on access.
+    Fields with values that do not fit their compact dtype are stored as they are.
+
+    Args:
+        data_list (list): hemisphere data dicts, which all need to have the same fields and shapes.
+            Values are moved out of the dicts while packing, to limit peak memory usage.
+        compact (bool): store fields in compact dtypes.
+    """
+
+    def __init__(self, data_list, compact=False):
+        self.log = logging.getLogger(__name__)
+        self._len = len(data_list)
+        self.fields = list(data_list[0].keys()) if self._len > 0 else []
+        for d in data_list:
+            assert set(d.keys()) == set(self.fields), f"data dicts have different fields: {self.fields}, {list(d.keys())}"
+        self.arrays = {}
+        # original dtypes of compact fields
+        self.decode_dtypes = {}
+        # size of the unpacked data
+        self.source_nbytes = 0
+        for field in self.fields:
+            shape = np.shape(data_list[0][field])
+            dtype = np.result_type(*[d[field] for d in data_list])
+            self.source_nbytes += sum(np.asarray(d[field]).nbytes for d in data_list)
+            if compact and _base_field(field) in COMPACT_DTYPES:
+                compact_dtype = COMPACT_DTYPES[_base_field(field)]
+                if all(fits_compact(field, d[field]) for d in data_list):
+                    self.decode_dtypes[field] = dtype
+                    dtype = compact_dtype
+                else:
+                    self.log.warning(f"Values of {field} do not fit {np.dtype(compact_dtype)}, storing as {dtype}")
+            array = self._shared_empty((self._len,) + shape, dtype)
+            for i, d in enumerate(data_list):
+                values = d.pop(field)
+                array[i] = encode_compact(field, values) if field in self.decode_dtypes else values
+            array.setflags(write=False)
+            self.arrays[field] = array
+
+    @staticmethod
+    def _shared_empty(shape, dtype):
+        """uninitialised array in an anonymous memory map that is shared with forked processes"""
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        buffer = mmap.mmap(-1, max(nbytes, 1))
+        return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError(f"index {idx} out of range for SharedDataList of length {self._len}")
+        return {
+            field: decode_compact(field, array[idx], self.decode_dtypes[field])
+            if field in self.decode_dtypes
+            else array[idx]
+            for field, array in self.arrays.items()
+        }
+
+    def __getstate__(self):
+        # memory maps cannot be pickled (e.g. for spawned workers): send arrays, which are re-packed on arrival
+        state = {k: v for k, v in self.__dict__.items() if k not in ["arrays", "log"]}
+        state["arrays"] = {k: np.asarray(v) for k, v in self.arrays.items()}
+        return state
+
+    def __setstate__(self, state):
+        arrays = state.pop("arrays")
+        self.__dict__.update(state)
+        self.log = logging.getLogger(__name__)
+        self.arrays = {}
+        for field, values in arrays.items():
+            array = self._shared_empty(values.shape, values.dtype)
+            array[:] = values
+            array.setflags(write=False)
+            self.arrays[field] = array
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+
+class StreamingDataList(Sequence):
+    """
+    Read-only list of hemisphere data dicts of subjects that are loaded on demand.
+
+    Used by GraphDataset for cohorts that do not fit in memory. Item i is hemisphere i % 2 (lh, rh)
+    of subject i // 2. Only the requested hemisphere is loaded, so that an access (e.g. with shuffled
+    or oversampled indices) costs reading and preprocessing one hemisphere, rather than loading the whole subject.
+    Every process (e.g. each DataLoader worker) keeps its own LRU cache of the cache_size most recently used
+    hemispheres. It only avoids reloading items that are accessed again before they are evicted,
+    e.g. if the dataset is smaller than cache_size.
+
+    Args:
+        subject_ids (list): subjects to load.
+        load_hemisphere (callable): returns the data dict of a subject id and hemisphere index (0: lh, 1: rh).
+        cache_size (int): number of hemispheres kept in memory.
+    """
+
+    def __init__(self, subject_ids, load_hemisphere, cache_size=16):
+        self.subject_ids = subject_ids
+        self.load_hemisphere = load_hemisphere
+        self.cache_size = cache_size
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return 2 * len(self.subject_ids)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"index {idx} out of range for StreamingDataList of length {len(self)}")
+        data_dict = self._items.pop(idx, None)
+        if data_dict is None:
+            data_dict = self.load_hemisphere(self.subject_ids[idx // 2], idx % 2)
+            while len(self._items) >= self.cache_size:
+                self._items.popitem(last=False)
+        self._items[idx] = data_dict
+        # copy dict, so that changes in get are not cached
+        return dict(data_dict)
+
+    def __getstate__(self):
+        # do not send loaded hemispheres to (spawned) workers
+        state = self.__dict__.copy()
+        state["_items"] = OrderedDict()
+        return state
+
+
+def add_smooth_label_and_dist(sdl, gt, smooth_labels):
+    """Updates hemisphere data dict sdl with "distances" and, if smooth_labels, "smooth_labels"."""
+    return add_smooth_labels_and_dists([sdl], gt, smooth_labels)[0]
+
+
+def add_smooth_labels_and_dists(subject_data_list, gt, smooth_labels):
+    """
+    Updates hemisphere data dicts in subject_data_list with "distances" and, if smooth_labels, "smooth_labels".
+    Distances of all lesional hemispheres are computed in one call of GraphTools.batch_geodesics.
+    """
+    lesional = []
+    for sdl in subject_data_list:
+        if "distances" in sdl:
+            # already computed, e.g. for lesions from a SyntheticLesionBank
+            if not smooth_labels:
+                sdl.pop("smooth_labels", None)
+        elif (sdl['labels']==1).any():
+            lesional.append(sdl)
+        else:
+            sdl['distances'] = np.ones(len(sdl['labels']),dtype=np.float32)*300
+            if smooth_labels:
+                sdl['smooth_labels'] = np.zeros(len(sdl['labels']),dtype=np.float32)
+    if len(lesional) != 0:
+        labels = np.stack([sdl['labels'] for sdl in lesional])
+        distances = gt.batch_geodesics(labels).astype(np.float32)
+        if smooth_labels:
+            smoothed = gt.smooth_labels(labels, iteration=10)
+        for i, sdl in enumerate(lesional):
+            sdl['distances'] = distances[i]
+            if smooth_labels:
+                sdl['smooth_labels'] = smoothed[i]
+    return subject_data_list
+
+
+def load_subject_data(subject_id, prep, gt, params, hemis=("lh", "rh")):
+    """
+    Load and preprocess data of both hemispheres of subject_id, and add distances and smoothed labels.
+
+    Args:
+        subject_id: subject to load.
+        prep (Preprocess): used to load and preprocess features.
+        gt (GraphTools): used to calculate distances and smoothed labels.
+        params (dict): data_parameters.
+        hemis (optional): hemispheres to load. By default both.
+
+    Returns:
+        list of dicts for left and right hemisphere, or for the requested hemispheres.
+    """
+    # features are appended to list in order: left, right
+    subject_data_list = prep.get_data_preprocessed(
+        subject=subject_id,
+        features=params["features"],
+        lobes=params["lobes"],
+        lesion_bias=False,
+        distance_maps=False,
+        combine_hemis=params["combine_hemis"],
+        hemis=hemis,
+    )
+    add_smooth_labels_and_dists(subject_data_list, gt, params["smooth_labels"])
+    return subject_data_list
+
+
+# Preprocess and GraphTools of worker processes loading subjects for GraphDataset
+_worker_tools = {}
+
+
+def _init_load_worker(cohort, params, distance_mask_medial_wall):
+    """create preprocessing tools of this worker"""
+    # workers run in parallel, avoid oversubscribing cores
+    torch.set_num_threads(1)
+    icospheres = get_icospheres()
+    _worker_tools["prep"] = Preprocess(cohort=cohort, params=params["preprocessing_parameters"], icospheres=icospheres)
+    _worker_tools["gt"] = get_graph_tools(
+        icospheres,
+        cohort=cohort,
+        distance_mask_medial_wall=distance_mask_medial_wall,
+        geodesic_backend=params.get("geodesic_backend", "pp3d"),
+    )
+    _worker_tools["params"] = params
+
+
+def _load_subject_worker(subject_id):
+    return load_subject_data(subject_id, _worker_tools["prep"], _worker_tools["gt"], _worker_tools["params"])
+
+
 class GraphDataset(torch_geometric.data.Dataset):
     """
     GraphDataset containing hemisphere-level data.
@@ -70,6 +354,14 @@ class GraphDataset(torch_geometric.data.Dataset):
             will be available as self.get().output_level<level>.
             Distance maps will be available as self.get().output_level<level>_distance_map.
         distance_mask_medial_wall (bool): mask of medial wall in distance maps to 300.
+        num_workers (int): number of processes used to load and preprocess subjects.
+            If None, params["num_workers"] is used. 0 loads all subjects in this process.
+
+    If params["cache_dir"] is set, preprocessed data of real subjects is read from / written to
+    a PreprocessedDataCache in this directory (relative to BASE_PATH).
+
+    If params["streaming"] is True, subjects are not preloaded but read when they are accessed
+    (see StreamingDataList), and lesional_idxs are taken from the subject manifest of the cohort.
     """
 
     def __init__(
@@ -83,6 +375,7 @@ class GraphDataset(torch_geometric.data.Dataset):
         pre_filter=None,
         output_levels=[],
         distance_mask_medial_wall=True,
+        num_workers=None,
     ):
 
         super().__init__(None, transform, pre_transform, pre_filter)
@@ -92,15 +385,22 @@ class GraphDataset(torch_geometric.data.Dataset):
         self.cohort = cohort
         self.mode = mode
         self.output_levels = sorted(output_levels)
-        self.icospheres = IcoSpheres()
-        self.gt = GraphTools(
+        self.distance_mask_medial_wall = distance_mask_medial_wall
+        self.icospheres = get_icospheres()
+        self.gt = get_graph_tools(
             self.icospheres,
             cohort=self.cohort,
             distance_mask_medial_wall=distance_mask_medial_wall,
+            geodesic_backend=self.params.get("geodesic_backend", "pp3d"),
         )
         self.augment = None
         if (self.mode == "train") & (self.params["augment_data"] != None):
             self.augment = Augment(self.params["augment_data"], self.gt)
+        # with batch_augmentation, get only augments lesions, and all other augmentations are applied to
+        # collated batches by calling self.batch_augment.apply (done in Trainer.train_epoch)
+        self.batch_augment = None
+        if self.augment is not None and self.params.get("batch_augmentation", False):
+            self.batch_augment = BatchAugment(self.params["augment_data"], self.icospheres, self.output_levels)
 
         if len(self.output_levels) != 0:
             self.pool_layers = {
@@ -108,6 +408,9 @@ class GraphDataset(torch_geometric.data.Dataset):
                 for level in range(min(self.output_levels), 7)[::-1]
             }
         self._lesional_idxs = None
+        self.cache = None
+        if self.params.get("cache_dir", None) is not None:
+            self.cache = PreprocessedDataCache(os.path.join(BASE_PATH, self.params["cache_dir"]))
 
         # preload data in memory, with all preprocessing done
         self.data_list = []
@@ -116,6 +419,11 @@ class GraphDataset(torch_geometric.data.Dataset):
             params=self.params["preprocessing_parameters"],
             icospheres=self.icospheres,
         )
+        lesion_bank = self.params["synthetic_data"].get("lesion_bank", None)
+        uses_synthetic = self.params["synthetic_data"]["run_synthetic"] or self.params.get("synth_on_the_fly", False)
+        if lesion_bank is not None and uses_synthetic:
+            self.prep.lesion_bank = SyntheticLesionBank(os.path.join(BASE_PATH, lesion_bank))
+            self.prep.lesion_bank.check_params(self.params["synthetic_data"], self.distance_mask_medial_wall)
         self.log.info(f"Loading and preprocessing {mode} data")
         self.log.debug(f"Combine hemis {self.params['combine_hemis']}")
 
@@ -132,9 +440,14 @@ class GraphDataset(torch_geometric.data.Dataset):
             if not self.params["synthetic_data"]["use_controls"]:
                 self.subject_ids = np.arange(self.n_subs_split)
                 self.log.info(f"WARNING: Simulating {len(self.subject_ids)} subjects")
-                for s in np.arange(self.n_subs_split):
-                    synth_sub_data_list = self.synthetic_lesion()
+                # generate lesions for batches of subjects
+                for start in np.arange(0, self.n_subs_split, SYNTHETIC_BATCH_SUBJECTS):
+                    n_subs = min(SYNTHETIC_BATCH_SUBJECTS, self.n_subs_split - start)
+                    synth_sub_data_list = self.synthetic_lesion([{"features": None}] * (2 * n_subs))
+                    # computing dists and smoothed labels
+                    synth_sub_data_list = self.add_smooth_label_and_dists(synth_sub_data_list)
                     self.data_list.extend(synth_sub_data_list)
+                self.pack_data_list()
                 return
             # undersample subject ids to get controlled number
             n_subs_before = len(self.subject_ids)
@@ -147,6 +460,27 @@ class GraphDataset(torch_geometric.data.Dataset):
 
             self.log.info(f"WARNING: Simulating {len(self.subject_samples)} subjects using {n_subs_before} controls")
 
+        if self.params.get("streaming", False):
+            assert not self.params["synthetic_data"]["run_synthetic"], "streaming is not supported for synthetic data"
+            # StreamingDataList and lesional_idxs assume one data dict per hemisphere
+            assert self.params["combine_hemis"] is None, "streaming is not supported with combine_hemis"
+            self.data_list = StreamingDataList(
+                self.subject_ids,
+                self.load_streamed_hemisphere,
+                cache_size=self.params.get("streaming_cache_size", 16),
+            )
+            self.log.info(f"Streaming {len(self.subject_ids)} subjects")
+            return
+
+        if not self.params["synthetic_data"]["run_synthetic"]:
+            if num_workers is None:
+                num_workers = self.params.get("num_workers", 0)
+            self.load_subjects(num_workers=num_workers)
+            if self.cache is not None:
+                self.log.info(f"preprocessed data cache {self.cache.cache_dir}: {self.cache.stats()}")
+            self.pack_data_list()
+            return
+
         for s_i, subj_id in enumerate(self.subject_ids):
             # load in (control) data
             # features are appended to list in order: left, right
@@ -159,24 +493,92 @@ class GraphDataset(torch_geometric.data.Dataset):
                 combine_hemis=self.params["combine_hemis"],
             )
 
-            # add lesion if simulating synthetic data
-            if self.params["synthetic_data"]["run_synthetic"]:
-                for duplicate in np.arange(np.sum(self.subject_samples == s_i)):
-                    synth_sub_data_list = self.synthetic_lesion(subject_data_list)
-                    # computing dists and smoothed labels
-                    synth_sub_data_list = self.add_smooth_label_and_dists(synth_sub_data_list)
-                    self.data_list.extend(synth_sub_data_list)
-            else:
-                # add dists and smoothed labels
-                subject_data_list = self.add_smooth_label_and_dists(subject_data_list)
-                self.data_list.extend(subject_data_list)
+            # add lesion as simulating synthetic data
+            for duplicate in np.arange(np.sum(self.subject_samples == s_i)):
+                synth_sub_data_list = self.synthetic_lesion(subject_data_list)
+                # computing dists and smoothed labels
+                synth_sub_data_list = self.add_smooth_label_and_dists(synth_sub_data_list)
+                self.data_list.extend(synth_sub_data_list)
 
         # dataset has weird properties. subject_ids needs to be the right length, matching the data length
-        if self.params["synthetic_data"]["run_synthetic"]:
-            if self.n_subs_split > len(self.subject_ids):
-                self.subject_ids = np.array(self.subject_ids)[self.subject_samples]
+        if self.n_subs_split > len(self.subject_ids):
+            self.subject_ids = np.array(self.subject_ids)[self.subject_samples]
+        self.pack_data_list()
         return
 
+    def pack_data_list(self):
+        """
+        Replace self.data_list by a SharedDataList, which is shared with (rather than copied to) DataLoader workers.
+        data_list is kept as list if its dicts have different fields.
+        """
+        self.add_label_pyramids(self.data_list)
+        fields = set(self.data_list[0].keys()) if len(self.data_list) > 0 else set()
+        if any(set(d.keys()) != fields for d in self.data_list):
+            self.log.warning("Data dicts have different fields, not packing data_list")
+            return
+        self.data_list = SharedDataList(self.data_list, compact=self.params.get("compact_storage", False))
+        self.log.info(
+            f"Packed {len(self.data_list)} hemispheres into {self.data_list.nbytes / 1e6:.1f} MB shared memory "
+            f"(unpacked: {self.data_list.source_nbytes / 1e6:.1f} MB)"
+        )
+
+    def load_subjects(self, num_workers=0):
+        """
+        Load and preprocess all subjects and add them to self.data_list, in the order of self.subject_ids.
+
+        Subjects are read from self.cache if possible. Other subjects are loaded in this process,
+        or distributed over num_workers processes that each have their own Preprocess and GraphTools.
+        """
+        subject_data_lists = [None] * len(self.subject_ids)
+        cache_keys = [None] * len(self.subject_ids)
+        if self.cache is not None:
+            for i, subj_id in enumerate(self.subject_ids):
+                cache_keys[i] = self.get_cache_key(subj_id)
+                subject_data_lists[i] = self.cache.load(subj_id, cache_keys[i])
+        to_load = [i for i, subject_data_list in enumerate(subject_data_lists) if subject_data_list is None]
+        ids_to_load = [self.subject_ids[i] for i in to_load]
+
+        def store(i, subject_data_list):
+            subject_data_lists[i] = subject_data_list
+            if self.cache is not None:
+                self.cache.save(
+                    self.subject_ids[i], cache_keys[i], subject_data_list, info={"features": self.params["features"]}
+                )
+
+        if num_workers > 0 and len(to_load) > 1:
+            self.log.info(f"Loading {len(to_load)} subjects with {num_workers} workers")
+            with multiprocessing.Pool(
+                min(num_workers, len(to_load)),
+                initializer=_init_load_worker,
+                initargs=(self.cohort, self.params, self.distance_mask_medial_wall),
+            ) as pool:
+                # imap returns results in order of ids_to_load
+                for i, subject_data_list in zip(to_load, pool.imap(_load_subject_worker, ids_to_load)):
+                    store(i, subject_data_list)
+        else:
+            for i, subj_id in zip(to_load, ids_to_load):
+                store(i, load_subject_data(subj_id, self.prep, self.gt, self.params))
+
+        for subject_data_list in subject_data_lists:
+            self.data_list.extend(subject_data_list)
+
+    def load_streamed_hemisphere(self, subject_id, h):
+        """
+        Load data dict of hemisphere h (0: lh, 1: rh) of subject_id in streaming mode, using self.cache if possible.
+        On a cache miss both hemispheres are loaded, so that the cache entry of the subject is complete.
+        """
+        if self.cache is None:
+            subject_data_list = load_subject_data(subject_id, self.prep, self.gt, self.params, hemis=(("lh", "rh")[h],))
+        else:
+            cache_key = self.get_cache_key(subject_id)
+            subject_data_list = self.cache.load(subject_id, cache_key, hemis=[h])
+            if subject_data_list is None:
+                subject_data_list = load_subject_data(subject_id, self.prep, self.gt, self.params)
+                self.cache.save(subject_id, cache_key, subject_data_list, info={"features": self.params["features"]})
+                subject_data_list = subject_data_list[h : h + 1]
+        self.add_label_pyramids(subject_data_list)
+        return subject_data_list[0]
+
     @classmethod
     def from_experiment(cls, experiment, mode):
         """
@@ -205,42 +607,92 @@ class GraphDataset(torch_geometric.data.Dataset):
             distance_mask_medial_wall=experiment.data_parameters.get("distance_mask_medial_wall", False),
         )
 
+    def get_cache_key(self, subject_id):
+        """
+        Key of preprocessed data of subject_id in self.cache.
+        Depends on all parameters used for preprocessing and on the modification time of the source hdf5 file.
+        """
+        subj = MeldSubject(subject_id, cohort=self.cohort)
+        zscore = self.params["preprocessing_parameters"].get("zscore", False)
+        zscore_stat = None
+        if zscore:
+            zscore_file = os.path.join(MELD_PARAMS_PATH, zscore)
+            zscore_stat = os.stat(zscore_file).st_mtime_ns if os.path.isfile(zscore_file) else None
+        # only part of the key for non-default backends, to keep existing entries valid
+        backend_params = {}
+        if self.gt.geodesic_backend != "pp3d":
+            backend_params["geodesic_backend"] = self.gt.geodesic_backend
+        return self.cache.make_key(
+            subject_id=subject_id,
+            hdf5_file_root=self.cohort.hdf5_file_root,
+            source_stat=self.cohort.get_site_file_stat(subj.site_code, subj.group),
+            features=self.params["features"],
+            lobes=self.params["lobes"],
+            combine_hemis=self.params["combine_hemis"],
+            preprocessing_parameters=self.params["preprocessing_parameters"],
+            zscore_stat=zscore_stat,
+            smooth_labels=self.params["smooth_labels"],
+            distance_mask_medial_wall=self.distance_mask_medial_wall,
+            **backend_params,
+        )
+
+    @property
+    def label_field(self):
+        """data dict field used as target y"""
+        if self.params["smooth_labels"] and self.augment != None:
+            return "smooth_labels"
+        return "labels"
+
+    def get_labels_tensor(self, subject_data_dict):
+        """target y of subject_data_dict"""
+        dtype = torch.float32 if self.label_field == "smooth_labels" else torch.int64
+        return torch.tensor(subject_data_dict[self.label_field], dtype=dtype)
+
+    def pool_labels(self, labels):
+        """Max pool labels tensor from level 7 to all output levels. Returns dict of pooled labels per level"""
+        labels_pooled = {7: labels}
+        for level in range(min(self.output_levels), 7)[::-1]:
+            labels_pooled[level] = self.pool_layers[level](labels_pooled[level + 1])
+        return {level: labels_pooled[level] for level in self.output_levels}
+
+    def add_label_pyramids(self, data_list):
+        """
+        Add pooled labels of all output levels to the dicts in data_list, as fields <label_field>_level<level>.
+        get uses these unless augmentation changed the labels.
+        """
+        if len(self.output_levels) == 0:
+            return
+        for subject_data_dict in data_list:
+            if self.label_field not in subject_data_dict:
+                continue
+            for level, labels in self.pool_labels(self.get_labels_tensor(subject_data_dict)).items():
+                subject_data_dict[f"{self.label_field}_level{level}"] = labels.numpy()
+
     def add_smooth_label_and_dists(self, subject_data_list):
         """Compute a smoothed label and distance map.
 
         Updates subject_data_list with "smooth_labels" and "distances".
         """
-        for sdl in subject_data_list:
-            sdl = self.add_smooth_label_single(sdl)
-        return subject_data_list
+        return add_smooth_labels_and_dists(subject_data_list, self.gt, self.params['smooth_labels'])
     
     def add_smooth_label_single(self,sdl):
         """ Updates subject_data_list with "smooth_labels" and "distances"."""
-        if (sdl['labels']==1).any():
-            if self.params['smooth_labels']:
-                sdl['smooth_labels'] = self.gt.smoothing(sdl['labels'],iteration=10).astype(np.float32)
-            sdl['distances'] = self.gt.fast_geodesics(sdl['labels']).astype(np.float32)
-        else:
-            sdl['distances'] = np.ones(len(sdl['labels']),dtype=np.float32)*300
-            if self.params['smooth_labels']:
-                sdl['smooth_labels'] = np.zeros(len(sdl['labels']),dtype=np.float32)
-        return sdl
+        return add_smooth_label_and_dist(sdl, self.gt, self.params['smooth_labels'])
 
     def synthetic_lesion(self, subject_data_list=[{"features": None}, {"features": None}]):
-        """Add synthetic lesion to input features for both hemis"""
-        synth_dicts = []
-        for si, sdl in enumerate(subject_data_list):
-            # controls the proportion of examples with lesions.
-            subtype = np.random.choice(self.params["synthetic_data"]["n_subtypes"])
-            synth_dict = self.prep.generate_synthetic_data(
-                self.icospheres.icospheres[7]["coords"],
-                len(self.params["features"]),
-                histo_type_seed=subtype,
-                synth_params=self.params["synthetic_data"],
-                features=sdl["features"],
-            )
-            synth_dicts.append(synth_dict)
-        return synth_dicts
+        """Add synthetic lesion to input features for all hemis in subject_data_list (default: both hemis of white noise)"""
+        # controls the proportion of examples with lesions.
+        subtypes = np.random.choice(self.params["synthetic_data"]["n_subtypes"], len(subject_data_list))
+        features = None
+        if subject_data_list[0]["features"] is not None:
+            features = np.stack([sdl["features"] for sdl in subject_data_list])
+        return self.prep.generate_synthetic_data_batch(
+            self.icospheres.icospheres[7]["coords"],
+            len(self.params["features"]),
+            synth_params=self.params["synthetic_data"],
+            histo_type_seeds=subtypes,
+            features=features,
+        )
 
     def len(self):
         # every subject will be shown twice per epoch
@@ -253,6 +705,8 @@ class GraphDataset(torch_geometric.data.Dataset):
         Returns data will have attributes x, y, distance_map, output_level<level>, output_level<level>_distance_map.
         """
         subject_data_dict = self.data_list[idx]
+        # pooled labels in data_list are valid as long as labels are not replaced by synthetic lesions or augmentation
+        stored_labels = subject_data_dict.get(self.label_field)
 
         #could consider adding synthetic lesions to control data here
         
@@ -268,29 +722,31 @@ class GraphDataset(torch_geometric.data.Dataset):
                 subject_data_dict = self.add_smooth_label_single(subject_data_dict)
 
         # apply data augmentation
-        if self.augment != None:
+        if self.batch_augment is not None:
+            subject_data_dict = self.augment.apply_lesion_augmentation(subject_data_dict.copy())
+        elif self.augment != None:
             subject_data_dict = self.augment.apply(subject_data_dict)
 
         
         
-        if self.params['smooth_labels'] and self.augment!=None:
-            data = torch_geometric.data.Data(
-                x=torch.tensor(subject_data_dict["features"], dtype=torch.float32),
-                y=torch.tensor(subject_data_dict["smooth_labels"], dtype=torch.float32),
-                num_nodes=len(subject_data_dict["features"]),
-            )
-        else:
-            data = torch_geometric.data.Data(
-                x=torch.tensor(subject_data_dict["features"], dtype=torch.float32),
-                y=torch.tensor(subject_data_dict["labels"], dtype=torch.int64),
-                num_nodes=len(subject_data_dict["features"]),
-            )
+        data = torch_geometric.data.Data(
+            x=torch.tensor(subject_data_dict["features"], dtype=torch.float32),
+            y=self.get_labels_tensor(subject_data_dict),
+            num_nodes=len(subject_data_dict["features"]),
+        )
 
         # add extra output levels to data
         if len(self.output_levels) != 0:
-            labels_pooled = {7: data.y}
-            for level in range(min(self.output_levels), 7)[::-1]:
-                labels_pooled[level] = self.pool_layers[level](labels_pooled[level + 1])
+            pyramid_fields = {level: f"{self.label_field}_level{level}" for level in self.output_levels}
+            if subject_data_dict[self.label_field] is stored_labels and all(
+                field in subject_data_dict for field in pyramid_fields.values()
+            ):
+                labels_pooled = {
+                    level: torch.tensor(subject_data_dict[field], dtype=data.y.dtype)
+                    for level, field in pyramid_fields.items()
+                }
+            else:
+                labels_pooled = self.pool_labels(data.y)
             for level in self.output_levels:
                 setattr(data, f"output_level{level}", labels_pooled[level])
 
@@ -305,14 +761,13 @@ class GraphDataset(torch_geometric.data.Dataset):
         
 
         if len(self.output_levels) != 0:
-            dists_pooled = {7: data.distance_map}
-            for level in range(min(self.output_levels), 7)[::-1]:
-                dists_pooled[level] = self.pool_layers[level](dists_pooled[level + 1], center_pool=True)
+            # center pooling keeps the first vertices of the (nested) icosphere, so pooling to any level is a slice
             for level in self.output_levels:
+                n_vertices = len(self.pool_layers[level].neigh_indices)
                 setattr(
                     data,
                     f"output_level{level}_distance_map",
-                    torch.clip(dists_pooled[level], 0, 300),
+                    torch.clip(data.distance_map[:n_vertices], 0, 300),
                 )
         return data
     
@@ -335,6 +790,13 @@ class GraphDataset(torch_geometric.data.Dataset):
     @property
     def lesional_idxs(self):
         """find ids of data entries with lesional examples"""
+        if self._lesional_idxs is None and isinstance(self.data_list, StreamingDataList):
+            # do not load all subjects: get lesional hemispheres from subject manifest
+            lesion_hemis = self.cohort.subject_manifest.get_lesion_hemispheres(self.subject_ids)
+            self._lesional_idxs = np.array(
+                [2 * i + ["lh", "rh"].index(hemi) for i, hemi in enumerate(lesion_hemis) if hemi is not None],
+                dtype=int,
+            )
         if self._lesional_idxs is None:
             lesional_idxs = []
             for i, d in enumerate(self.data_list):
@@ -0,0 +1,145 @@
+#Contains PreprocessedDataCache, a disk cache of the preprocessed subject data of GraphDataset
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+# increase when preprocessing in GraphDataset changes, to invalidate all existing cache entries
+CACHE_VERSION = 1
+# fields of the hemisphere data dicts that are cached
+CACHED_FIELDS = ("features", "labels", "distances", "smooth_labels")
+
+
+class PreprocessedDataCache:
+    """
+    Disk cache of preprocessed hemisphere data (features, labels, distances and smooth labels) of GraphDataset subjects.
+
+    Entries are content-addressed: the key of an entry is a hash of everything the preprocessed data depends on
+    (subject, features, preprocessing parameters, modification time of the source hdf5 file, ...),
+    so that changed inputs result in a new entry rather than in stale data.
+    Entries are stored as {cache_dir}/{subject_id}/{key}/ containing one .npy file per hemisphere and field,
+    and are loaded as memory maps. Arrays are copy-on-write: changes made during augmentation are not written to disk.
+
+    Args:
+        cache_dir (str): directory of the cache. Created if it does not exist.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.log = logging.getLogger(__name__)
+        os.makedirs(cache_dir, exist_ok=True)
+        # statistics of this session
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    @staticmethod
+    def make_key(**key_params):
+        """hash of key_params, which need to be json serialisable"""
+        key_params["cache_version"] = CACHE_VERSION
+        key_str = json.dumps(key_params, sort_keys=True, default=str)
+        return hashlib.sha1(key_str.encode()).hexdigest()
+
+    def _entry_dir(self, subject_id, key):
+        return os.path.join(self.cache_dir, str(subject_id), key)
+
+    def load(self, subject_id, key, hemis=None):
+        """
+        Return cached list of hemisphere data dicts of subject_id, or None if there is no entry for key.
+
+        Args:
+            subject_id: subject id
+            key: key of the entry, see make_key
+            hemis (optional): indices of the hemisphere dicts to return. By default all are returned.
+        """
+        entry_dir = self._entry_dir(subject_id, key)
+        info_file = os.path.join(entry_dir, "info.json")
+        if not os.path.isfile(info_file):
+            self.misses += 1
+            return None
+        with open(info_file, "r") as f:
+            info = json.load(f)
+        if hemis is None:
+            hemis = range(len(info["fields"]))
+        subject_data_list = []
+        for h in hemis:
+            fields = info["fields"][h]
+            subject_data_list.append(
+                {field: np.load(os.path.join(entry_dir, f"{h}_{field}.npy"), mmap_mode="c") for field in fields}
+            )
+        self.hits += 1
+        return subject_data_list
+
+    def save(self, subject_id, key, subject_data_list, info={}):
+        """
+        Write list of hemisphere data dicts of subject_id to cache.
+
+        Args:
+            subject_id: subject id
+            key: key of this entry, see make_key
+            subject_data_list: list of hemisphere dicts. Fields in CACHED_FIELDS are saved.
+            info: additional json serialisable information to store with entry
+        """
+        entry_dir = self._entry_dir(subject_id, key)
+        if os.path.isdir(entry_dir):
+            return
+        # write to temporary directory first, so that incomplete entries are never read
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        fields = []
+        for h, sdl in enumerate(subject_data_list):
+            hemi_fields = [field for field in CACHED_FIELDS if field in sdl]
+            for field in hemi_fields:
+                np.save(os.path.join(tmp_dir, f"{h}_{field}.npy"), np.asarray(sdl[field]))
+            fields.append(hemi_fields)
+        with open(os.path.join(tmp_dir, "info.json"), "w") as f:
+            json.dump(dict(info, subject_id=str(subject_id), fields=fields), f, default=str)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # entry was written concurrently by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.writes += 1
+
+    def stats(self):
+        """hits, misses and writes of this session, and number and size of entries on disk"""
+        n_entries, n_bytes = 0, 0
+        subject_ids = os.listdir(self.cache_dir)
+        for subject_id in subject_ids:
+            for entry in os.scandir(os.path.join(self.cache_dir, subject_id)):
+                if entry.name.endswith(".tmp"):
+                    continue
+                n_entries += 1
+                n_bytes += sum(f.stat().st_size for f in os.scandir(entry.path))
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "subjects": len(subject_ids),
+            "entries": n_entries,
+            "size_mb": round(n_bytes / 1e6, 1),
+        }
+
+    def clear(self, subject_ids=None):
+        """
+        Remove cache entries.
+
+        Args:
+            subject_ids (optional): only remove entries of these subjects. By default all entries are removed.
+
+        Returns:
+            number of removed entries
+        """
+        if subject_ids is None:
+            subject_ids = os.listdir(self.cache_dir)
+        n_removed = 0
+        for subject_id in subject_ids:
+            subject_dir = os.path.join(self.cache_dir, str(subject_id))
+            if os.path.isdir(subject_dir):
+                n_removed += len(os.listdir(subject_dir))
+                shutil.rmtree(subject_dir)
+        self.log.info(f"removed {n_removed} entries from {self.cache_dir}")
+        return n_removed
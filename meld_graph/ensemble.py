@@ -1,31 +1,95 @@
 import torch
 from torch import nn
 
+# vectorised ensembles need torch.func (torch >= 2.0), members are run one by one without it
+try:
+    from torch.func import functional_call, vmap
+except ImportError:
+    functional_call = vmap = None
+
+
 class Ensemble(nn.Module):
     """
     Ensemble models by taking mean of output
     Supported outputs: log_softmax, hemi_log_softmax, non_lesion_logits
+
+    Members need to have identical architectures. With vectorised, parameters of all members are stacked
+    and all members are run in one pass with torch.func.vmap. Index tensors of layers (e.g. spirals) are shared
+    between members, so the gathers of the first layer, whose input is shared, are only computed once.
+    Otherwise, or if torch.func is not available, members are run one after the other.
+    NOTE on CPU, vmap runs index_select of vertices with batched inputs as a much slower gather,
+    and vectorised is about 2x slower than running members one after the other.
+    Use scripts/benchmarks/benchmark_ensemble.py to compare both on a GPU.
+
+    Args:
+        models (list): ensemble members. The state dict of the ensemble contains models.{i}.{parameter}.
+        vectorised (bool): run all members in one vectorised pass.
     """
-    def __init__(self, models):
+    def __init__(self, models, vectorised=False):
         super(Ensemble, self).__init__()
         self.models = nn.ModuleList(models)
-        
+        self.vectorised = vectorised and vmap is not None
+
+    @property
+    def n_members(self):
+        return len(self.models)
+
+    def stacked_state(self):
+        """
+        Parameters and buffers of members, for functional_call of the first member.
+
+        Returns:
+            dict of stacked (n_members, ...) parameters and persistent buffers,
+            dict of non-persistent buffers (index tensors), which are shared.
+        """
+        shared = {}
+        for module_name, module in self.models[0].named_modules():
+            for name in module._non_persistent_buffers_set:
+                shared[f"{module_name}.{name}" if module_name else name] = module._buffers[name]
+        states = [dict(list(model.named_parameters()) + list(model.named_buffers())) for model in self.models]
+        stacked = {
+            name: torch.stack([state[name] for state in states]) for name in states[0].keys() if name not in shared
+        }
+        return stacked, shared
+
+    def member_estimates(self, x):
+        """
+        Outputs of all members.
+
+        Returns:
+            dict of outputs, stacked to (n_members, ...) tensors.
+        """
+        if self.vectorised:
+            stacked, shared = self.stacked_state()
+
+            def member_forward(state, x):
+                return functional_call(self.models[0], (state, shared), (x,))
+
+            return vmap(member_forward, in_dims=(0, None))(stacked, x)
+        estimates = [model(x) for model in self.models]
+        return {key: torch.stack([est[key] for est in estimates]) for key in estimates[0].keys()}
+
     def forward(self, x):
         """
         Forward pass
         """
-        estimates = [model(x) for model in self.models]
+        estimates = self.member_estimates(x)
         ensembled_estimates = {}
         for key in ['log_softmax', 'hemi_log_softmax', 'non_lesion_logits','object_detection_linear']:
-            if key not in estimates[0].keys():
+            if key not in estimates.keys():
                 continue
             if 'log_softmax' in key:
-                # there are the logged outputs -> before mean, need to do exp 
-                vals = torch.stack([torch.exp(est[key]) for est in estimates], dim=2)
-                mean_val = torch.log(torch.mean(vals, dim=2))
+                # there are the logged outputs -> before mean, need to do exp
+                mean_val = torch.log(torch.mean(torch.exp(estimates[key]), dim=0))
                 #testing out max instead of mean
-                #mean_val = torch.log(torch.max(vals, dim=2)[0])
+                #mean_val = torch.log(torch.max(torch.exp(estimates[key]), dim=0)[0])
             else:
-                mean_val = torch.mean(torch.stack([est[key] for est in estimates], dim=2), dim=2)
+                mean_val = torch.mean(estimates[key], dim=0)
             ensembled_estimates[key] = mean_val
-        return ensembled_estimates
\ No newline at end of file
+        return ensembled_estimates
+
+
+def count_ensemble_members(state_dict):
+    """number of members of an Ensemble state dict, from its models.{i}. keys"""
+    members = {int(key.split(".")[1]) for key in state_dict.keys() if key.startswith("models.")}
+    return max(members) + 1 if len(members) > 0 else 0
@@ -771,9 +771,9 @@ class Evaluator:
 
             # initialise the icosphere or flat map
             if flat_map != True:
-                from meld_graph.icospheres import IcoSpheres
+                from meld_graph.icospheres import get_icospheres
 
-                icos = IcoSpheres()
+                icos = get_icospheres()
                 ico_ini = icos.icospheres[7]
                 coords = ico_ini["coords"]
                 faces = ico_ini["faces"]
@@ -1041,6 +1041,32 @@ def get_scores(subjects_dict, thresholds):
                 control_spec.append(fp >1 )
         return np.mean(dice), np.mean(patient_sens), 1-np.mean(control_spec)
 
+def cluster_agreement(clusters, reference_clusters):
+    """
+    Agreement of thresholded clusters of one subject with reference clusters,
+    e.g. of a distilled student model with its teacher.
+
+    Args:
+        clusters: cluster_thresholded of Evaluator, 0 for no cluster and cluster index otherwise.
+        reference_clusters: reference cluster_thresholded, same shape as clusters.
+
+    Returns:
+        dict with dice of cluster masks (1 if both are empty), number of clusters and reference clusters,
+        number of clusters overlapping a reference cluster and reference clusters overlapping a cluster.
+    """
+    clusters = np.asarray(clusters)
+    reference_clusters = np.asarray(reference_clusters)
+    mask, reference_mask = clusters > 0, reference_clusters > 0
+    total = mask.sum() + reference_mask.sum()
+    overlap = mask & reference_mask
+    return {
+        "dice": 2 * overlap.sum() / total if total > 0 else 1.0,
+        "n_clusters": len(np.unique(clusters[mask])),
+        "n_reference_clusters": len(np.unique(reference_clusters[reference_mask])),
+        "n_matched_clusters": len(np.unique(clusters[overlap])),
+        "n_matched_reference_clusters": len(np.unique(reference_clusters[overlap])),
+    }
+
 def sigmoid(x, k=2, m=0.5, ymin=0.03, ymax=0.5):
     """
     Inverse sigmoid function with fixed endpoints ymin and ymax, variable midpoint m and slope k.
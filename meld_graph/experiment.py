@@ -5,11 +5,10 @@ import os
 import torch
 import meld_graph.models
 from meld_graph.meld_cohort import MeldCohort
-from meld_graph.ensemble import Ensemble
+from meld_graph.ensemble import Ensemble, count_ensemble_members
 from meld_graph.training import Trainer
 import numpy as np
 import pandas as pd
-import copy
 import glob
 
 
@@ -67,6 +66,8 @@ class Experiment:
         data_parameters (dict): parameters for setting up dataset. See example_experiment_config.py for options.
         save_params (bool): save network and data parameters as json files in experiment folder.
         verbose (int): logging level.
+        init_logging (bool): set up logging handlers. Set to False for experiments loaded
+            while another experiment is running, e.g. the teacher of a distillation.
     """
 
     def __init__(
@@ -75,6 +76,7 @@ class Experiment:
         data_parameters,
         save_params=True,
         verbose=logging.INFO,
+        init_logging=True,
     ):
         self.network_parameters = network_parameters
         self.data_parameters = data_parameters
@@ -90,7 +92,8 @@ class Experiment:
             os.makedirs(self.experiment_path, exist_ok=True)
         # init logging now, path is created
         # if save_params, will overwrite/append to logs
-        self._init_logging(verbose, save_params)
+        if init_logging:
+            self._init_logging(verbose, save_params)
         self.log = logging.getLogger(__name__)
 
         self.cohort = MeldCohort(
@@ -102,16 +105,63 @@ class Experiment:
         self.log.info(f"Initialised Experiment {self.experiment_name}")
 
     @classmethod
-    def from_folder(cls, experiment_path):
+    def from_folder(cls, experiment_path, init_logging=True):
         """
         Set up experiment for existing experiment_path.
 
         Args:
             experiment_path (str): path to experiment. E.g. experiment_name/fold_00
+            init_logging (bool): set up logging handlers.
         """
         data_parameters = json.load(open(os.path.join(experiment_path, "data_parameters.json")))
         network_parameters = json.load(open(os.path.join(experiment_path, "network_parameters.json")))
-        return cls(network_parameters, data_parameters, save_params=False)
+        return cls(network_parameters, data_parameters, save_params=False, init_logging=init_logging)
+
+    @classmethod
+    def for_distillation(
+        cls,
+        teacher_path,
+        name,
+        model_name="best_model",
+        fold_n=0,
+        model_parameters=None,
+        distillation_parameters=None,
+        **kwargs,
+    ):
+        """
+        Set up experiment training a single student model on the outputs of a trained teacher
+        (e.g. the ensemble in experiment_name/fold_all), see DistillationLoss.
+        Uses the parameters of the teacher, with a distillation loss added to the loss_dictionary.
+        Train ids, val ids and test ids are split again for fold fold_n, as ensembles do not have val ids.
+        Train the student with Experiment.train. It is a single model and can be evaluated like any other model.
+
+        Args:
+            teacher_path (str): path to teacher experiment, relative to EXPERIMENT_PATH. E.g. experiment_name/fold_all
+            name (str): name of the student experiment.
+            model_name (str): name of the teacher checkpoint.
+            fold_n (int): fold used for train / val split of the student.
+            model_parameters (dict): model_parameters of the student that differ from the teacher,
+                e.g. smaller layer_sizes.
+            distillation_parameters (dict): parameters of the distillation loss,
+                weight, temperature, distance_weight. See example_experiment_config.py
+            kwargs: passed to Experiment
+        """
+        path = os.path.join(EXPERIMENT_PATH, teacher_path)
+        data_parameters = json.load(open(os.path.join(path, "data_parameters.json")))
+        network_parameters = json.load(open(os.path.join(path, "network_parameters.json")))
+        for key in ["train_ids", "val_ids", "test_ids"]:
+            data_parameters.pop(key, None)
+        data_parameters["fold_n"] = fold_n
+        network_parameters["name"] = name
+        network_parameters["model_parameters"].update(model_parameters or {})
+        training_parameters = network_parameters["training_parameters"]
+        training_parameters["init_weights"] = None
+        training_parameters.pop("start_epoch", None)
+        distillation = {"weight": 1, "temperature": 1, "distance_weight": 1}
+        distillation.update(distillation_parameters or {})
+        distillation.update({"teacher_path": teacher_path, "model_name": model_name})
+        training_parameters["loss_dictionary"]["distillation"] = distillation
+        return cls(network_parameters, data_parameters, **kwargs)
 
     def _init_logging(self, verbose, save_params=False):
         """
@@ -260,28 +310,45 @@ class Experiment:
             self.log.warn(f"Model checkpoing {checkpoint_path} does not exist!!!")
         self.model.to(device)
 
-    def load_ensemble_model(self, checkpoint_path=None, force=False):
+    def load_ensemble_model(self, checkpoint_path=None, force=False, n_members=None, vectorised=False):
+        """
+        Build Ensemble of models and optionally load weights from checkpoint.
+
+        Args:
+            checkpoint_path (str): absolute path to ensemble checkpoint, created by create_ensemble.py.
+            force (bool): reload model if model is already loaded.
+            n_members (int): number of ensemble members. Default is the number of members in the checkpoint,
+                or number_of_folds if there is no checkpoint.
+            vectorised (bool): run all members in one vectorised pass, see Ensemble.
+        """
         if self.model is not None and not force:
             self.log.info("Model already exists. Specify force=True to force reloading and initialisation")
+        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        state_dict = None
+        if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+            state_dict = torch.load(checkpoint_path, map_location=device)
+        if n_members is None:
+            if state_dict is not None:
+                n_members = count_ensemble_members(state_dict)
+            else:
+                n_members = self.data_parameters.get("number_of_folds", 5)
         # create model without checkpoint
         self.load_model(checkpoint_path=None, force=force)
-        self.log.info('Creating ensemble model')
-        models = [copy.deepcopy(self.model) for _ in range(5)]  # TODO this assumes that we are always ensembling 5 models
-        device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.log.info(f'Creating ensemble model of {n_members} models')
+        # models share icospheres and index tensors
+        models = [meld_graph.models.deepcopy_model(self.model) for _ in range(n_members)]
         for model in models:
             model.to(device)
-        ensemble_model = Ensemble(models)
+        ensemble_model = Ensemble(models, vectorised=vectorised)
         self.model = ensemble_model
-        # load weights from checkpoint    
-        if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        # load weights from checkpoint
+        if state_dict is not None:
             # checkpoint contains both model architecture + weights
-            device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
             self.log.info(f"Loading ensemble model weights from checkpoint {checkpoint_path}")
-            res = self.model.load_state_dict(torch.load(checkpoint_path, map_location=device), strict=False)
+            res = self.model.load_state_dict(state_dict, strict=False)
             self.log.debug(f'Loading returns: {res}')
             self.model.eval()
 
-
     def train(self, wandb_logging=False):
         """
         Train model.
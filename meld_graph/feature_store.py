@@ -0,0 +1,274 @@
+#Contains FeatureStore, a memory-mapped alternative to the hdf5 feature matrix files
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+import h5py
+from meld_graph.paths import NVERT
+
+# hdf5_file_roots ending with this suffix are read from and written to FeatureStores
+FEATURE_STORE_SUFFIX = ".store"
+HEMIS = ("lh", "rh")
+# number of subject rows by which feature files are grown
+CHUNK_SUBJECTS = 64
+
+
+def is_feature_store_root(hdf5_file_root):
+    """True if hdf5_file_root refers to FeatureStore directories rather than hdf5 files"""
+    return hdf5_file_root.endswith(FEATURE_STORE_SUFFIX)
+
+
+class FeatureStore:
+    """
+    Memory-mapped cortex-only feature values of all subjects of one site and group.
+
+    Alternative to the {site_code}_{group}_featurematrix*.hdf5 files: MeldCohort reads and writes
+    FeatureStores instead of hdf5 files if its hdf5_file_root ends with ".store".
+    Every feature is stored as one contiguous array, so that values of all subjects
+    can be sliced (e.g. by vertex range) without reading the whole cohort into memory.
+
+    A store is a directory containing:
+        subjects.csv: subject index with columns subject_id and scanner.
+            The row of a subject in subjects.csv is its row in all feature arrays.
+        cortex_label.npy: the vertices that are stored.
+        {feature}.f32: float32 values of shape (n_rows, 2, n_cortex) for hemispheres lh and rh.
+        {feature}.present: uint8 flags of shape (n_rows, 2), marking hemispheres that have the feature.
+    Feature files are grown in chunks of CHUNK_SUBJECTS rows and have a row for every subject in the index.
+
+    Use get_feature_store to get the FeatureStore of a directory, which is shared within this process.
+
+    Args:
+        path (str): store directory.
+        cortex_label (array, optional): vertices to store. Required to create a new store.
+    """
+
+    def __init__(self, path, cortex_label=None):
+        self.path = path
+        self.log = logging.getLogger(__name__)
+        if not self.exists(path):
+            assert cortex_label is not None, f"{path} is not a FeatureStore, need cortex_label to create it"
+            os.makedirs(path, exist_ok=True)
+            np.save(os.path.join(path, "cortex_label.npy"), np.asarray(cortex_label, dtype=np.int64))
+            self._write_index(pd.DataFrame({"subject_id": [], "scanner": []}))
+        self.cortex_label = np.load(os.path.join(path, "cortex_label.npy"))
+        self.n_cortex = len(self.cortex_label)
+        # open memory maps: (values, present, writable) for each feature
+        self._arrays = {}
+        self._load_index()
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, "subjects.csv"))
+
+    @staticmethod
+    def file_stat(path):
+        """(latest mtime, total size) of all files in store directory path"""
+        mtime, size = 0, 0
+        for entry in os.scandir(path):
+            stat = entry.stat()
+            mtime = max(mtime, stat.st_mtime_ns)
+            size += stat.st_size
+        return (mtime, size)
+
+    # subject index
+    def _write_index(self, df):
+        p = os.path.join(self.path, "subjects.csv")
+        # write to temporary file first, so that concurrent readers never see a partial index
+        df.to_csv(f"{p}.tmp", index=False)
+        os.replace(f"{p}.tmp", p)
+
+    def _load_index(self):
+        p = os.path.join(self.path, "subjects.csv")
+        self._index_stat = self._get_index_stat()
+        df = pd.read_csv(p, dtype=str, keep_default_na=False)
+        self.subject_ids = df["subject_id"].to_numpy(dtype=str)
+        self.scanners = df["scanner"].to_numpy(dtype=str)
+        self._rows = {subject_id: i for i, subject_id in enumerate(self.subject_ids)}
+
+    def _get_index_stat(self):
+        stat = os.stat(os.path.join(self.path, "subjects.csv"))
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _check_index(self):
+        """reload subject index if it was changed by another FeatureStore"""
+        if self._get_index_stat() != self._index_stat:
+            self._load_index()
+
+    @property
+    def n_subjects(self):
+        return len(self.subject_ids)
+
+    def row(self, subject_id):
+        """row of subject_id, or None if subject is not in this store"""
+        self._check_index()
+        return self._rows.get(subject_id, None)
+
+    def add_subject(self, subject_id, scanner):
+        """add subject to index if necessary and return its row"""
+        row = self.row(subject_id)
+        if row is None:
+            df = pd.DataFrame(
+                {
+                    "subject_id": np.append(self.subject_ids, subject_id),
+                    "scanner": np.append(self.scanners, scanner),
+                }
+            )
+            self._write_index(df)
+            self._load_index()
+            row = self._rows[subject_id]
+            # all feature files have a row for every subject
+            for feature in self.features:
+                if self._n_rows(feature) < self.n_subjects:
+                    self._open(feature, min_rows=self.n_subjects, write=True)
+        return row
+
+    # feature arrays
+    @property
+    def features(self):
+        """sorted list of all features in this store (including lesion masks)"""
+        # feature names start with "." and are not matched by glob
+        return sorted(name[: -len(".f32")] for name in os.listdir(self.path) if name.endswith(".f32"))
+
+    def _feature_path(self, feature):
+        return os.path.join(self.path, feature)
+
+    def _n_rows(self, feature):
+        return os.path.getsize(self._feature_path(feature) + ".f32") // (2 * self.n_cortex * 4)
+
+    def _open(self, feature, min_rows=0, write=False):
+        """
+        Return memory mapped (values, present) arrays of feature with at least min_rows rows,
+        or None if feature does not exist and write is False.
+        """
+        arrays = self._arrays.get(feature, None)
+        if arrays is not None and len(arrays[1]) >= min_rows and (arrays[2] or not write):
+            return arrays[:2]
+        p = self._feature_path(feature)
+        if not os.path.isfile(p + ".f32"):
+            if not write:
+                return None
+            open(p + ".f32", "wb").close()
+            open(p + ".present", "wb").close()
+        n_rows = self._n_rows(feature)
+        if write and n_rows < min_rows:
+            # grow files to multiple of CHUNK_SUBJECTS rows. New rows are zero
+            n_rows = int(np.ceil(min_rows / CHUNK_SUBJECTS)) * CHUNK_SUBJECTS
+            with open(p + ".f32", "r+b") as f:
+                f.truncate(n_rows * 2 * self.n_cortex * 4)
+            with open(p + ".present", "r+b") as f:
+                f.truncate(n_rows * 2)
+        if n_rows < min_rows:
+            return None
+        mode = "r+" if write else "r"
+        if n_rows == 0:
+            values = np.zeros((0, 2, self.n_cortex), dtype=np.float32)
+            present = np.zeros((0, 2), dtype=np.uint8)
+        else:
+            values = np.memmap(p + ".f32", dtype=np.float32, mode=mode, shape=(n_rows, 2, self.n_cortex))
+            present = np.memmap(p + ".present", dtype=np.uint8, mode=mode, shape=(n_rows, 2))
+        self._arrays[feature] = (values, present, write)
+        return values, present
+
+    def has_feature(self, feature, row, hemi):
+        arrays = self._open(feature, min_rows=row + 1)
+        return arrays is not None and bool(arrays[1][row, HEMIS.index(hemi)])
+
+    def hemi_features(self, row, hemi):
+        """list of features that subject in row has for hemi"""
+        return [feature for feature in self.features if self.has_feature(feature, row, hemi)]
+
+    def read(self, feature, row, hemi):
+        """cortex values of feature for subject in row and hemi (a read-only view), or None if missing"""
+        arrays = self._open(feature, min_rows=row + 1)
+        if arrays is None or not arrays[1][row, HEMIS.index(hemi)]:
+            return None
+        return arrays[0][row, HEMIS.index(hemi)]
+
+    def write(self, feature, row, hemi, values):
+        """write cortex values of feature for subject in row and hemi"""
+        values_mm, present = self._open(feature, min_rows=max(row + 1, self.n_subjects), write=True)
+        h = HEMIS.index(hemi)
+        values_mm[row, h] = values
+        present[row, h] = 1
+        values_mm.flush()
+        present.flush()
+
+    def feature_matrix(self, feature):
+        """
+        Zero-copy views on feature values and present flags of all subjects.
+
+        Returns:
+            values: float32 array of shape (n_subjects, 2, n_cortex)
+            present: bool array of shape (n_subjects, 2)
+        """
+        self._check_index()
+        arrays = self._open(feature, min_rows=self.n_subjects)
+        if arrays is None:
+            return None, np.zeros((self.n_subjects, 2), dtype=bool)
+        return arrays[0][: self.n_subjects], arrays[1][: self.n_subjects].astype(bool)
+
+    def close(self):
+        """release memory maps"""
+        self._arrays = {}
+
+    # bridge to hdf5 files
+    def import_hdf5(self, hdf5_path):
+        """
+        Copy all subjects and datasets of an hdf5 feature matrix file into this store.
+        Only the values of cortex vertices are kept.
+        """
+        cortex_mask = np.zeros(NVERT, dtype=bool)
+        cortex_mask[self.cortex_label] = True
+        with h5py.File(hdf5_path, "r") as f:
+            for site_code in f.keys():
+                if not isinstance(f[site_code], h5py.Group):
+                    # e.g. cortex_label of cortex-only files
+                    continue
+                for scanner in f[site_code].keys():
+                    for group in f[site_code][scanner].keys():
+                        for subject_id, subject_group in f[site_code][scanner][group].items():
+                            row = self.add_subject(subject_id, scanner)
+                            for hemi in HEMIS:
+                                if hemi not in subject_group:
+                                    continue
+                                for feature, dset in subject_group[hemi].items():
+                                    values = dset[:]
+                                    self.write(feature, row, hemi, values[cortex_mask] if len(values) == NVERT else values)
+
+    def export_hdf5(self, hdf5_path, site_code, group):
+        """Write all subjects of this store to an hdf5 feature matrix file, using the layout of MeldSubject"""
+        self._check_index()
+        hemi_data = np.zeros(NVERT, dtype=np.float32)
+        with h5py.File(hdf5_path, "a") as f:
+            for feature in self.features:
+                values, present = self.feature_matrix(feature)
+                for row, (subject_id, scanner) in enumerate(zip(self.subject_ids, self.scanners)):
+                    for h, hemi in enumerate(HEMIS):
+                        if not present[row, h]:
+                            continue
+                        subject_group = f.require_group(os.path.join(site_code, scanner, group, subject_id, hemi))
+                        hemi_data[self.cortex_label] = values[row, h]
+                        dset = subject_group.require_dataset(
+                            feature, shape=(NVERT,), dtype="float32", compression="gzip", compression_opts=9
+                        )
+                        dset[:] = hemi_data
+
+
+# FeatureStores shared by all cohorts in this process, keyed by path
+FEATURE_STORES = {}
+
+
+def get_feature_store(path, cortex_label=None):
+    """
+    FeatureStore of directory path, shared within this process.
+    Returns None if the store does not exist and no cortex_label is given to create it.
+    """
+    path = os.path.abspath(path)
+    store = FEATURE_STORES.get(path, None)
+    if store is None or not FeatureStore.exists(path):
+        if not FeatureStore.exists(path) and cortex_label is None:
+            return None
+        store = FeatureStore(path, cortex_label=cortex_label)
+        FEATURE_STORES[path] = store
+    return store
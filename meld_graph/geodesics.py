@@ -0,0 +1,176 @@
+#Contains batched geodesic distance solvers on triangle meshes, used by GraphTools.batch_geodesics
+
+import numpy as np
+import potpourri3d as pp3d
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from scipy.sparse.csgraph import dijkstra
+
+
+def mesh_edges(faces):
+    """unique (n_edges, 2) vertex pairs of the edges of a triangle mesh"""
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    return np.unique(np.sort(edges, axis=1), axis=0)
+
+
+class HeatMethodSolver:
+    """
+    Geodesic distances to sets of source vertices, with the heat method (Crane et al. 2013).
+
+    Solves for distances of many source sets at once: the heat flow and poisson systems are factorised once
+    when the solver is created, and every call solves them for all source sets as columns of one right hand side.
+
+    Args:
+        coords (np.array): (n_vertices, 3) vertex coordinates.
+        faces (np.array): (n_faces, 3) vertex indices of triangles.
+        t_coef (float): time step of the heat flow, in units of the squared mean edge length.
+    """
+
+    def __init__(self, coords, faces, t_coef=1.0):
+        self.coords = np.asarray(coords, dtype=np.float64)
+        self.faces = np.asarray(faces, dtype=int)
+        n_vertices = len(self.coords)
+        p = [self.coords[self.faces[:, i]] for i in range(3)]
+        # edge opposite to vertex i of each face
+        opposite_edges = [p[2] - p[1], p[0] - p[2], p[1] - p[0]]
+        normals = np.cross(p[1] - p[0], p[2] - p[0])
+        double_areas = np.linalg.norm(normals, axis=1)
+        normals = normals / double_areas[:, None]
+        # cotangent of the angle at vertex i of each face
+        cotans = []
+        for i in range(3):
+            a, b = p[(i + 1) % 3] - p[i], p[(i + 2) % 3] - p[i]
+            cotans.append(np.einsum("ij,ij->i", a, b) / np.linalg.norm(np.cross(a, b), axis=1))
+
+        # cotan laplacian (positive semi-definite) and lumped mass matrix
+        rows, cols, values = [], [], []
+        for i in range(3):
+            j, k = self.faces[:, (i + 1) % 3], self.faces[:, (i + 2) % 3]
+            w = cotans[i] / 2
+            rows += [j, k, j, k]
+            cols += [k, j, j, k]
+            values += [-w, -w, w, w]
+        laplacian = sparse.csc_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(n_vertices, n_vertices)
+        )
+        vertex_areas = np.bincount(self.faces.ravel(), weights=np.repeat(double_areas / 6, 3), minlength=n_vertices)
+        mass = sparse.diags(vertex_areas, format="csc")
+
+        # gradient (3 * n_faces, n_vertices) and integrated divergence (n_vertices, 3 * n_faces) operators
+        face_rows = 3 * np.arange(len(self.faces))
+        rows, cols, values = [], [], []
+        for i in range(3):
+            grad_i = np.cross(normals, opposite_edges[i]) / double_areas[:, None]
+            for c in range(3):
+                rows.append(face_rows + c)
+                cols.append(self.faces[:, i])
+                values.append(grad_i[:, c])
+        self.gradient = sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(3 * len(self.faces), n_vertices),
+        )
+        rows, cols, values = [], [], []
+        for i in range(3):
+            j, k = (i + 1) % 3, (i + 2) % 3
+            div_i = (cotans[k][:, None] * (p[j] - p[i]) + cotans[j][:, None] * (p[k] - p[i])) / 2
+            for c in range(3):
+                rows.append(self.faces[:, i])
+                cols.append(face_rows + c)
+                values.append(div_i[:, c])
+        self.divergence = sparse.csr_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(n_vertices, 3 * len(self.faces)),
+        )
+
+        mean_edge_length = np.linalg.norm(np.diff(self.coords[mesh_edges(self.faces)], axis=1), axis=2).mean()
+        t = t_coef * mean_edge_length**2
+        self.heat_solver = splu(mass + t * laplacian)
+        # small mass term makes the poisson system positive definite
+        self.poisson_solver = splu(laplacian + 1e-8 * mass)
+
+    def compute_distance_multisource_batch(self, sources):
+        """
+        Geodesic distances to sets of source vertices.
+
+        Args:
+            sources (np.array): (n_vertices, n_sets) boolean array, column i marks the source vertices of set i.
+
+        Returns:
+            (n_vertices, n_sets) array of distances to the closest source vertex of each set.
+        """
+        sources = np.asarray(sources, dtype=bool)
+        heat = self.heat_solver.solve(sources.astype(np.float64))
+        grad = self.gradient.dot(heat).reshape(-1, 3, sources.shape[1])
+        # unit vector field pointing away from the sources
+        field = -grad / np.maximum(np.linalg.norm(grad, axis=1, keepdims=True), np.finfo(np.float64).tiny)
+        distances = self.poisson_solver.solve(-self.divergence.dot(field.reshape(-1, sources.shape[1])))
+        # shift distances to zero at the sources
+        distances -= np.where(sources, distances, 0).sum(axis=0) / np.maximum(sources.sum(axis=0), 1)
+        return distances
+
+
+class DijkstraSolver:
+    """
+    Approximate geodesic distances to sets of source vertices: shortest paths along mesh edges,
+    with multi-source Dijkstra. Overestimates geodesic distances, as paths are restricted to edges.
+
+    Args:
+        coords (np.array): (n_vertices, 3) vertex coordinates.
+        faces (np.array): (n_faces, 3) vertex indices of triangles.
+    """
+
+    def __init__(self, coords, faces):
+        coords = np.asarray(coords, dtype=np.float64)
+        edges = mesh_edges(np.asarray(faces, dtype=int))
+        lengths = np.linalg.norm(coords[edges[:, 0]] - coords[edges[:, 1]], axis=1)
+        self.graph = sparse.csr_matrix((lengths, (edges[:, 0], edges[:, 1])), shape=(len(coords), len(coords)))
+
+    def compute_distance_multisource_batch(self, sources):
+        """
+        Shortest path distances to sets of source vertices.
+
+        Args:
+            sources (np.array): (n_vertices, n_sets) boolean array, column i marks the source vertices of set i.
+
+        Returns:
+            (n_vertices, n_sets) array of distances to the closest source vertex of each set.
+        """
+        sources = np.asarray(sources, dtype=bool)
+        distances = np.zeros(sources.shape)
+        for i in range(sources.shape[1]):
+            distances[:, i] = dijkstra(self.graph, directed=False, indices=np.flatnonzero(sources[:, i]), min_only=True)
+        return distances
+
+
+class PP3DSolver:
+    """
+    Geodesic distances with the heat method solver of potpourri3d, solving for one set of sources at a time.
+    The factorisation of the solver is reused across calls.
+
+    Args:
+        coords (np.array): (n_vertices, 3) vertex coordinates.
+        faces (np.array): (n_faces, 3) vertex indices of triangles.
+    """
+
+    def __init__(self, coords, faces):
+        self.solver = pp3d.MeshHeatMethodDistanceSolver(coords, faces)
+
+    def compute_distance_multisource_batch(self, sources):
+        """
+        Geodesic distances to sets of source vertices.
+
+        Args:
+            sources (np.array): (n_vertices, n_sets) boolean array, column i marks the source vertices of set i.
+
+        Returns:
+            (n_vertices, n_sets) array of distances to the closest source vertex of each set.
+        """
+        sources = np.asarray(sources, dtype=bool)
+        distances = np.zeros(sources.shape)
+        for i in range(sources.shape[1]):
+            distances[:, i] = self.solver.compute_distance_multisource(np.flatnonzero(sources[:, i]))
+        return distances
+
+
+# geodesic distance backends of GraphTools
+GEODESIC_SOLVERS = {"pp3d": PP3DSolver, "heat": HeatMethodSolver, "dijkstra": DijkstraSolver}
@@ -1,15 +1,20 @@
 import numpy as np
 import torch
-import potpourri3d as pp3d
+from scipy import sparse
+from meld_graph.geodesics import GEODESIC_SOLVERS
 from meld_graph.models import HexUnpool, HexPool, HexSmoothSparse
 from meld_graph.meld_cohort import MeldCohort
 import time
 
 
 class GraphTools:
-    def __init__(self, icospheres, cohort=None, distance_mask_medial_wall=False):
+    def __init__(self, icospheres, cohort=None, distance_mask_medial_wall=False, geodesic_backend="pp3d"):
         """
         Use graph tools
+
+        geodesic_backend selects the solver of fast_geodesics and batch_geodesics (see meld_graph.geodesics):
+        "pp3d" (heat method of potpourri3d), "heat" (heat method, batched over lesions)
+        or "dijkstra" (approximate, shortest paths along mesh edges).
         """
         self.icospheres = icospheres
         self.cohort = cohort
@@ -17,6 +22,13 @@ class GraphTools:
             self.cohort = MeldCohort()
         self.coords = self.icospheres.icospheres[5]["coords"]
         self.distance_mask_medial_wall = distance_mask_medial_wall
+        if geodesic_backend not in GEODESIC_SOLVERS:
+            raise ValueError(f"Unknown geodesic_backend {geodesic_backend}, choose from {list(GEODESIC_SOLVERS)}")
+        self.geodesic_backend = geodesic_backend
+        # cache of upsampling operators, by (source_level, target_level)
+        self._upsample_operators = {}
+        # cache of smoothing operators, by dtype or device
+        self._smoothing_operators = {}
 
         # initialise distance solver
         self.setup_distance_solver()
@@ -25,10 +37,9 @@ class GraphTools:
         self.device = "cpu"
         self.pool7 = self.pool(level=6)
         self.pool6 = self.pool(level=5)
-        self.unpool6 = self.unpool(level=6)
-        self.unpool7 = self.unpool(level=7)
+        self.upsample_operator(source_level=5, target_level=7)
         self.smooth5 = self.smoother(level=5)
-        self.solver = pp3d.MeshHeatMethodDistanceSolver(self.coords, self.icospheres.icospheres[5]["faces"])
+        self.solver = GEODESIC_SOLVERS[self.geodesic_backend](self.coords, self.icospheres.icospheres[5]["faces"])
         self.smoother_op = self.smoother(level=7)
 
     def pool(self, level=7):
@@ -42,6 +53,36 @@ class GraphTools:
         unpooling = HexUnpool(upsample_indices=upsample, target_size=num)
         return unpooling
 
+    def upsample_operator(self, source_level, target_level=7):
+        """
+        Linear operator upsampling vertex values from source_level to target_level, as repeated HexUnpool
+        (new vertices are the mean of the two vertices of the edge they split).
+        Operators are computed once and cached.
+
+        Returns:
+            sparse (n_target_vertices, n_source_vertices) csr matrix.
+        """
+        key = (source_level, target_level)
+        if key not in self._upsample_operators:
+            n_vertices = len(self.icospheres.icospheres[source_level]["coords"])
+            operator = sparse.identity(n_vertices, format="csr")
+            for level in range(source_level + 1, target_level + 1):
+                upsample_indices = np.asarray(self.icospheres.get_upsample(target_level=level))
+                n_new = len(upsample_indices)
+                new_vertices = np.arange(n_vertices, n_vertices + n_new)
+                rows = np.concatenate([np.arange(n_vertices), np.repeat(new_vertices, 2)])
+                cols = np.concatenate([np.arange(n_vertices), upsample_indices.ravel()])
+                values = np.concatenate([np.ones(n_vertices), np.full(2 * n_new, 0.5)])
+                unpool = sparse.csr_matrix((values, (rows, cols)), shape=(n_vertices + n_new, n_vertices))
+                operator = unpool @ operator
+                n_vertices += n_new
+            self._upsample_operators[key] = operator.tocsr()
+        return self._upsample_operators[key]
+
+    def upsample(self, data, source_level, target_level=7):
+        """upsample (n_source_vertices,) or (n_source_vertices, n_features) numpy array data to target_level"""
+        return self.upsample_operator(source_level, target_level) @ data
+
     def smoother(self, level=7):
         neighbours = self.icospheres.get_neighbours(level=level)
         pooling = HexSmoothSparse(neighbours=neighbours)
@@ -53,6 +94,51 @@ class GraphTools:
         # data=data.astype(np.float16)
         return data
 
+    def smoothing_operator(self, dtype=np.float32):
+        """level 7 smoothing matrix of smoother_op in dtype, as cached scipy csr matrix"""
+        key = np.dtype(dtype).name
+        if key not in self._smoothing_operators:
+            self._smoothing_operators[key] = self.smoother_op.sparse_weights.tocsr().astype(dtype)
+        return self._smoothing_operators[key]
+
+    def smoothing_operator_torch(self, device="cpu"):
+        """level 7 smoothing matrix of smoother_op, as cached float32 torch sparse tensor on device"""
+        key = str(device)
+        if key not in self._smoothing_operators:
+            operator = self.smoothing_operator(np.float32).tocoo()
+            indices = torch.from_numpy(np.vstack([operator.row, operator.col]).astype(np.int64))
+            self._smoothing_operators[key] = (
+                torch.sparse_coo_tensor(indices, torch.from_numpy(operator.data), operator.shape).coalesce().to(device)
+            )
+        return self._smoothing_operators[key]
+
+    def smooth_labels(self, labels, iteration=10):
+        """
+        Smooth lesion labels as smoothing, in float32, for a whole batch at once (one SpMM per iteration).
+
+        Powers of the smoothing matrix are not precomputed: S^10 has ~330 non-zeros per row on level 7 (650MB),
+        and multiplying with it is slower than 10 multiplications with S.
+
+        Args:
+            labels (np.array or torch.Tensor): (n_vertices,) or (n_samples, n_vertices) labels.
+                Tensors are smoothed with smoothing_operator_torch on their device.
+            iteration (int): number of smoothing steps.
+
+        Returns:
+            float32 smoothed labels, same shape and type as labels.
+        """
+        if torch.is_tensor(labels):
+            operator = self.smoothing_operator_torch(labels.device)
+            smoothed = labels.float().reshape(-1, operator.shape[0]).t()
+            for i in range(iteration):
+                smoothed = torch.sparse.mm(operator, smoothed)
+            return smoothed.t().reshape(labels.shape)
+        operator = self.smoothing_operator(np.float32)
+        smoothed = np.asarray(labels, dtype=np.float32).T
+        for i in range(iteration):
+            smoothed = operator @ smoothed
+        return smoothed.T
+
     def fast_geodesics(self, lesion):
         """calculate geodesic distances on downsampled mesh then upsample
         currently calculating on level 5, with two upsample steps"""
@@ -63,33 +149,67 @@ class GraphTools:
             print("ERROR, called fast_geodesics, but have no lesion!")
             n_vert = len(self.icospheres.icospheres[7]["coords"])
             return np.ones(n_vert) * 300
-        n_vert = len(self.icospheres.icospheres[5]["coords"])
+        return self.batch_geodesics(np.asarray(lesion)[None])[0]
+
+    def batch_geodesics(self, lesions):
+        """
+        Signed geodesic distances to the boundaries of several lesions, as fast_geodesics.
+        Distances are calculated on level 5 for all lesions at once, then upsampled.
+
+        Args:
+            lesions (np.array): (n_lesions, n_vertices) lesion masks on level 7.
+
+        Returns:
+            (n_lesions, n_vertices) array of distances, negative inside lesions. 300 for masks without lesion.
+        """
+        lesions = np.asarray(lesions, dtype=np.float32)
+        has_lesion = lesions.sum(axis=1) > 0
+        full_upsampled = np.full(lesions.shape, 300.0)
+        if not has_lesion.any():
+            return full_upsampled
+        lesions = lesions[has_lesion]
 
-        indices = np.arange(n_vert, dtype=int)
-        downsampled1 = self.pool7(torch.from_numpy(lesion.reshape(-1, 1)))
-        lesion_small = self.pool6(downsampled1).detach().cpu().numpy().ravel()
+        # downsample lesions, as (n_vertices, n_lesions) arrays
+        downsampled1 = self.pool7(torch.from_numpy(np.ascontiguousarray(lesions.T)))
+        lesion_small = self.pool6(downsampled1).detach().cpu().numpy()
 
         # find boundaries of lesions
         non_lesion = (lesion_small == 0).astype(np.float32)
         new_nonlesion = self.smooth5(non_lesion)
-        diff = (new_nonlesion - non_lesion) > 0
-        lesion_boundary_vertices = indices[diff]
-        boundary_distance = self.solver.compute_distance_multisource(lesion_boundary_vertices)
+        lesion_boundaries = (new_nonlesion - non_lesion) > 0
+        boundary_distance = np.abs(self.solver.compute_distance_multisource_batch(lesion_boundaries))
 
         # upsample distance
-        # boundary_distance[lesion_small == 1] = 0
-        boundary_distance[lesion_small > 0] = -np.abs(boundary_distance[lesion_small > 0])
-        boundary_distance[lesion_small == 0] = np.abs(boundary_distance[lesion_small == 0])
-        upsampled1 = self.unpool6(torch.from_numpy(boundary_distance.reshape(-1, 1)), device=self.device)
-        full_upsampled = self.unpool7(upsampled1, device=self.device)
-        full_upsampled = full_upsampled.detach().cpu().numpy().ravel()
+        boundary_distance *= np.where(lesion_small > 0, -1, 1)
+        upsampled = np.abs(self.upsample(boundary_distance, source_level=5, target_level=7)).T
 
         # inverse values on the lesion
-        full_upsampled[lesion > 0] = -np.abs(full_upsampled[lesion > 0])
-        full_upsampled[lesion == 0] = np.abs(full_upsampled[lesion == 0])
+        full_upsampled[has_lesion] = upsampled * np.where(lesions > 0, -1, 1)
 
         # mask medial wall
         if self.distance_mask_medial_wall:
-            # print('masking medial wall on newly calculated distances')
-            full_upsampled[~self.cohort.cortex_mask] = 300
+            full_upsampled[:, ~self.cohort.cortex_mask] = 300
         return full_upsampled
+
+
+# GraphTools shared within this process, see get_graph_tools
+_graph_tools_registry = {}
+
+
+def get_graph_tools(icospheres, cohort=None, distance_mask_medial_wall=False, geodesic_backend="pp3d"):
+    """
+    Return GraphTools shared by all callers in this process with the same arguments.
+    Avoids building pooling, smoothing and upsampling operators and the distance solver more than once.
+    Arguments are as for GraphTools. Icospheres and cohort are compared by identity,
+    use meld_graph.icospheres.get_icospheres to share icospheres.
+    """
+    key = (id(icospheres), id(cohort), distance_mask_medial_wall, geodesic_backend)
+    if key not in _graph_tools_registry:
+        _graph_tools_registry[key] = GraphTools(
+            icospheres,
+            cohort=cohort,
+            distance_mask_medial_wall=distance_mask_medial_wall,
+            geodesic_backend=geodesic_backend,
+        )
+    return _graph_tools_registry[key]
+
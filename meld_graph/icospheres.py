@@ -1,4 +1,5 @@
 import os
+import json
 import numpy as np
 import nibabel as nb
 from scipy import sparse
@@ -8,11 +9,164 @@ from math import pi
 import logging
 
 
+# increase when arrays stored in the icosphere cache change, to rebuild existing caches
+ICOSPHERE_CACHE_VERSION = 1
+ICOSPHERE_CACHE_FILE = f"icospheres.v{ICOSPHERE_CACHE_VERSION}.cache"
+# files of every level the icosphere cache is created from
+ICOSPHERE_SOURCE_FILES = (
+    "ico{level}.surf.gii",
+    "ico{level}.neighbours.npy",
+    "ico{level}.edges_and_attrs.npy",
+    "ico{level}.spirals.npy",
+    "ico{level}.pseudo.npy",
+)
+# arrays of every level stored in the icosphere cache
+ICOSPHERE_CACHE_ARRAYS = (
+    "coords",
+    "faces",
+    "spherical_coords",
+    "neighbours_indptr",
+    "neighbours_indices",
+    "edges",
+    "exact_edge_attr",
+    "pseudo_edge_attr",
+    "spirals",
+)
+
+
+def _pair_lookup(a, b, n):
+    """
+    Sorted keys of vertex pairs (a, b), for vectorised lookup of pairs with _find_pairs.
+
+    Args:
+        a, b (np.array): vertex indices of pairs.
+        n (int): number of vertices.
+
+    Returns:
+        sorted keys and the indices into a and b that sort them.
+    """
+    keys = a.astype(np.int64) * n + b
+    order = np.argsort(keys, kind="stable")
+    return keys[order], order
+
+
+def _find_pairs(lookup, a, b, n):
+    """indices of pairs (a, b) in the arrays used to create lookup with _pair_lookup. All pairs need to exist."""
+    sorted_keys, order = lookup
+    return order[np.searchsorted(sorted_keys, a.astype(np.int64) * n + b)]
+
+
+class IcoSphereCache:
+    """
+    Single file cache of named numpy arrays, that are loaded as read-only memory maps.
+
+    The file starts with a magic string, the length of a json header and the header,
+    which contains the cache version, dtype, shape and offset of every array,
+    and the modification times and sizes of the files the arrays were created from.
+    Array data follows, aligned to 64 bytes.
+
+    Args:
+        path (str): cache file.
+    """
+
+    MAGIC = b"MELDICO\0"
+    ALIGN = 64
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f"{path} is not an icosphere cache")
+            header_len = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+            self.header = json.loads(f.read(header_len).decode())
+        if self.header["version"] != ICOSPHERE_CACHE_VERSION:
+            raise ValueError(f"{path} has version {self.header['version']}, expected {ICOSPHERE_CACHE_VERSION}")
+
+    def __contains__(self, name):
+        return name in self.header["arrays"]
+
+    @property
+    def sources(self):
+        """modification times and sizes of source files, when the cache was created"""
+        return self.header.get("sources", None)
+
+    def load(self, name):
+        """return array name as read-only memory map"""
+        info = self.header["arrays"][name]
+        return np.memmap(self.path, dtype=info["dtype"], mode="r", offset=info["offset"], shape=tuple(info["shape"]))
+
+    @classmethod
+    def write(cls, path, arrays, sources=None):
+        """
+        Write dict of arrays to cache file path. The file is replaced atomically.
+
+        Args:
+            path (str): cache file.
+            arrays (dict): named arrays.
+            sources (dict): modification times and sizes of source files, see source_file_stamps.
+        """
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+        header = {"version": ICOSPHERE_CACHE_VERSION, "arrays": {}, "sources": sources}
+        # header size depends on offsets, reserve enough space for it
+        header_space = cls.ALIGN * (len(json.dumps({name: [0] * 8 for name in arrays})) // cls.ALIGN + 2) + 4096
+        header_space += len(json.dumps(sources))
+        offset = len(cls.MAGIC) + 8 + header_space
+        for name, array in arrays.items():
+            offset = -(-offset // cls.ALIGN) * cls.ALIGN
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset += array.nbytes
+        header_bytes = json.dumps(header).encode()
+        assert len(header_bytes) <= header_space
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(np.array([len(header_bytes)], dtype="<u8").tobytes())
+            f.write(header_bytes)
+            for name, array in arrays.items():
+                f.seek(header["arrays"][name]["offset"])
+                f.write(array.tobytes())
+        os.replace(tmp_path, path)
+
+
+def source_file_stamps(icosphere_path):
+    """
+    Modification times (ns) and sizes of the files icospheres are created from.
+
+    Returns:
+        dict of [mtime, size] for every file of ICOSPHERE_SOURCE_FILES, None for files that do not exist.
+    """
+    stamps = {}
+    for level in range(1, 8):
+        for pattern in ICOSPHERE_SOURCE_FILES:
+            name = pattern.format(level=level)
+            try:
+                stat = os.stat(os.path.join(icosphere_path, name))
+                stamps[name] = [stat.st_mtime_ns, stat.st_size]
+            except FileNotFoundError:
+                stamps[name] = None
+    return stamps
+
+
+class _LazyDict(dict):
+    """dict that calls loader(key) to add missing keys on first access"""
+
+    def __init__(self, loader, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loader = loader
+
+    def __missing__(self, key):
+        self.loader(key)
+        if not dict.__contains__(self, key):
+            raise KeyError(key)
+        return dict.__getitem__(self, key)
+
+
 class IcoSpheres:
     """
     Icospheres representation, with functions for loading, downsampling, upsampling, etc.
 
     Icospheres at each level are stored in self.icospheres[1:7].
+    Levels are loaded lazily, when they are first accessed.
     Autoloads & calculates:
         'coords': spherical coordinates
         'faces': triangle faces
@@ -20,11 +174,17 @@ class IcoSpheres:
         'edges': all edges
         'adj_mat': sparse adjacency matrix
 
+    Levels are loaded from a single memory-mapped cache file in icosphere_path (see IcoSphereCache),
+    that contains all derived arrays of all levels. If it does not exist, it is created from the
+    GIFTI files (and .npy files of neighbours, edges and spirals, if present) on first use.
+    The cache is created again if any of these files changed since the cache was created.
+
     Args:
         distance_type (str): 'exact' or 'pseudo'
             exact - edge length and flattened relative angle
             pseudo - relative polar coordinates
         conv_type (str): GMMConv or SpiralConv
+        read_only (bool): make numpy arrays read-only. Arrays loaded from the cache are always read-only.
     """
 
     def __init__(
@@ -32,41 +192,140 @@ class IcoSpheres:
         icosphere_path="data/icospheres/",
         distance_type="pseudo",
         conv_type="GMMConv",
+        read_only=False,
         **kwargs,
     ):
         # TODO already gets combine_hemis as input, can use that to choose edges file
         self.log = logging.getLogger(__name__)
         self.icosphere_path = icosphere_path
-        self.icospheres = {}
+        self.icospheres = _LazyDict(self.load_one_level)
         self.conv_type = conv_type
         self.distance_type = distance_type
+        self.read_only = read_only
+        # device of tensors, set by to
+        self.device = None
+        # shared by get_icospheres, tensors stay on cpu
+        self.shared = False
+        self._cache = None
         self.log.debug(f"Using coord type {self.distance_type}")
-        self.load_all_levels()
+
+    @property
+    def cache(self):
+        """
+        IcoSphereCache of icosphere_path, created if it does not exist or if its source files changed.
+        None if it cannot be created.
+        """
+        if self._cache is None:
+            path = os.path.join(self.icosphere_path, ICOSPHERE_CACHE_FILE)
+            cache = None
+            if os.path.isfile(path):
+                try:
+                    cache = IcoSphereCache(path)
+                except ValueError as e:
+                    self.log.warning(f"Ignoring icosphere cache: {e}")
+            if cache is None or cache.sources != source_file_stamps(self.icosphere_path):
+                if cache is not None:
+                    self.log.info(f"Source files of icosphere cache {path} changed")
+                try:
+                    self.create_cache(path)
+                except OSError as e:
+                    self.log.warning(f"Could not create icosphere cache {path}: {e}")
+                    return None
+                cache = IcoSphereCache(path)
+            self._cache = cache
+        return self._cache
+
+    def create_cache(self, path):
+        """
+        Compute arrays of all levels from the GIFTI files, and write them to cache file path.
+        Levels are computed with a separate IcoSpheres, the levels of this IcoSpheres are not changed.
+        """
+        self.log.info(f"Creating icosphere cache {path}")
+        builder = IcoSpheres(
+            icosphere_path=self.icosphere_path, distance_type=self.distance_type, conv_type=self.conv_type
+        )
+        arrays = {}
+        for level in np.arange(7) + 1:
+            surf = builder.load_one_level_from_files(level, all_arrays=True)
+            for name in ICOSPHERE_CACHE_ARRAYS:
+                array = surf[name]
+                if name == "spirals":
+                    array = array.numpy()
+                arrays[f"ico{level}/{name}"] = array
+        # stamps after creating the levels, which saves .npy files that do not exist yet
+        IcoSphereCache.write(path, arrays, sources=source_file_stamps(self.icosphere_path))
 
     def load_all_levels(self):
         for level in np.arange(7) + 1:
-            self.load_one_level(level=level)
+            self.icospheres[level]
         return
 
     def load_one_level(self, level=7):
+        if level not in range(1, 8):
+            return
+        if self.cache is not None:
+            self.load_one_level_from_cache(level=level)
+        else:
+            self.load_one_level_from_files(level=level)
+        if self.read_only:
+            for value in self.icospheres[level].values():
+                if isinstance(value, np.ndarray):
+                    value.setflags(write=False)
+        if self.device is not None:
+            self.level_to(level, self.device)
+        return
+
+    def load_one_level_from_cache(self, level=7):
+        surf = _LazyDict(lambda key: self.load_derived(level, key))
+        self.icospheres[level] = surf
+        for name in ICOSPHERE_CACHE_ARRAYS:
+            if name not in ["pseudo_edge_attr", "spirals"]:
+                surf[name] = self.cache.load(f"ico{level}/{name}")
+        # add tensors needed for model
+        surf["t_edges"] = torch.tensor(surf["edges"].T, dtype=torch.long).contiguous()
+        surf["t_exact_edge_attr"] = torch.tensor(surf["exact_edge_attr"], dtype=torch.float)
+        if self.conv_type == "SpiralConv":
+            surf["spirals"] = torch.tensor(self.cache.load(f"ico{level}/spirals"), dtype=torch.long)
+        elif self.conv_type == "GMMConv":
+            if self.distance_type == "pseudo":
+                surf["pseudo_edge_attr"] = self.cache.load(f"ico{level}/pseudo_edge_attr")
+                surf["t_pseudo_edge_attr"] = torch.tensor(surf["pseudo_edge_attr"], dtype=torch.float)
+        return
+
+    def load_one_level_from_files(self, level=7, all_arrays=False):
+        """load level from GIFTI and .npy files. If all_arrays, load all arrays stored in the cache"""
         self.load_icosphere(level=level)
         self.calculate_neighbours(level=level)
         self.spherical_coords(level=level)
         self.get_exact_edge_attrs(level=level)
-        self.calculate_adj_mat(level=level)
-        if self.conv_type == "SpiralConv":
+        if self.conv_type == "SpiralConv" or all_arrays:
             self.create_spirals(level=level)
-        elif self.conv_type == "GMMConv":
-            if self.distance_type == "pseudo":
-                self.calculate_pseudo_edge_attrs(level=level)
+        if (self.conv_type == "GMMConv" and self.distance_type == "pseudo") or all_arrays:
+            self.calculate_pseudo_edge_attrs(level=level)
+        return self.icospheres[level]
+
+    def load_derived(self, level, key):
+        """calculate arrays of level that are only needed by some callers, when first accessed"""
+        surf = self.icospheres[level]
+        if key == "neighbours":
+            indptr, indices = surf["neighbours_indptr"], surf["neighbours_indices"]
+            neighbours = np.empty(len(indptr) - 1, dtype=object)
+            for v in range(len(neighbours)):
+                neighbours[v] = indices[indptr[v] : indptr[v + 1]]
+            surf["neighbours"] = neighbours
+        elif key == "adj_mat":
+            self.calculate_adj_mat(level=level)
+        if self.read_only and isinstance(surf.get(key), np.ndarray):
+            surf[key].setflags(write=False)
         return
 
     def load_icosphere(self, level=7):
         surf_nb = nb.load(os.path.join(self.icosphere_path, f"ico{level}.surf.gii"))
-        self.icospheres[level] = {
-            "coords": surf_nb.darrays[0].data,
-            "faces": surf_nb.darrays[1].data,
-        }
+        self.icospheres[level] = _LazyDict(
+            lambda key: self.load_derived(level, key),
+            coords=surf_nb.darrays[0].data,
+            faces=surf_nb.darrays[1].data,
+        )
         return
 
     def calculate_adj_mat(self, level=7):
@@ -91,7 +350,10 @@ class IcoSpheres:
                 dtype=object,
             )
             np.save(file_path, self.icospheres[level]["neighbours"], allow_pickle=True)
-
+        # flattened neighbours
+        neighbours = self.icospheres[level]["neighbours"]
+        self.icospheres[level]["neighbours_indptr"] = np.concatenate([[0], np.cumsum([len(n) for n in neighbours])])
+        self.icospheres[level]["neighbours_indices"] = np.concatenate(neighbours).astype(int)
         return
 
     def spherical_coords(self, level=7):
@@ -125,19 +387,29 @@ class IcoSpheres:
         return
 
     def to(self, device):
-        """loads edges, edge vectors and neighbors to device (eg GPU)"""
+        """
+        loads edges, edge vectors and neighbors to device (eg GPU). Levels loaded later are loaded to device.
+        Not possible for icospheres shared with get_icospheres.
+        """
+        assert not self.shared, (
+            "Icospheres of get_icospheres are shared by all models and datasets and stay on cpu. "
+            "Move models with model.to(device), which moves their index tensors"
+        )
+        self.device = device
         for level in self.icospheres.keys():
-            self.icospheres[level]["t_edges"] = self.icospheres[level]["t_edges"].to(device)
-            if self.conv_type == "SpiralConv":
-                self.icospheres[level]["spirals"] = self.icospheres[level]["spirals"].to(device)
-            elif self.conv_type == "GMMConv":
-                if self.distance_type == "exact":
-                    self.icospheres[level]["t_exact_edge_attr"] = self.icospheres[level]["t_exact_edge_attr"].to(device)
-                elif self.distance_type == "pseudo":
-                    self.icospheres[level]["t_pseudo_edge_attr"] = self.icospheres[level]["t_pseudo_edge_attr"].to(
-                        device
-                    )
+            self.level_to(level, device)
+        return
 
+    def level_to(self, level, device):
+        """loads edges, edge vectors and neighbors of level to device"""
+        self.icospheres[level]["t_edges"] = self.icospheres[level]["t_edges"].to(device)
+        if self.conv_type == "SpiralConv":
+            self.icospheres[level]["spirals"] = self.icospheres[level]["spirals"].to(device)
+        elif self.conv_type == "GMMConv":
+            if self.distance_type == "exact":
+                self.icospheres[level]["t_exact_edge_attr"] = self.icospheres[level]["t_exact_edge_attr"].to(device)
+            elif self.distance_type == "pseudo":
+                self.icospheres[level]["t_pseudo_edge_attr"] = self.icospheres[level]["t_pseudo_edge_attr"].to(device)
         return
 
     # helper functions
@@ -156,16 +428,35 @@ class IcoSpheres:
         Input: tris
         Returns Nested list. Each list corresponds
         to the ordered neighbours for the given vertex"""
+        indptr, indices = self.get_neighbours_csr_from_tris(tris)
+        return np.split(indices, indptr[1:-1])
+
+    def get_neighbours_csr_from_tris(self, tris):
+        """
+        Ordered neighbours of all vertices from tris, as flattened arrays.
+        Neighbours of vertex v are indices[indptr[v]:indptr[v+1]], in the same order as sort_neighbours.
+
+        Uses a table of half-edges: vertex v of each triangle has the opposite half-edge (a, b),
+        and the neighbours of v are found by following b from a around v, for all vertices at once.
+        """
+        tris = np.asarray(tris).astype(int)
         n_vert = np.max(tris) + 1
-        neighbours = [[] for i in range(n_vert)]
-        for tri in tris:
-            neighbours[tri[0]].append([tri[1], tri[2]])
-            neighbours[tri[2]].append([tri[0], tri[1]])
-            neighbours[tri[1]].append([tri[2], tri[0]])
-        # Get unique neighbours
-        for k in range(len(neighbours)):
-            neighbours[k] = self.sort_neighbours(neighbours[k])
-        return neighbours
+        # half-edges opposite to each corner of each triangle, in order of triangles
+        vertices = tris.ravel()
+        starts = tris[:, [1, 2, 0]].ravel()
+        ends = tris[:, [2, 0, 1]].ravel()
+        counts = np.bincount(vertices, minlength=n_vert)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        # the walk around each vertex starts at the first half-edge of its first triangle
+        first = np.argsort(vertices, kind="stable")[indptr[:-1]]
+        lookup = _pair_lookup(vertices, starts, n_vert)
+        current = starts[first]
+        neighbours = np.zeros((n_vert, counts.max()), dtype=int)
+        for i in range(counts.max()):
+            current = ends[_find_pairs(lookup, np.arange(n_vert), current, n_vert)]
+            neighbours[:, i] = current
+        indices = neighbours[np.arange(counts.max()) < counts[:, None]]
+        return indptr, indices
 
     def sort_neighbours(self, edges):
         edges = np.vstack(edges)
@@ -227,25 +518,57 @@ class IcoSpheres:
         return
 
     def calculate_exact_edge_attrs(self, level=7):
+        """
+        Edges and exact edge attributes of all vertices, as vertex_attributes for each vertex.
+        Returns (n_vertices + n_edges, 4) array of self edge and edges to ordered neighbours of each vertex,
+        with flattened angle and distance of each edge.
+        """
         surf = self.icospheres[level]
-        n_vert = len(surf["coords"])
-        all_edge_attrs = []
-        for v in np.arange(n_vert):
-            edge_attrs = self.vertex_attributes(surf, v)
-            all_edge_attrs.append(edge_attrs)
-        all_edge_attrs = np.vstack(all_edge_attrs)
+        coords = surf["coords"]
+        indptr, indices = surf["neighbours_indptr"], surf["neighbours_indices"]
+        n_vert = len(coords)
+        counts = np.diff(indptr)
+        # (n_vertices, max_neighbours) tables of neighbours, and of previous neighbours
+        valid = np.arange(counts.max()) < counts[:, None]
+        neighbours = np.zeros(valid.shape, dtype=int)
+        neighbours[valid] = indices
+        previous = np.roll(neighbours, 1, axis=1)
+        previous[:, 0] = neighbours[np.arange(n_vert), counts - 1]
+        vertices = np.repeat(np.arange(n_vert), counts)
+        v1 = coords[indices] - coords[vertices]
+        v2 = coords[previous[valid]] - coords[vertices]
+        angles = np.zeros(valid.shape, dtype=v1.dtype)
+        angles[valid] = self.findAnglesBetweenTwoVectors1(v1, v2)
+        cum_angles = angles.cumsum(axis=1)
+        total_angle = cum_angles[np.arange(n_vert), counts - 1]
+        angles_flattened = 2 * pi * cum_angles / total_angle[:, None]
+        # self edge of each vertex, followed by its neighbours
+        self_rows = indptr[:-1] + np.arange(n_vert)
+        neighbour_rows = np.ones(len(indices) + n_vert, dtype=bool)
+        neighbour_rows[self_rows] = False
+        all_edge_attrs = np.zeros((len(indices) + n_vert, 4))
+        all_edge_attrs[self_rows] = [0, 0, 1e-15, 1e-15]
+        all_edge_attrs[self_rows, :2] = np.arange(n_vert)[:, None]
+        all_edge_attrs[neighbour_rows, 0] = vertices
+        all_edge_attrs[neighbour_rows, 1] = indices
+        all_edge_attrs[neighbour_rows, 2] = angles_flattened[valid]
+        all_edge_attrs[neighbour_rows, 3] = np.linalg.norm(v1, axis=1)
         return all_edge_attrs
 
     def get_neighbours(self, level=7):
         """return 7*n_vertex array of neighbours, with self neighbours
         and repeated self index if only 5 neighbours"""
         if "t_neighbours" not in self.icospheres[level].keys():
-            self.icospheres[level]["t_neighbours"] = np.tile(np.arange(len(self.icospheres[level]["coords"])), (7, 1)).T
-            for ni, n in enumerate(self.icospheres[level]["neighbours"]):
-                self.icospheres[level]["t_neighbours"][ni, -len(n) :] = n
-            self.icospheres[level]["t_neighbours"] = torch.tensor(
-                self.icospheres[level]["t_neighbours"], dtype=torch.long
-            )
+            indptr = self.icospheres[level]["neighbours_indptr"]
+            indices = self.icospheres[level]["neighbours_indices"]
+            n_vertices = len(indptr) - 1
+            t_neighbours = np.tile(np.arange(n_vertices), (7, 1)).T
+            # neighbours fill the last columns of each row
+            counts = np.diff(indptr)
+            rows = np.repeat(np.arange(n_vertices), counts)
+            cols = np.arange(len(indices)) - np.repeat(indptr[:-1], counts) + np.repeat(7 - counts, counts)
+            t_neighbours[rows, cols] = indices
+            self.icospheres[level]["t_neighbours"] = torch.tensor(t_neighbours, dtype=torch.long)
         return self.icospheres[level]["t_neighbours"]
 
     def get_downsample(self, target_level=6):
@@ -299,13 +622,53 @@ class IcoSpheres:
         return self.icospheres[level]["spirals"]
 
     def calculate_spirals(self, level=7, size=20):
-        """precalculate spinal kernels"""
-        neighbours = self.icospheres[level]["neighbours"]
-        n_vertices = len(neighbours)
-        spirals = np.zeros((n_vertices, size))
-        for v in np.arange(n_vertices):
-            spirals[v] = self.get_spiral_for_vertex(neighbours, vertex=v, size=size)
-        return spirals
+        """
+        precalculate spinal kernels of all vertices, as get_spiral_for_vertex for each vertex.
+
+        Spirals of all vertices are extended at once: each step moves to the next center around the previous
+        center, and adds its neighbours from the last spiral vertex up to the next vertex after the center.
+        """
+        surf = self.icospheres[level]
+        indptr, indices = surf["neighbours_indptr"], surf["neighbours_indices"]
+        n_vertices = len(indptr) - 1
+        counts = np.diff(indptr)
+        # positions of each vertex in the neighbour rings
+        lookup = _pair_lookup(np.repeat(np.arange(n_vertices), counts), indices, n_vertices)
+
+        def ring_position(centers, vertices):
+            return _find_pairs(lookup, centers, vertices, n_vertices) - indptr[centers]
+
+        # spirals start with the vertex and its neighbours, and grow by at most max_neighbours each step
+        max_length = size + counts.max()
+        spirals = np.zeros((n_vertices, max_length), dtype=int)
+        spirals[:, 0] = np.arange(n_vertices)
+        valid = np.arange(counts.max()) < counts[:, None]
+        spirals[:, 1 : counts.max() + 1][valid] = indices
+        lengths = counts + 1
+        centers = np.arange(n_vertices)
+        active = np.flatnonzero(lengths < size)
+        while len(active) > 0:
+            spiral = spirals[active]
+            v_start = spiral[np.arange(len(active)), lengths[active] - 1]
+            old_centers = centers[active]
+            # next center follows the last spiral vertex around the old center
+            position = (ring_position(old_centers, v_start) + 1) % counts[old_centers]
+            new_centers = indices[indptr[old_centers] + position]
+            # stop vertex is next in spiral after the new center
+            in_spiral = (spiral == new_centers[:, None]) & (np.arange(max_length) < lengths[active][:, None])
+            stop_vertex = spiral[np.arange(len(active)), in_spiral.argmax(axis=1) + 1]
+            # neighbours of new center after the last spiral vertex, up to the stop vertex
+            new_counts = counts[new_centers]
+            start = ring_position(new_centers, v_start) + 1
+            n_added = (ring_position(new_centers, stop_vertex) - start) % new_counts
+            for j in range(n_added.max()):
+                add = np.flatnonzero(j < n_added)
+                rows = active[add]
+                spirals[rows, lengths[rows]] = indices[indptr[new_centers[add]] + (start[add] + j) % new_counts[add]]
+                lengths[rows] += 1
+            centers[active] = new_centers
+            active = active[lengths[active] < size]
+        return spirals[:, :size].astype(float)
 
     def get_spiral_for_vertex(self, neighbours, vertex=0, size=10):
         """create spiral convolution"""
@@ -330,3 +693,29 @@ class IcoSpheres:
             old_neighbours = new_neighbours
 
         return np.array(spiral[:size])
+
+
+# IcoSpheres shared within this process, by (icosphere_path, distance_type, conv_type)
+_icospheres_registry = {}
+
+
+def get_icospheres(icosphere_path="data/icospheres/", distance_type="pseudo", conv_type="GMMConv", **kwargs):
+    """
+    Return IcoSpheres shared by all callers in this process with the same icosphere_path, distance_type and conv_type.
+    Loading icospheres is slow and their arrays are large, so models, datasets and graph tools should use this
+    instead of creating their own IcoSpheres.
+
+    Numpy arrays of the shared icospheres are read-only. Callers that need to modify them need to copy them first.
+    Tensors of the shared icospheres stay on cpu, and the shared icospheres cannot be moved to another device.
+    Models keep index tensors as non-persistent buffers, that are moved to the device of the model.
+    Arguments are as for IcoSpheres.
+    """
+    key = (os.path.normpath(icosphere_path), distance_type, conv_type)
+    if key not in _icospheres_registry:
+        icospheres = IcoSpheres(
+            icosphere_path=icosphere_path, distance_type=distance_type, conv_type=conv_type, read_only=True
+        )
+        icospheres.shared = True
+        _icospheres_registry[key] = icospheres
+    return _icospheres_registry[key]
+
@@ -0,0 +1,230 @@
+#Contains SyntheticLesionBank, precomputed synthetic lesions that replace per-sample lesion generation
+
+import os
+import json
+import time
+import logging
+import multiprocessing
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.stats import special_ortho_group
+from meld_graph.icospheres import get_icospheres
+from meld_graph.graph_tools import get_graph_tools
+from meld_graph.data_preprocessing import Preprocess
+
+# increase when the content of banks changes, so that outdated banks are detected
+BANK_VERSION = 2
+# arrays stored for every lesion in the bank, and their dtypes
+BANK_FIELDS = {"labels": np.uint8, "smoothed": np.float16, "smooth_labels": np.float16, "distances": np.float32}
+
+
+def create_lesion(prep, gt, coords, radius, smooth_lesion, seed):
+    """
+    Create one synthetic lesion, as Preprocess.add_lesion and GraphDataset.add_smooth_label_and_dists would.
+
+    The lesion mask is restricted to cortex, but the smoothed mask and the distances are not masked,
+    so that they are still valid after rotating the lesion. gt should not mask the medial wall in distances.
+
+    Returns:
+        dict with BANK_FIELDS: lesion mask, gaussian smoothed mask (used to add the lesion to the features),
+        smoothed labels and geodesic distances to the lesion boundary.
+    """
+    np.random.seed(seed)
+    lesion = np.zeros(len(coords))
+    # lesions can fall completely into the medial wall
+    while not lesion.any():
+        if smooth_lesion:
+            lesion, smoothed = prep.create_lesion_mask(radius, coords, return_smoothed=True)
+        else:
+            lesion = smoothed = prep.create_lesion_mask(radius, coords, return_smoothed=False)
+        lesion[~prep.cohort.cortex_mask] = 0
+    labels = lesion.astype("int32")
+    return {
+        "labels": labels,
+        "smoothed": smoothed,
+        "smooth_labels": gt.smooth_labels(labels, iteration=10),
+        "distances": gt.fast_geodesics(labels),
+    }
+
+
+def random_rotation_indices(coords, n_rotations, seed=0):
+    """
+    Vertex indices of n_rotations random rotations of the icosphere with coords.
+    values[indices] resamples values at the nearest vertex of each rotated vertex. This is an approximate rotation:
+    the indices are not permutations, some vertices are repeated and others are dropped.
+    """
+    tree = cKDTree(coords)
+    rotations = special_ortho_group.rvs(3, size=n_rotations, random_state=seed).reshape(n_rotations, 3, 3)
+    return np.array([tree.query(coords @ rotation)[1] for rotation in rotations], dtype=np.int32)
+
+
+# Preprocess and GraphTools of worker processes creating lesions
+_worker_tools = {}
+
+
+def _init_bank_worker(cohort):
+    icospheres = get_icospheres()
+    _worker_tools["prep"] = Preprocess(cohort=cohort)
+    # the medial wall is masked after rotation, in SyntheticLesionBank.sample
+    _worker_tools["gt"] = get_graph_tools(icospheres, cohort=cohort, distance_mask_medial_wall=False)
+    _worker_tools["coords"] = icospheres.icospheres[7]["coords"]
+
+
+def _create_lesion_worker(args):
+    radius, smooth_lesion, seed = args
+    tools = _worker_tools
+    return create_lesion(tools["prep"], tools["gt"], tools["coords"], radius, smooth_lesion, seed)
+
+
+class SyntheticLesionBank:
+    """
+    Memory-mapped bank of precomputed synthetic lesions.
+
+    Creating a synthetic lesion (polygon rasterisation on a lat-long grid, interpolation to the mesh,
+    geodesic distances and smoothing) is slow. A bank holds n_lesions lesions created offline with
+    SyntheticLesionBank.create, and sample returns one of them, rotated with one of n_rotations
+    precomputed rotations. Rotations resample values at the nearest vertices, so rotated lesions are
+    approximate (see random_rotation_indices). Rotations that move the lesion into the medial wall are rejected.
+    Smoothed masks and distances are stored without masking the medial wall, which is masked after rotation.
+
+    A bank is a directory containing:
+        info.json: parameters used to create the bank.
+        cortex_mask.npy: cortex mask used to create the lesions.
+        {field}.npy: (n_lesions, n_vertices) arrays of BANK_FIELDS.
+        rotations.npy: (n_rotations, n_vertices) vertex indices of rotations.
+
+    Args:
+        path (str): bank directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger(__name__)
+        with open(os.path.join(path, "info.json"), "r") as f:
+            self.info = json.load(f)
+        if self.info.get("version", 1) != BANK_VERSION:
+            self.log.warning(f"lesion bank {path} is outdated, recreate it with create_lesion_bank.py")
+        self.cortex_mask = np.load(os.path.join(path, "cortex_mask.npy"))
+        self.arrays = {field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r") for field in BANK_FIELDS}
+        self.rotations = np.load(os.path.join(path, "rotations.npy"), mmap_mode="r")
+
+    @property
+    def n_lesions(self):
+        return len(self.arrays["labels"])
+
+    @classmethod
+    def create(
+        cls,
+        path,
+        cohort,
+        n_lesions,
+        radius,
+        smooth_lesion=True,
+        distance_mask_medial_wall=True,
+        n_rotations=100,
+        num_workers=0,
+        seed=0,
+    ):
+        """
+        Create a bank of n_lesions synthetic lesions in directory path.
+
+        Args:
+            path (str): bank directory.
+            cohort (MeldCohort): cohort defining the cortex mask.
+            n_lesions (int): number of lesions.
+            radius (float): mean radius of lesions, see synthetic_data in example_experiment_config.py.
+            smooth_lesion (bool): compute gaussian smoothed lesion masks.
+            distance_mask_medial_wall (bool): mask medial wall in distance maps of sampled lesions to 300.
+            n_rotations (int): number of random rotations stored with the bank.
+            num_workers (int): number of processes creating lesions. 0 creates lesions in this process.
+            seed (int): random seed. Lesion i is created with seed + i.
+
+        Returns:
+            SyntheticLesionBank
+        """
+        log = logging.getLogger(__name__)
+        os.makedirs(path, exist_ok=True)
+        icospheres = get_icospheres()
+        coords = icospheres.icospheres[7]["coords"]
+        arrays = {
+            field: np.lib.format.open_memmap(
+                os.path.join(path, f"{field}.npy"), mode="w+", dtype=dtype, shape=(n_lesions, len(coords))
+            )
+            for field, dtype in BANK_FIELDS.items()
+        }
+        tasks = [(radius, smooth_lesion, seed + i) for i in range(n_lesions)]
+        start = time.perf_counter()
+        if num_workers > 0:
+            pool = multiprocessing.Pool(
+                num_workers, initializer=_init_bank_worker, initargs=(cohort,)
+            )
+            lesions = pool.imap(_create_lesion_worker, tasks)
+        else:
+            pool = None
+            _init_bank_worker(cohort)
+            lesions = map(_create_lesion_worker, tasks)
+        for i, lesion in enumerate(lesions):
+            for field, array in arrays.items():
+                array[i] = lesion[field]
+            if (i + 1) % 100 == 0:
+                log.info(f"created {i + 1} / {n_lesions} lesions")
+        if pool is not None:
+            pool.close()
+            pool.join()
+        duration = time.perf_counter() - start
+        log.info(f"created {n_lesions} lesions in {duration:.1f}s")
+        for array in arrays.values():
+            array.flush()
+        np.save(os.path.join(path, "rotations.npy"), random_rotation_indices(coords, n_rotations, seed=seed))
+        np.save(os.path.join(path, "cortex_mask.npy"), cohort.cortex_mask)
+        info = {
+            "version": BANK_VERSION,
+            "n_lesions": n_lesions,
+            "radius": radius,
+            "smooth_lesion": smooth_lesion,
+            "distance_mask_medial_wall": distance_mask_medial_wall,
+            "n_rotations": n_rotations,
+            "seed": seed,
+            "seconds_per_lesion": duration / max(n_lesions, 1),
+        }
+        with open(os.path.join(path, "info.json"), "w") as f:
+            json.dump(info, f, indent=4)
+        return cls(path)
+
+    def check_params(self, synth_params, distance_mask_medial_wall):
+        """warn if synthetic_data parameters differ from the parameters used to create this bank"""
+        for key, value in [
+            ("radius", synth_params["radius"]),
+            ("smooth_lesion", synth_params["smooth_lesion"]),
+            ("distance_mask_medial_wall", distance_mask_medial_wall),
+        ]:
+            if self.info[key] != value:
+                self.log.warning(f"{key} is {value}, but lesion bank {self.path} was created with {self.info[key]}")
+
+    def sample(self, max_tries=10):
+        """
+        Return random lesion of the bank, randomly rotated.
+
+        Args:
+            max_tries (int): number of rotations tried before returning the unrotated lesion,
+                if all rotations move lesional vertices into the medial wall.
+
+        Returns:
+            dict with float32 arrays labels, smoothed, smooth_labels and distances.
+        """
+        i = np.random.randint(self.n_lesions)
+        labels = self.arrays["labels"][i]
+        indices = None
+        for _ in range(max_tries):
+            rotation = self.rotations[np.random.randint(len(self.rotations))]
+            if not labels[rotation][~self.cortex_mask].any():
+                indices = rotation
+                break
+        lesion = {}
+        for field, array in self.arrays.items():
+            values = array[i] if indices is None else array[i][indices]
+            lesion[field] = values.astype(np.float32)
+        lesion["smoothed"][~self.cortex_mask] = 0
+        if self.info["distance_mask_medial_wall"]:
+            lesion["distances"][~self.cortex_mask] = 300
+        return lesion
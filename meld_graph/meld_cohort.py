@@ -1,6 +1,7 @@
 #Contains MeldCohort and MeldSubject classes
 
 from contextlib import contextmanager
+from collections import OrderedDict
 from meld_graph.paths import (
     DEMOGRAPHIC_FEATURES_FILE,
     CORTEX_LABEL_FILE,
@@ -19,17 +20,265 @@ import h5py
 import sys
 import glob
 import logging
+import atexit
 import meld_graph.mesh_tools as mt
+from meld_graph.feature_store import FeatureStore, get_feature_store, is_feature_store_root, HEMIS
 import scipy
 
 
+class HDF5FilePool:
+    """
+    Pool of open hdf5 file handles, keyed by file path.
+
+    Files stay open between calls, so that loading many features does not pay the cost of
+    opening the file and parsing its metadata every time.
+    Read-only handles are reopened with write permissions when needed, and are reopened
+    when the file was modified on disk by another process.
+    Handles that are in use are never reopened: opening a file for writing while it is open
+    for reading raises a RuntimeError.
+    Write handles are flushed at the end of every write and stay open until close() is called.
+    At most max_open_files files are kept open, the least recently used file is closed first.
+    Handles are never shared between processes: after a fork (e.g. in DataLoader workers)
+    or after unpickling, files are reopened on first access.
+
+    Args:
+        max_open_files (int): maximum number of files kept open.
+    """
+
+    def __init__(self, max_open_files=32):
+        self.max_open_files = max_open_files
+        self._reset()
+
+    def _reset(self):
+        # open h5py.File handles, from least to most recently used
+        self._handles = OrderedDict()
+        # number of active users of each handle
+        self._in_use = {}
+        # modification time of read-only files when they were opened
+        self._mtimes = {}
+        # handles opened by a parent process. Kept referenced so they are never closed by this process.
+        self._inherited = []
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        # file handles cannot be pickled
+        return {"max_open_files": self.max_open_files}
+
+    def __setstate__(self, state):
+        self.max_open_files = state["max_open_files"]
+        self._reset()
+
+    def _check_process(self):
+        """drop handles inherited from parent process"""
+        if os.getpid() != self._pid:
+            inherited = self._inherited + list(self._handles.values())
+            self._reset()
+            self._inherited = inherited
+
+    def _is_stale(self, path, f):
+        if not f.id.valid:
+            return True
+        if f.mode == "r":
+            try:
+                return os.stat(path).st_mtime_ns != self._mtimes.get(path)
+            except OSError:
+                return True
+        return False
+
+    @contextmanager
+    def file(self, path, write=False):
+        """
+        Context block yielding the pooled h5py.File for path.
+
+        Args:
+            path: path to hdf5 file.
+            write: open with writing permissions, or create the file if it does not exist.
+
+        Yields: the opened hdf5 file, or None if not write and the file does not exist.
+        """
+        f = self._acquire(path, write=write)
+        try:
+            yield f
+        finally:
+            if f is not None:
+                self._release(path, flush=write)
+
+    def _acquire(self, path, write=False):
+        self._check_process()
+        f = self._handles.get(path, None)
+        if f is not None and (self._is_stale(path, f) or (write and f.mode != "r+")):
+            if self._in_use.get(path, 0) > 0 and f.id.valid:
+                # never close a handle that is still used by an enclosing block
+                if write and f.mode != "r+":
+                    raise RuntimeError(
+                        f"Cannot open {path} for writing while it is open for reading. "
+                        "Open it with write=True in the outer block."
+                    )
+                # modified on disk: keep reading from the handle in use, it is reopened once released
+            else:
+                self._close(path)
+                f = None
+        if f is None:
+            # open existing file or create new one
+            if os.path.isfile(path):
+                f = h5py.File(path, "r+" if write else "r")
+            elif write:
+                f = h5py.File(path, "a")
+            else:
+                return None
+            if not write:
+                self._mtimes[path] = os.stat(path).st_mtime_ns
+            self._handles[path] = f
+        self._handles.move_to_end(path)
+        self._in_use[path] = self._in_use.get(path, 0) + 1
+        self._evict()
+        return f
+
+    def _release(self, path, flush=False):
+        self._in_use[path] = max(self._in_use.get(path, 0) - 1, 0)
+        f = self._handles.get(path, None)
+        if flush and f is not None and f.id.valid:
+            f.flush()
+
+    def _evict(self):
+        """close least recently used files that are not in use"""
+        n_excess = len(self._handles) - self.max_open_files
+        for path in list(self._handles.keys()):
+            if n_excess <= 0:
+                break
+            if self._in_use.get(path, 0) == 0:
+                self._close(path)
+                n_excess -= 1
+
+    def _close(self, path):
+        f = self._handles.pop(path)
+        self._mtimes.pop(path, None)
+        if f.id.valid:
+            f.close()
+
+    def flush(self):
+        """flush all files opened with write permissions"""
+        self._check_process()
+        for f in self._handles.values():
+            if f.id.valid and f.mode == "r+":
+                f.flush()
+
+    def close(self, path=None):
+        """close all open files, or only path if specified"""
+        self._check_process()
+        paths = list(self._handles.keys()) if path is None else [path]
+        for p in paths:
+            if p in self._handles:
+                self._close(p)
+
+
+# hdf5 file handles shared by all cohorts in this process,
+# so that cohorts reading and writing the same files do not hold conflicting handles
+HDF5_FILE_POOL = HDF5FilePool()
+atexit.register(HDF5_FILE_POOL.close)
+
+
+def get_file_stat(path):
+    """(mtime, size) of hdf5 file or FeatureStore directory, or None if path does not exist"""
+    if FeatureStore.exists(path):
+        return FeatureStore.file_stat(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class HDF5StoragePolicy:
+    """
+    Defines how features are stored in hdf5 files by MeldSubject.write_feature_values.
+
+    The default policy writes the original format: float32 values of all NVERT vertices, compressed with gzip level 9.
+    Writing and reading are considerably faster with lzf or no compression and cortex-only datasets.
+    Files written with any policy can be read by MeldSubject.
+
+    Args:
+        compression: None, "lzf" or "gzip".
+        compression_level: gzip compression level (0-9). Ignored for other compressions.
+        cortex_only: if True, only store values of cortex vertices. The cortex label is stored once per file,
+            in dataset "cortex_label".
+        dtype: "float32", or "float16" to halve the size of derived features that do not need full precision.
+    """
+
+    def __init__(self, compression="gzip", compression_level=9, cortex_only=False, dtype="float32"):
+        assert compression in (None, "lzf", "gzip"), f"unknown compression {compression}"
+        assert dtype in ("float32", "float16"), f"unsupported dtype {dtype}"
+        self.compression = compression
+        self.compression_level = compression_level
+        self.cortex_only = cortex_only
+        self.dtype = dtype
+
+    def __repr__(self):
+        return (
+            f"HDF5StoragePolicy(compression={self.compression}, compression_level={self.compression_level}, "
+            f"cortex_only={self.cortex_only}, dtype={self.dtype})"
+        )
+
+    def write(self, group, feature, cortex_values, cortex_mask):
+        """
+        Write cortex values of one hemisphere as dataset feature of hdf5 group.
+        Existing datasets are overwritten, or recreated if they were stored with a different policy.
+        """
+        if self.cortex_only:
+            values = np.asarray(cortex_values, dtype=self.dtype)
+            f = group.file
+            if "cortex_label" not in f:
+                f.create_dataset("cortex_label", data=np.where(cortex_mask)[0].astype(np.int32))
+        else:
+            values = np.zeros(NVERT, dtype=self.dtype)
+            values[cortex_mask] = cortex_values
+        compression_opts = self.compression_level if self.compression == "gzip" else None
+        if feature in group:
+            dset = group[feature]
+            if (
+                dset.shape == values.shape
+                and dset.dtype == values.dtype
+                and dset.compression == self.compression
+                and dset.compression_opts == compression_opts
+            ):
+                dset[:] = values
+                return
+            # stored with a different policy
+            del group[feature]
+        group.create_dataset(feature, data=values, compression=self.compression, compression_opts=compression_opts)
+
+
+def read_hdf5_feature(dset, cortex_mask, out):
+    """
+    Read feature dataset, stored for all vertices or for cortex vertices only, into out.
+
+    Args:
+        dset: hdf5 dataset
+        cortex_mask: boolean mask of cortex vertices
+        out: float32 array of length NVERT or of length of cortex. Vertices that are not stored are set to 0.
+    """
+    if dset.shape[0] == len(out):
+        dset.read_direct(out)
+    elif dset.shape[0] == NVERT:
+        out[:] = dset[:][cortex_mask]
+    else:
+        assert dset.shape[0] == cortex_mask.sum(), f"{dset.name} has unexpected shape {dset.shape}"
+        out[:] = 0
+        out[cortex_mask] = dset[:]
+    return out
+
+
 class MeldCohort:
     """Class to define cohort-level parameters such as subject ids, mesh"""
-    def __init__(self, hdf5_file_root=DEFAULT_HDF5_FILE_ROOT, dataset=None, data_dir=BASE_PATH, meld_dir=MELD_PARAMS_PATH):
+    def __init__(self, hdf5_file_root=DEFAULT_HDF5_FILE_ROOT, dataset=None, data_dir=BASE_PATH, meld_dir=MELD_PARAMS_PATH, hdf5_pool=None, storage_policy=None):
         self.data_dir = data_dir
         self.meld_dir = meld_dir
         self.hdf5_file_root = hdf5_file_root
         self.dataset = dataset
+        # hdf5_pool: open hdf5 file handles. Shared by all cohorts unless a separate HDF5FilePool is given
+        self.hdf5_pool = HDF5_FILE_POOL if hdf5_pool is None else hdf5_pool
+        # storage_policy: HDF5StoragePolicy used to write features. Default is gzip-9 compressed float32 of all vertices
+        self.storage_policy = HDF5StoragePolicy() if storage_policy is None else storage_policy
         self.log = logging.getLogger(__name__)
 
         # class properties (readonly attributes):
@@ -54,6 +303,17 @@ class MeldCohort:
         self._lobes = None
         # neighbours: list of neighbours for each vertex
         self._neighbours = None
+        # demographics: DemographicsIndex for each demographics csv file, keyed by csv path
+        self._demographics = {}
+        # subject_manifest: SubjectManifest of subjects in hdf5 files
+        self._subject_manifest = None
+
+    @property
+    def subject_manifest(self):
+        """SubjectManifest listing site, scanner, group, lesion and features of all subjects in the hdf5 files"""
+        if self._subject_manifest is None:
+            self._subject_manifest = SubjectManifest(self)
+        return self._subject_manifest
 
     @property
     def full_feature_list(self):
@@ -62,10 +322,7 @@ class MeldCohort:
             self._full_feature_list = []
             subject_ids = self.get_subject_ids()
             # get union of all features from subjects in this cohort
-            features = set()
-            for subj in subject_ids:
-                features = features.union(MeldSubject(subj, self).get_feature_list().copy())
-            self._full_feature_list = sorted(list(features))
+            self._full_feature_list = self.subject_manifest.get_feature_list(subject_ids)
             self.log.info(f"full_feature_list: {self._full_feature_list}")
         return self._full_feature_list
 
@@ -148,6 +405,21 @@ class MeldCohort:
             self._coords = surf["coords"] #rounded_norm_coords
         return self._coords
 
+    def get_demographics_index(self, csv_file=DEMOGRAPHIC_FEATURES_FILE):
+        """
+        Return in-memory DemographicsIndex for csv_file, shared by all subjects of this cohort.
+        The csv file is only parsed again if it changed on disk.
+
+        Args:
+            csv_file: demographics csv file, relative to MELD_DATA_PATH (or absolute path).
+        """
+        csv_path = os.path.join(MELD_DATA_PATH, csv_file)
+        index = self._demographics.get(csv_path, None)
+        if index is None or index.is_stale():
+            index = DemographicsIndex(csv_path)
+            self._demographics[csv_path] = index
+        return index
+
     def read_subject_ids_from_dataset(self):
         """Read subject ids from the dataset csv file.
         Returns subject_ids, trainval_ids, test_ids"""
@@ -166,6 +438,16 @@ class MeldCohort:
                 sites.append(f.split("_")[-1])
         return sites
 
+    def _site_file_path(self, site_code, group, hdf5_file_root=None):
+        """path of hdf5 file (or FeatureStore) of site_code and group"""
+        if hdf5_file_root is None:
+            hdf5_file_root = self.hdf5_file_root
+        return os.path.join(self.data_dir, f"MELD_{site_code}", hdf5_file_root.format(site_code=site_code, group=group))
+
+    def get_site_file_stat(self, site_code, group):
+        """(mtime, size) of hdf5 file (or FeatureStore) of site_code and group, or None if it does not exist"""
+        return get_file_stat(self._site_file_path(site_code, group))
+
     @contextmanager
     def _site_hdf5(self, site_code, group, write=False, hdf5_file_root=None):
         """
@@ -176,8 +458,10 @@ class MeldCohort:
             with cohort._site_hdf5('H1', 'patient') as f:
                 # read information from f
                 pass
-            # f is automatically closed outside of the `with` block
+            # f is kept open in cohort.hdf5_pool for subsequent calls
         ```
+        Files opened with write permissions are flushed at the end of the block.
+        Call cohort.close_hdf5_files() to close all open files.
 
         Args:
             site_code: hospital site code, e.g. 'H1'
@@ -190,21 +474,102 @@ class MeldCohort:
         if hdf5_file_root is None:
             hdf5_file_root = self.hdf5_file_root
 
-        p = os.path.join(self.data_dir, f"MELD_{site_code}", hdf5_file_root.format(site_code=site_code, group=group))
-        # open existing file or create new one
-        if os.path.isfile(p) and not write:
-            f = h5py.File(p, "r")
-        elif os.path.isfile(p) and write:
-            f = h5py.File(p, "r+")
-        elif not os.path.isfile(p) and write:
-            f = h5py.File(p, "a")
-        else:
-            f = None
-        try:
+        p = self._site_file_path(site_code, group, hdf5_file_root=hdf5_file_root)
+        with self.hdf5_pool.file(p, write=write) as f:
             yield f
-        finally:
-            if f is not None:
-                f.close()
+
+    def _site_feature_store(self, site_code, group, write=False, hdf5_file_root=None):
+        """
+        FeatureStore for specified site_code and group (patient or control).
+        Used instead of _site_hdf5 if hdf5_file_root ends with ".store".
+
+        Args:
+            site_code: hospital site code, e.g. 'H1'
+            group: 'patient' or 'control'
+            write (optional): flag to create the store if it does not exist.
+
+        Returns: the FeatureStore, or None if it does not exist and write is False.
+        """
+        if hdf5_file_root is None:
+            hdf5_file_root = self.hdf5_file_root
+        p = self._site_file_path(site_code, group, hdf5_file_root=hdf5_file_root)
+        return get_feature_store(p, cortex_label=self.cortex_label if write else None)
+
+    def get_feature_matrix(self, feature, subject_ids, hemi=None, vertices=slice(None)):
+        """
+        Return cortex values of feature for several subjects.
+
+        Only the requested vertices are read: for cohorts stored in FeatureStores,
+        slices are taken from memory-mapped arrays without loading all subjects into memory.
+        Missing features are set to 0.
+
+        Args:
+            feature: feature to be loaded
+            subject_ids: list of subject ids
+            hemi (optional): 'lh' or 'rh'. By default both hemispheres are returned.
+            vertices (optional): slice or index array of cortex vertices to return.
+
+        Returns:
+            values: float32 array of shape (n_subjects, 2, n_vertices), or (n_subjects, n_vertices) if hemi is given.
+        """
+        hemis = HEMIS if hemi is None else (hemi,)
+        h = slice(None) if hemi is None else HEMIS.index(hemi)
+        n_vertices = len(np.arange(len(self.cortex_label))[vertices])
+        values = np.zeros((len(subject_ids), len(hemis), n_vertices), dtype=np.float32)
+        if is_feature_store_root(self.hdf5_file_root):
+            for site_code in self.get_sites():
+                for group in ["patient", "control"]:
+                    store = self._site_feature_store(site_code, group)
+                    if store is None:
+                        continue
+                    rows = [store.row(subject_id) for subject_id in subject_ids]
+                    in_store = np.array([row is not None for row in rows], dtype=bool)
+                    store_values, present = store.feature_matrix(feature)
+                    if store_values is None or not in_store.any():
+                        continue
+                    rows = np.array([row for row in rows if row is not None])
+                    # view of requested vertices, so that only these are read for the requested subjects
+                    subject_values = store_values[:, h, vertices][rows].reshape(-1, len(hemis), n_vertices)
+                    subject_present = present[rows][:, h].reshape(-1, len(hemis), 1)
+                    values[in_store] = np.where(subject_present, subject_values, 0)
+        else:
+            for i, subject_id in enumerate(subject_ids):
+                subject_values, _ = MeldSubject(subject_id, self).load_feature_block([feature], hemis=hemis, cortex_only=True)
+                values[i] = subject_values[:, vertices, 0]
+        return values if hemi is None else values[:, 0]
+
+    def write_cohort_features(self, feature, feature_values, subject_ids, hemis=["lh", "rh"], hdf5_file_root=None):
+        """
+        Write feature of several subjects, keeping one file open for all subjects of a site and group.
+
+        Args:
+            feature: name of the feature
+            feature_values: cortex feature values of each subject, see MeldSubject.write_feature_values
+            subject_ids: list of subject ids
+            hemis: hemispheres that should be written.
+            hdf5_file_root: optional to specify a different root from baseline, if writing to a new file
+        """
+        assert len(feature_values) == len(subject_ids)
+        if hdf5_file_root is None:
+            hdf5_file_root = self.hdf5_file_root
+        # group subjects by file
+        subjects_per_file = {}
+        for i, subject_id in enumerate(subject_ids):
+            subj = MeldSubject(subject_id, cohort=self)
+            subjects_per_file.setdefault((subj.site_code, subj.group), []).append((i, subj))
+        for (site_code, group), subjects in subjects_per_file.items():
+            if is_feature_store_root(hdf5_file_root):
+                for i, subj in subjects:
+                    subj.write_feature_values(feature, feature_values[i], hemis=hemis, hdf5_file_root=hdf5_file_root)
+                continue
+            with self._site_hdf5(site_code, group, write=True, hdf5_file_root=hdf5_file_root) as f:
+                for i, subj in subjects:
+                    assert len(feature_values[i]) == len(self.cortex_label) * len(hemis)
+                    subj._write_hdf5_feature(f, feature, feature_values[i], hemis)
+
+    def close_hdf5_files(self):
+        """flush and close all hdf5 files held open in self.hdf5_pool"""
+        self.hdf5_pool.close()
 
     def get_subject_ids(self, **kwargs):
         """Output list of subject_ids.
@@ -217,6 +582,8 @@ class MeldCohort:
         Optionally filter subjects by group (patient or control).
         If self.dataset is not none, restrict subjects to subjects in dataset csv file.
         subject_features_to_exclude: exclude subjects that dont have this feature
+        Subjects are filtered using self.subject_manifest, which avoids opening the hdf5 files
+        unless they changed since the manifest was last updated.
 
         Args:
             site_codes (list of str): hospital site codes, e.g. ['H1'].
@@ -248,27 +615,6 @@ class MeldCohort:
         subject_features_to_exclude = kwargs.get("subject_features_to_exclude", [""])
         subject_features_to_include = kwargs.get("subject_features_to_include", [""])
 
-        # get subjects for specified groups and sites
-        subject_ids = []
-        for site_code in site_codes:
-            for group in groups:
-                with self._site_hdf5(site_code, group) as f:
-                    if f is None:
-                        continue
-                    cur_scanners = f[site_code].keys()
-                    for scanner in cur_scanners:
-                        subject_ids += list(f[os.path.join(site_code, scanner, group)].keys())
-
-        self.log.info(f"total number of subjects: {len(subject_ids)}")
-
-        # restrict to ids in dataset (if specified)
-        if self.dataset is not None:
-            subjects_in_dataset, _, _ = self.read_subject_ids_from_dataset()
-            subject_ids = list(np.array(subject_ids)[np.in1d(subject_ids, subjects_in_dataset)])
-            self.log.info(
-                f"total number of subjects after restricting to subjects from {self.dataset}: {len(subject_ids)}"
-            )
-
         # get list of features that is used to filter subjects
         # e.g. use this to filter subjects without FLAIR features
         _, required_subject_features = self._filter_features(
@@ -285,24 +631,37 @@ class MeldCohort:
         )
         self.log.debug("selecting subjects that don't have features: {}".format(undesired_subject_features))
 
+        # get subjects for specified groups and sites.
+        # these are read from the subject manifest, which is updated if the hdf5 files changed
+        subjects = self.subject_manifest.get_table(
+            site_codes, groups, features=required_subject_features + undesired_subject_features
+        )
+        subject_ids = subjects["subject_id"]
+        keep = np.ones(len(subject_ids), dtype=bool)
+
+        self.log.info(f"total number of subjects: {len(subject_ids)}")
+
+        # restrict to ids in dataset (if specified)
+        if self.dataset is not None:
+            subjects_in_dataset, _, _ = self.read_subject_ids_from_dataset()
+            keep &= np.in1d(subject_ids, subjects_in_dataset)
+            self.log.info(
+                f"total number of subjects after restricting to subjects from {self.dataset}: {keep.sum()}"
+            )
+
         # filter ids by scanner, features and whether they have lesions.
-        filtered_subject_ids = []
-        for subject_id in subject_ids:
-            subj = MeldSubject(subject_id, self)
-            # check scanner
-            if subj.scanner not in scanners:
-                continue
-            # check required features
-            if not subj.has_features(required_subject_features):
-                continue
-            # check undesired features
-            if subj.has_features(undesired_subject_features) and len(undesired_subject_features) > 0:
-                continue
-            # check lesion mask presence
-            if lesional_only and subj.is_patient and not subj.has_lesion():
-                continue
-            # subject has passed all filters, add to list
-            filtered_subject_ids.append(subject_id)
+        # check scanner
+        keep &= np.in1d(subjects["scanner"], scanners)
+        # check required features
+        n_required = len(required_subject_features)
+        keep &= subjects["features"][:, :n_required].all(axis=1)
+        # check undesired features
+        if len(undesired_subject_features) > 0:
+            keep &= ~subjects["features"][:, n_required:].all(axis=1)
+        # check lesion mask presence
+        if lesional_only:
+            keep &= ~((subjects["group"] == "patient") & (subjects["lesion_hemi"] == ""))
+        filtered_subject_ids = subject_ids[keep].tolist()
 
         self.log.info(
             f"total number after filtering by scanner {scanners}, features, lesional_only {lesional_only}: {len(filtered_subject_ids)}"
@@ -373,6 +732,285 @@ class MeldCohort:
         return hemisphere_data
 
 
+class DemographicsIndex:
+    """
+    In-memory index of a demographics csv file, keyed by subject id.
+
+    Columns keep the dtypes inferred by pandas and are stored as numpy arrays,
+    rows are found with a dictionary lookup on the subject id.
+    Use MeldCohort.get_demographics_index to get an index that is shared by all subjects of a cohort,
+    and reloaded when the csv file changes.
+
+    Args:
+        csv_path (str): path to demographics csv file.
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.file_stat = self._get_file_stat()
+        df = pd.read_csv(csv_path, header=0, encoding="latin")
+        # get index column
+        self.id_col = None
+        for col in df.keys():
+            if "ID" in col:
+                self.id_col = col
+        if self.id_col is not None:
+            df = df.set_index(self.id_col)
+        self.df = df
+        self.columns = list(df.keys())
+        # typed column values and row number of each subject
+        self._values = {col: df[col].to_numpy() for col in self.columns}
+        self._rows = {}
+        for i, subject_id in enumerate(df.index):
+            self._rows.setdefault(subject_id, i)
+        self._matching_columns = {}
+
+    def _get_file_stat(self):
+        stat = os.stat(self.csv_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def is_stale(self):
+        """True if the csv file was modified or removed since it was loaded"""
+        try:
+            return self._get_file_stat() != self.file_stat
+        except OSError:
+            return True
+
+    def matching_columns(self, name):
+        """return all columns whose title contains name"""
+        if name not in self._matching_columns:
+            self._matching_columns[name] = [col for col in self.columns if name in col]
+        return self._matching_columns[name]
+
+    def __contains__(self, subject_id):
+        return subject_id in self._rows
+
+    def get(self, subject_id, column):
+        """return value of column for subject_id"""
+        return self._values[column][self._rows[subject_id]]
+
+
+class SubjectManifest:
+    """
+    Table of the subjects in the hdf5 files of a cohort, stored as a columnar .npz sidecar file in data_dir.
+
+    For each subject, stores site, scanner (as in the hdf5 file), group, lesional hemisphere
+    and the available features per hemisphere, so that subjects can be filtered without opening the hdf5 files.
+    Rows of an hdf5 file are only read again when this file was modified since the manifest was written.
+    Use MeldCohort.subject_manifest to get the manifest of a cohort.
+
+    Args:
+        cohort (MeldCohort): cohort whose hdf5 files are listed in the manifest.
+    """
+
+    version = 1
+    hemis = ("lh", "rh")
+    # datasets that are stored next to features but are not features
+    non_features = (".on_lh.lesion.mgh", ".on_lh.boundary_zone.mgh")
+
+    def __init__(self, cohort):
+        self.cohort = cohort
+        self.log = logging.getLogger(__name__)
+        root = os.path.splitext(cohort.hdf5_file_root.format(site_code="all", group="all"))[0]
+        self.path = os.path.join(cohort.data_dir, f".subject_manifest_{root}.npz")
+        # files: rows of each hdf5 file, keyed by (site_code, group)
+        self.files = {}
+        self._load()
+
+    def _load(self):
+        """read manifest from disk. An unreadable or outdated manifest is ignored and rebuilt."""
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as npz:
+                data = {key: npz[key] for key in npz.files}
+        except (OSError, ValueError) as e:
+            self.log.warning(f"could not read subject manifest {self.path}: {e}")
+            return
+        if int(data["version"]) != self.version:
+            return
+        features = data["features"]
+        for i, (site_code, group) in enumerate(data["file_keys"]):
+            rows = data["file_index"] == i
+            self.files[(site_code, group)] = {
+                "stat": tuple(data["file_stats"][i]),
+                "subject_id": data["subject_id"][rows],
+                "scanner": data["scanner"][rows],
+                "lesion_hemi": data["lesion_hemi"][rows],
+                "features": features,
+                **{f"features_{hemi}": data[f"features_{hemi}"][rows] for hemi in self.hemis},
+            }
+
+    def save(self):
+        """write manifest to self.path. Failing to write (e.g. read-only data_dir) is not an error."""
+        keys = list(self.files.keys())
+        features = sorted(set().union(*[self.files[key]["features"] for key in keys]))
+        data = {
+            "version": np.array(self.version),
+            "file_keys": np.array(keys, dtype=str).reshape(-1, 2),
+            "file_stats": np.array([self.files[key]["stat"] for key in keys], dtype=np.int64).reshape(-1, 2),
+            "features": np.array(features, dtype=str),
+        }
+        for col in ["subject_id", "scanner", "lesion_hemi"]:
+            data[col] = np.concatenate([np.zeros(0, dtype=str)] + [self.files[key][col] for key in keys])
+        data["file_index"] = np.concatenate(
+            [np.zeros(0, dtype=np.int32)]
+            + [np.full(len(self.files[key]["subject_id"]), i, dtype=np.int32) for i, key in enumerate(keys)]
+        )
+        for hemi in self.hemis:
+            data[f"features_{hemi}"] = np.zeros((len(data["subject_id"]), len(features)), dtype=bool)
+            for i, key in enumerate(keys):
+                entry = self.files[key]
+                cols = np.searchsorted(features, entry["features"]).astype(int)
+                data[f"features_{hemi}"][np.ix_(data["file_index"] == i, cols)] = entry[f"features_{hemi}"]
+        # write to temporary file first, so that concurrent readers never see a partial manifest
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.log.warning(f"could not write subject manifest {self.path}: {e}")
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+    def _scan_file(self, site_code, group):
+        """read subject rows of hdf5 file of site_code and group"""
+        if is_feature_store_root(self.cohort.hdf5_file_root):
+            return self._scan_feature_store(site_code, group)
+        subject_ids, scanners, lesion_hemis = [], [], []
+        subject_features = {hemi: [] for hemi in self.hemis}
+        with self.cohort._site_hdf5(site_code, group) as f:
+            if f is None:
+                return None
+            for scanner in f[site_code].keys():
+                if group not in f[site_code][scanner]:
+                    continue
+                for subject_id, subject_group in f[site_code][scanner][group].items():
+                    subject_ids.append(subject_id)
+                    scanners.append(scanner)
+                    lesion_hemi = ""
+                    for hemi in self.hemis:
+                        keys = list(subject_group[hemi].keys()) if hemi in subject_group else []
+                        if lesion_hemi == "" and ".on_lh.lesion.mgh" in keys:
+                            lesion_hemi = hemi
+                        subject_features[hemi].append([key for key in keys if key not in self.non_features])
+                    lesion_hemis.append(lesion_hemi)
+        features = sorted(set().union(*subject_features["lh"], *subject_features["rh"]))
+        return self._make_entry(subject_ids, scanners, lesion_hemis, features, subject_features)
+
+    def _scan_feature_store(self, site_code, group):
+        """read subject rows of FeatureStore of site_code and group"""
+        store = self.cohort._site_feature_store(site_code, group)
+        if store is None:
+            return None
+        features = [feature for feature in store.features if feature not in self.non_features]
+        entry = {
+            "subject_id": store.subject_ids.copy(),
+            "scanner": store.scanners.copy(),
+            "features": np.array(features, dtype=str),
+        }
+        for hemi in self.hemis:
+            entry[f"features_{hemi}"] = np.zeros((store.n_subjects, len(features)), dtype=bool)
+        for i, feature in enumerate(features):
+            _, present = store.feature_matrix(feature)
+            for h, hemi in enumerate(self.hemis):
+                entry[f"features_{hemi}"][:, i] = present[:, h]
+        _, lesion_present = store.feature_matrix(".on_lh.lesion.mgh")
+        entry["lesion_hemi"] = np.where(lesion_present[:, 0], "lh", np.where(lesion_present[:, 1], "rh", ""))
+        return entry
+
+    def _make_entry(self, subject_ids, scanners, lesion_hemis, features, subject_features):
+        entry = {
+            "subject_id": np.array(subject_ids, dtype=str),
+            "scanner": np.array(scanners, dtype=str),
+            "lesion_hemi": np.array(lesion_hemis, dtype=str),
+            "features": np.array(features, dtype=str),
+        }
+        columns = {feature: i for i, feature in enumerate(features)}
+        for hemi in self.hemis:
+            entry[f"features_{hemi}"] = np.zeros((len(subject_ids), len(features)), dtype=bool)
+            for i, keys in enumerate(subject_features[hemi]):
+                entry[f"features_{hemi}"][i, [columns[key] for key in keys]] = True
+        return entry
+
+    def update(self, site_codes, groups=("patient", "control")):
+        """rescan hdf5 files of site_codes and groups that changed since they were added to the manifest"""
+        changed = False
+        for site_code in site_codes:
+            for group in groups:
+                stat = self.cohort.get_site_file_stat(site_code, group)
+                entry = self.files.get((site_code, group), None)
+                if entry is not None and entry["stat"] == stat:
+                    continue
+                changed = True
+                self.files.pop((site_code, group), None)
+                if stat is None:
+                    continue
+                self.log.debug(f"updating subject manifest for {site_code} {group}")
+                entry = self._scan_file(site_code, group)
+                if entry is not None:
+                    entry["stat"] = stat
+                    self.files[(site_code, group)] = entry
+        if changed:
+            self.save()
+
+    def get_table(self, site_codes, groups=("patient", "control"), features=(), hemi="lh"):
+        """
+        Return subjects of site_codes and groups, in the order in which they are stored in the hdf5 files.
+
+        Args:
+            site_codes (list of str): hospital site codes, e.g. ['H1'].
+            groups (list of str): 'patient' and / or 'control'.
+            features (list of str): features for which availability is returned.
+            hemi (str): hemisphere for which feature availability is returned.
+
+        Returns:
+            table: dict with arrays "subject_id", "site", "scanner", "group", "lesion_hemi" (empty string for no lesion)
+                and "features", a boolean array of shape (n_subjects, len(features)).
+        """
+        self.update(site_codes, groups)
+        table = {col: [np.zeros(0, dtype=str)] for col in ["subject_id", "site", "scanner", "group", "lesion_hemi"]}
+        table["features"] = [np.zeros((0, len(features)), dtype=bool)]
+        for site_code in site_codes:
+            for group in groups:
+                entry = self.files.get((site_code, group), None)
+                if entry is None:
+                    continue
+                n_subjects = len(entry["subject_id"])
+                for col in ["subject_id", "scanner", "lesion_hemi"]:
+                    table[col].append(entry[col])
+                table["site"].append(np.full(n_subjects, site_code))
+                table["group"].append(np.full(n_subjects, group))
+                has_features = np.zeros((n_subjects, len(features)), dtype=bool)
+                for i, feature in enumerate(features):
+                    col = np.searchsorted(entry["features"], feature)
+                    if col < len(entry["features"]) and entry["features"][col] == feature:
+                        has_features[:, i] = entry[f"features_{hemi}"][:, col]
+                table["features"].append(has_features)
+        return {col: np.concatenate(values) for col, values in table.items()}
+
+    def get_lesion_hemispheres(self, subject_ids):
+        """return list of lesion hemisphere ('lh', 'rh', or None) of each of subject_ids"""
+        self.update(self.cohort.get_sites(), groups=("patient",))
+        lesion_hemis = {}
+        for (site_code, group), entry in self.files.items():
+            if group != "patient":
+                continue
+            rows = np.in1d(entry["subject_id"], subject_ids)
+            lesion_hemis.update(zip(entry["subject_id"][rows], entry["lesion_hemi"][rows]))
+        return [lesion_hemis.get(subject_id, "") or None for subject_id in subject_ids]
+
+    def get_feature_list(self, subject_ids, hemi="lh"):
+        """return sorted union of features that subject_ids have on hemi"""
+        features = set()
+        for entry in self.files.values():
+            rows = np.in1d(entry["subject_id"], subject_ids)
+            if rows.any():
+                features.update(entry["features"][entry[f"features_{hemi}"][rows].any(axis=0)].tolist())
+        return sorted(features)
+
+
 class MeldSubject:
     """
     individual patient from meld cohort, can read subject data and other info
@@ -414,6 +1052,14 @@ class MeldSubject:
         site_code = self.get_demographic_features('Harmo code')
         return site_code
 
+    def _feature_store_row(self):
+        """FeatureStore and row of this subject, if cohort is stored in FeatureStores"""
+        store = self.cohort._site_feature_store(self.site_code, self.group)
+        row = None if store is None else store.row(self.subject_id)
+        if row is None:
+            raise KeyError(f"{self.subject_id} not found in {self.cohort.hdf5_file_root}")
+        return store, row
+
     def surf_dir_path(self, hemi):
         """return path to features dir (surf_dir)"""
         return os.path.join(self.site_code, self.scanner, self.group, self.subject_id, hemi)
@@ -436,6 +1082,12 @@ class MeldSubject:
         if not self.is_patient:
             return None
 
+        if is_feature_store_root(self.cohort.hdf5_file_root):
+            store, row = self._feature_store_row()
+            for hemi in HEMIS:
+                if store.has_feature(".on_lh.lesion.mgh", row, hemi):
+                    return hemi
+            return None
         with self.cohort._site_hdf5(self.site_code, self.group) as f:
             surf_dir_lh = f.require_group(self.surf_dir_path("lh"))
             if ".on_lh.lesion.mgh" in surf_dir_lh.keys():
@@ -451,13 +1103,17 @@ class MeldSubject:
 
     def get_feature_list(self, hemi="lh"):
         """Outputs a list of the features a participant has for each hemisphere"""
-        with self.cohort._site_hdf5(self.site_code, self.group) as f:
-            keys = list(f[self.surf_dir_path(hemi)].keys())
-            # remove lesion and boundaries from list of features
-            if ".on_lh.lesion.mgh" in keys:
-                keys.remove(".on_lh.lesion.mgh")
-            if ".on_lh.boundary_zone.mgh" in keys:
-                keys.remove(".on_lh.boundary_zone.mgh")
+        if is_feature_store_root(self.cohort.hdf5_file_root):
+            store, row = self._feature_store_row()
+            keys = store.hemi_features(row, hemi)
+        else:
+            with self.cohort._site_hdf5(self.site_code, self.group) as f:
+                keys = list(f[self.surf_dir_path(hemi)].keys())
+        # remove lesion and boundaries from list of features
+        if ".on_lh.lesion.mgh" in keys:
+            keys.remove(".on_lh.lesion.mgh")
+        if ".on_lh.boundary_zone.mgh" in keys:
+            keys.remove(".on_lh.boundary_zone.mgh")
         return keys
 
     def get_demographic_features(
@@ -479,36 +1135,28 @@ class MeldSubject:
         Returns:
             list of features, matching structure of feature_names
         """
-        csv_path = os.path.join(MELD_DATA_PATH, csv_file)
         return_single = False
         if isinstance(feature_names, str):
             return_single = True
             feature_names = [feature_names]
-        df = pd.read_csv(csv_path, header=0, encoding="latin")
-        # get index column
-        id_col = None
-        for col in df.keys():
-            if "ID" in col:
-                id_col = col
+        demographics = self.cohort.get_demographics_index(csv_file)
         # ensure that found an index column
-        if id_col is None:
+        if demographics.id_col is None:
             self.log.warning("No ID column found in file, please check the csv file")
 
             return None
-        df = df.set_index(id_col)
         # find desired demographic features
         features = []
         for desired_name in feature_names:
             matched_name = None
-            for col in df.keys():
-                if desired_name in col:
-                    if matched_name is not None:
-                        # already found another matching col
-                        self.log.warning(
-                            f"Multiple columns matching {desired_name} found ({matched_name}, {col}), please make search more specific"
-                        )
-                        return None
-                    matched_name = col
+            for col in demographics.matching_columns(desired_name):
+                if matched_name is not None:
+                    # already found another matching col
+                    self.log.warning(
+                        f"Multiple columns matching {desired_name} found ({matched_name}, {col}), please make search more specific"
+                    )
+                    return None
+                matched_name = col
             # ensure that found necessary data
             if matched_name is None:
 
@@ -520,12 +1168,13 @@ class MeldSubject:
 
             # read feature
             # if subject does not exists, add None
-            if self.subject_id in df.index:
+            if self.subject_id in demographics:
                 if matched_name == "Freesurfer_nul":
                     feature = "5.3"
                 else:
-                    feature = df.loc[self.subject_id][matched_name]
+                    feature = demographics.get(self.subject_id, matched_name)
                 if normalize:
+                    df = demographics.df
                     if matched_name == "Age of onset":
                         feature = np.log(feature + 1)
                         feature = feature / df[matched_name].max()
@@ -536,7 +1185,7 @@ class MeldSubject:
             elif default == "random":
                 # unseeded rng for generating random numbers
                 rng = np.random.default_rng()
-                feature = np.clip(np.random.normal(0, 0.1) + rng.choice(df[matched_name]), 0, 1)
+                feature = np.clip(np.random.normal(0, 0.1) + rng.choice(demographics.df[matched_name]), 0, 1)
             else:
                 feature = default
             features.append(feature)
@@ -549,11 +1198,19 @@ class MeldSubject:
         Load and return values of specified feature.
         """
         feature_values = np.zeros(NVERT, dtype=np.float32)
+        if is_feature_store_root(self.cohort.hdf5_file_root):
+            store, row = self._feature_store_row()
+            values = store.read(feature, row, hemi)
+            if values is not None:
+                feature_values[store.cortex_label] = values
+            else:
+                self.log.debug(f"missing feature: {feature} set to zero")
+            return feature_values
         # read data from hdf5
         with self.cohort._site_hdf5(self.site_code, self.group) as f:
             surf_dir = f[self.surf_dir_path(hemi)]
             if feature in surf_dir.keys():
-                feature_values[:] = surf_dir[feature][:]
+                read_hdf5_feature(surf_dir[feature], self.cohort.cortex_mask, feature_values)
             else:
                 self.log.debug(f"missing feature: {feature} set to zero")
         return feature_values
@@ -571,20 +1228,69 @@ class MeldSubject:
             feature_data, label
 
         """
-        # load all features
-        feature_values = []
-        for feature in features:
-            if feature in features_to_ignore:
-                # append zeros for features_to_ignore
-                feature_values.append(np.zeros(NVERT, dtype=np.float32))
-            else:
-                # read feature_values
-                feature_values.append(self.load_feature_values(feature, hemi=hemi))
-        feature_values = np.stack(feature_values, axis=-1)
-        # load lesion data
-        lesion_values = np.ceil(self.load_feature_values(".on_lh.lesion.mgh", hemi=hemi)).astype(int)
+        feature_values, lesion_values = self.load_feature_block(
+            features, hemis=(hemi,), features_to_ignore=features_to_ignore
+        )
+        return feature_values[0], lesion_values[0]
+
+    def load_feature_block(self, features, hemis=("lh", "rh"), cortex_only=False, out=None, features_to_ignore=[]):
+        """
+        Load features and lesion mask of several hemispheres, reading all datasets from one open hdf5 file.
+
+        Missing features and features_to_ignore are set to 0.
+
+        Args:
+            features: list of features to be loaded
+            hemis: hemispheres to be loaded, e.g. ('lh', 'rh')
+            cortex_only: if True, only return values of cortex vertices
+            out (optional): preallocated float32 array of shape (len(hemis), n_vertices, len(features))
+                that features are written into.
+            features_to_ignore: list of features that should be replaced with 0 upon loading
 
-        return feature_values, lesion_values
+        Returns:
+            feature_data: float32 array of shape (len(hemis), n_vertices, len(features))
+            label: int array of shape (len(hemis), n_vertices)
+        """
+        cortex_mask = self.cohort.cortex_mask
+        n_vert = int(cortex_mask.sum()) if cortex_only else NVERT
+        shape = (len(hemis), n_vert, len(features))
+        if out is None:
+            out = np.zeros(shape, dtype=np.float32)
+        else:
+            assert out.shape == shape, f"out has shape {out.shape}, expected {shape}"
+        lesion_values = np.zeros((len(hemis), n_vert), dtype=np.float32)
+        if is_feature_store_root(self.cohort.hdf5_file_root):
+            self._load_feature_store_block(features, hemis, cortex_only, out, lesion_values, features_to_ignore)
+            return out, np.ceil(lesion_values).astype(int)
+        # hemisphere sized buffer that datasets are read into
+        buffer = np.empty(n_vert, dtype=np.float32)
+        with self.cohort._site_hdf5(self.site_code, self.group) as f:
+            for h, hemi in enumerate(hemis):
+                surf_dir = f[self.surf_dir_path(hemi)]
+                keys = set(surf_dir.keys())
+                for i, feature in enumerate(features):
+                    if feature in keys and feature not in features_to_ignore:
+                        out[h, :, i] = read_hdf5_feature(surf_dir[feature], cortex_mask, buffer)
+                    else:
+                        out[h, :, i] = 0
+                if ".on_lh.lesion.mgh" in keys:
+                    lesion_values[h] = read_hdf5_feature(surf_dir[".on_lh.lesion.mgh"], cortex_mask, buffer)
+        return out, np.ceil(lesion_values).astype(int)
+
+    def _load_feature_store_block(self, features, hemis, cortex_only, out, lesion_values, features_to_ignore):
+        """fill out and lesion_values from FeatureStore, see load_feature_block"""
+        store, row = self._feature_store_row()
+        # store holds cortex vertices, which are in the same order as the cortex vertices of out
+        vertices = slice(None) if cortex_only else store.cortex_label
+        for h, hemi in enumerate(hemis):
+            for i, feature in enumerate(features):
+                values = None if feature in features_to_ignore else store.read(feature, row, hemi)
+                out[h, :, i] = 0
+                if values is not None:
+                    out[h, vertices, i] = values
+            values = store.read(".on_lh.lesion.mgh", row, hemi)
+            if values is not None:
+                lesion_values[h, vertices] = values
 
     def load_boundary_zone(self, max_distance=40, feat_name=".on_lh.boundary_zone.mgh"):
         """
@@ -634,26 +1340,30 @@ class MeldSubject:
             hdf5_file_root = self.cohort.hdf5_file_root
         assert len(feature_values) == sum(self.cohort.cortex_mask) * len(hemis)
         n_vert_cortex = sum(self.cohort.cortex_mask)
+        if hdf5_file is None and is_feature_store_root(hdf5_file_root):
+            store = self.cohort._site_feature_store(self.site_code, self.group, write=True, hdf5_file_root=hdf5_file_root)
+            row = store.add_subject(self.subject_id, self.scanner)
+            for i, hemi in enumerate(hemis):
+                store.write(feature, row, hemi, feature_values[i * n_vert_cortex : (i + 1) * n_vert_cortex])
+            return
         # open hdf5 file
         if hdf5_file is not None:
-            if not os.path.isfile(hdf5_file):
-                hdf5_file_context = h5py.File(hdf5_file, "a")
-            else:
-                hdf5_file_context = h5py.File(hdf5_file, "r+")
+            hdf5_file_context = self.cohort.hdf5_pool.file(hdf5_file, write=True)
         else:
             hdf5_file_context = self.cohort._site_hdf5(
                 self.site_code, self.group, write=True, hdf5_file_root=hdf5_file_root
             )
         with hdf5_file_context as f:
-
-            for i, hemi in enumerate(hemis):
-                group = f.require_group(self.surf_dir_path(hemi))
-                hemi_data = np.zeros(NVERT)
-                hemi_data[self.cohort.cortex_mask] = feature_values[i * n_vert_cortex : (i + 1) * n_vert_cortex]
-                dset = group.require_dataset(
-                    feature, shape=(NVERT,), dtype="float32", compression="gzip", compression_opts=9
-                )
-                dset[:] = hemi_data
+            self._write_hdf5_feature(f, feature, feature_values, hemis)
+
+    def _write_hdf5_feature(self, f, feature, feature_values, hemis):
+        """write cortex feature_values of hemis to open hdf5 file f, using self.cohort.storage_policy"""
+        n_vert_cortex = len(self.cohort.cortex_label)
+        for i, hemi in enumerate(hemis):
+            group = f.require_group(self.surf_dir_path(hemi))
+            self.cohort.storage_policy.write(
+                group, feature, feature_values[i * n_vert_cortex : (i + 1) * n_vert_cortex], self.cohort.cortex_mask
+            )
 
     def delete(self, f, feat):
         print("delete")
@@ -2,14 +2,29 @@ import torch_geometric
 import torch.nn as nn
 from copy import deepcopy
 
-from meld_graph.icospheres import IcoSpheres
+from meld_graph.icospheres import IcoSpheres, get_icospheres
 import torch
-from meld_graph.spiralconv import SpiralConv
+from meld_graph.spiralconv import SpiralConv, batch_instance_norm
 from torch_geometric.nn import InstanceNorm
 import scipy.sparse as sp
 import numpy as np
 
 
+def deepcopy_model(model):
+    """
+    Deep copy of model that shares icospheres and index tensors of layers (e.g. spirals, pooling indices),
+    which are not parameters or persistent buffers, with model. Only parameters and persistent buffers are copied.
+    """
+    memo = {}
+    for module in model.modules():
+        for value in vars(module).values():
+            if torch.is_tensor(value) or isinstance(value, (np.ndarray, IcoSpheres)):
+                memo[id(value)] = value
+        for name in module._non_persistent_buffers_set:
+            memo[id(module._buffers[name])] = module._buffers[name]
+    return deepcopy(model, memo)
+
+
 class GMMConv(nn.Module):
     """
     GMMConv implementation.
@@ -27,8 +42,9 @@ class GMMConv(nn.Module):
     ):
         super(GMMConv, self).__init__()
         self.layer = torch_geometric.nn.GMMConv(in_channels, out_channels, dim=dim, kernel_size=kernel_size)
-        self.edges = edges
-        self.edge_vectors = edge_vectors
+        # moved to the device of the module, not saved in the state dict
+        self.register_buffer("edges", edges, persistent=False)
+        self.register_buffer("edge_vectors", edge_vectors, persistent=False)
         if norm is not None:
             if norm == "instance":
                 self.norm = InstanceNorm(
@@ -44,9 +60,23 @@ class GMMConv(nn.Module):
             self.norm = None
 
     def forward(self, x, device):
-        x = self.layer(x, self.edges, self.edge_vectors)
+        """
+        Args:
+            x (torch.tensor): (n_nodes, in_channels) or (batch_size, n_nodes, in_channels) tensor.
+        """
+        if x.dim() == 3:
+            # batch of samples is one graph, containing a copy of the icosphere for each sample
+            batch_size, n_nodes, _ = x.shape
+            n_edges = self.edges.shape[1]
+            offsets = torch.arange(batch_size, device=x.device).repeat_interleave(n_edges) * n_nodes
+            edges = self.edges.repeat(1, batch_size) + offsets
+            edge_vectors = self.edge_vectors.repeat(batch_size, 1)
+            x = self.layer(x.reshape(batch_size * n_nodes, -1), edges, edge_vectors)
+            x = x.view(batch_size, n_nodes, -1)
+        else:
+            x = self.layer(x, self.edges, self.edge_vectors)
         if self.norm is not None:
-            x = self.norm(x)
+            x = batch_instance_norm(self.norm, x)
         return x
 
 
@@ -101,9 +131,8 @@ class MoNet(nn.Module):
         else:
             raise NotImplementedErrror("activation_fn: " + activation_fn)
 
-        self.icospheres = IcoSpheres(**icosphere_params)
-        # NOTE to device call necessary here because icoshperes need to be on GPU during conv layer init
-        self.icospheres.to(self.device)
+        # shared icospheres stay on cpu, layers keep index tensors as buffers that move with the model
+        self.icospheres = get_icospheres(**icosphere_params)
 
         # store n_vertices for batch rearrangement
         self.n_vertices = len(self.icospheres.icospheres[7]["coords"])
@@ -136,8 +165,8 @@ class MoNet(nn.Module):
 
     def to(self, device, **kwargs):
         super(MoNet, self).to(device, **kwargs)
-        # self.icospheres.to(device)
         self.device = device
+        return self
 
     def reset_parameters(self):
         for layer in self.conv_layers:
@@ -149,23 +178,21 @@ class MoNet(nn.Module):
         original_shape = batch_x.shape
         batch_x = batch_x.view((batch_x.shape[0] // self.n_vertices, self.n_vertices, self.num_features))
 
-        outputs = {"log_softmax": [], "non_lesion_logits": []}
-        for x in batch_x:
-            for cl in self.conv_layers:
-                x = cl(x, device=self.device)
-                x = self.activation_function(x)
-            # add final linear layer
-            x = self.fc(x)
-            outputs["non_lesion_logits"].append(x[:, 0])
-            x = nn.LogSoftmax(dim=1)(x)
-            outputs["log_softmax"].append(x)
+        # all layers process the whole batch
+        x = batch_x
+        for cl in self.conv_layers:
+            x = cl(x, device=self.device)
+            x = self.activation_function(x)
+        # add final linear layer
+        x = self.fc(x)
+        outputs = {"non_lesion_logits": x[:, :, 0], "log_softmax": nn.LogSoftmax(dim=2)(x)}
 
-        # stack and reshape outputs to (batch * n_vertices, -1)
+        # reshape outputs to (batch * n_vertices, -1)
         for key, output in outputs.items():
             shape = (-1, 2)
             if "non_lesion_logits" in key:
                 shape = (-1, 1)
-            outputs[key] = torch.stack(output).view(shape)
+            outputs[key] = output.reshape(shape)
         return outputs
 
 
@@ -232,9 +259,8 @@ class MoNetUnet(nn.Module):
         else:
             raise NotImplementedErrror("activation_fn: " + activation_fn)
 
-        self.icospheres = IcoSpheres(**icosphere_params)  # pseudo
-        # NOTE to device call necessary here because icoshperes need to be on GPU during conv layer init
-        self.icospheres.to(self.device)
+        # shared icospheres stay on cpu, layers keep index tensors as buffers that move with the model
+        self.icospheres = get_icospheres(**icosphere_params)  # pseudo
 
         # set up conv + pooling layers - encoder
         encoder_conv_layers = []
@@ -347,8 +373,8 @@ class MoNetUnet(nn.Module):
 
     def to(self, device, **kwargs):
         super(MoNetUnet, self).to(device, **kwargs)
-        self.icospheres.to(device)
         self.device = device
+        return self
 
     def forward(self, data):
         batch_x = data
@@ -356,99 +382,84 @@ class MoNetUnet(nn.Module):
         original_shape = batch_x.shape
 
         batch_x = batch_x.view((batch_x.shape[0] // self.n_vertices, self.n_vertices, self.num_features))
+        # all layers and heads process the whole batch, as (batch, n_vertices, features) tensors
+        x = batch_x
         skip_connections = []
-        outputs = {"log_softmax": [], "non_lesion_logits": [], "log_sumexp": []}
-        for level in self.deep_supervision:
-            outputs[f"ds{level}_log_softmax"] = []
-            outputs[f"ds{level}_non_lesion_logits"] = []
-            outputs[f"ds{level}_log_sumexp"] = []
+        outputs = {}
+        level = 7
+        for i, block in enumerate(self.encoder_conv_layers):
+            for cl in block:
+                x = cl(x, device=self.device)
+                x = self.activation_function(x)
+            skip_connections.append(x)
+            # apply pool except on last block
+            if i < len(self.encoder_conv_layers) - 1:
+                level -= 1
+                x = self.pool_layers[i](x)
+
         if self.classification_head:
-            outputs['hemi_log_softmax'] = []
+            # squeeze features of every vertex, then vertices of every sample
+            hemi_classification = self.hemi_classification_head[0](x.reshape(-1, x.shape[2], 1))
+            hemi_classification = self.activation_function(hemi_classification)
+            hemi_classification = self.hemi_classification_head[1](hemi_classification.view(x.shape[0], -1))
+            outputs["hemi_log_softmax"] = nn.LogSoftmax(dim=1)(hemi_classification)
+
         if self.object_detection_head:
-            outputs['object_detection_linear'] = []
-        for x in batch_x:
-            level = 7
-            for i, block in enumerate(self.encoder_conv_layers):
-                for cl in block:
-                    x = cl(x, device=self.device)
-                    x = self.activation_function(x)
-                skip_connections.append(x)
-                # apply pool except on last block
-                if i < len(self.encoder_conv_layers) - 1:
-                    level -= 1
-                    x = self.pool_layers[i](x)
-
-            if self.classification_head:
-                hemi_classification = self.activation_function(self.hemi_classification_head[0](x.unsqueeze(2)))
-                hemi_classification = self.hemi_classification_head[1](hemi_classification.view(-1))
-                hemi_classification = nn.LogSoftmax(dim=0)(hemi_classification)
-                outputs["hemi_log_softmax"].append(hemi_classification)
-
-            if self.object_detection_head:
-                # Object detection head
-                xyzr = self.object_detection_head[0](x.unsqueeze(2))
-                xyzr = self.object_detection_head[1](xyzr.view(-1))
-                xyz = xyzr[:3].contiguous()
-                r = xyzr[ 3:].contiguous()
-                xyz = xyz.view(xyz.size(0), -1)
-                xyz_norm = nn.functional.normalize(xyz, p=2, dim=0)
-                xyzr_norm = torch.cat([xyz_norm, r.view(r.size(0), -1)], dim=0)
-                xyzr_norm = torch.squeeze(xyzr_norm)
-                outputs['object_detection_linear'].append(xyzr_norm)
-
-            for i, block in enumerate(self.decoder_conv_layers):
-                # check if want deep supervision for this level
-                if level in self.deep_supervision:
-                    x_out = self.deep_supervision_fcs[str(level)](x)
-                    if self.distance_head:
-                        x_dist = self.distance_fcs[str(level)](x)
-                        outputs[f"ds{level}_non_lesion_logits"].append(x_dist)
-                    else:
-                        outputs[f"ds{level}_non_lesion_logits"].append(x_out[:, 0])
-                    x_out = nn.LogSoftmax(dim=1)(x_out)
-                    outputs[f"ds{level}_log_softmax"].append(x_out)
-
-                    x_out_logsumexp = torch.logsumexp(torch.exp(x_out[:, 1]), dim=0)
-                    x_out_logsumexp = torch.stack((1 - x_out_logsumexp, x_out_logsumexp))
-                    x_out_logsumexp = nn.LogSoftmax(dim=0)(x_out_logsumexp)
-                    outputs[f"ds{level}_log_sumexp"].append(x_out_logsumexp)
-
-                skip_i = len(self.decoder_conv_layers) - 1 - i
-                level += 1
-                x = self.unpool_layers[i](x, device=self.device)
-                x = torch.cat([x, skip_connections[skip_i]], dim=1)
-                for cl in block:
-                    x = cl(x, device=self.device)
-                    x = self.activation_function(x)
-
-            # add distance head
-            if self.distance_head:
-                x_dist = self.distance_fc(x)
-                outputs["non_lesion_logits"].append(x_dist)
-            else:
-                outputs["non_lesion_logits"].append(x[:, 0])
-            # add final linear layer
-            x = self.fc(x)
-            x = nn.LogSoftmax(dim=1)(x)
-            outputs["log_softmax"].append(x)
-
-            x_logsumexp = torch.logsumexp(torch.exp(x[:, 1]), dim=0)
-            x_logsumexp = torch.stack((1 - x_logsumexp, x_logsumexp))
-            x_logsumexp = nn.LogSoftmax(dim=0)(x_logsumexp)
-            outputs["log_sumexp"].append(x_logsumexp)
-
-        # stack and reshape outputs to (batch * n_vertices, -1)
-        #object detection is (batch * 4,-1)
+            # Object detection head
+            xyzr = self.object_detection_head[0](x.reshape(-1, x.shape[2], 1))
+            xyzr = self.object_detection_head[1](xyzr.view(x.shape[0], -1))
+            xyz_norm = nn.functional.normalize(xyzr[:, :3], p=2, dim=1)
+            outputs["object_detection_linear"] = torch.cat([xyz_norm, xyzr[:, 3:]], dim=1)
+
+        for i, block in enumerate(self.decoder_conv_layers):
+            # check if want deep supervision for this level
+            if level in self.deep_supervision:
+                x_out = self.deep_supervision_fcs[str(level)](x)
+                if self.distance_head:
+                    outputs[f"ds{level}_non_lesion_logits"] = self.distance_fcs[str(level)](x)
+                else:
+                    outputs[f"ds{level}_non_lesion_logits"] = x_out[:, :, 0]
+                x_out = nn.LogSoftmax(dim=2)(x_out)
+                outputs[f"ds{level}_log_softmax"] = x_out
+                outputs[f"ds{level}_log_sumexp"] = self.log_sumexp(x_out)
+
+            skip_i = len(self.decoder_conv_layers) - 1 - i
+            level += 1
+            x = self.unpool_layers[i](x, device=self.device)
+            x = torch.cat([x, skip_connections[skip_i]], dim=2)
+            for cl in block:
+                x = cl(x, device=self.device)
+                x = self.activation_function(x)
+
+        # add distance head
+        if self.distance_head:
+            outputs["non_lesion_logits"] = self.distance_fc(x)
+        else:
+            outputs["non_lesion_logits"] = x[:, :, 0]
+        # add final linear layer
+        x = self.fc(x)
+        x = nn.LogSoftmax(dim=2)(x)
+        outputs["log_softmax"] = x
+        outputs["log_sumexp"] = self.log_sumexp(x)
+
+        # reshape outputs to (batch * n_vertices, -1)
+        # object detection is (batch * 4,-1)
         # in case of hemi classification will be (batch, -1)
         for key, output in outputs.items():
             shape = (-1, 2)
             if "non_lesion_logits" in key:
                 shape = (-1, 1)
             if "object_detection_linear" in key:
-                shape = (-1,4)
-            outputs[key] = torch.stack(output).view(shape)
+                shape = (-1, 4)
+            outputs[key] = output.reshape(shape)
         return outputs
 
+    def log_sumexp(self, log_softmax):
+        """hemisphere level log softmax scores from (batch, n_vertices, 2) log softmax scores of vertices"""
+        x_logsumexp = torch.logsumexp(torch.exp(log_softmax[:, :, 1]), dim=1)
+        x_logsumexp = torch.stack((1 - x_logsumexp, x_logsumexp), dim=1)
+        return nn.LogSoftmax(dim=1)(x_logsumexp)
+
 
 class HexPool(nn.Module):
     """
@@ -457,20 +468,23 @@ class HexPool(nn.Module):
 
     def __init__(self, neigh_indices):
         super(HexPool, self).__init__()
-        self.neigh_indices = neigh_indices
+        self.register_buffer("neigh_indices", neigh_indices, persistent=False)
 
     def forward(self, x, center_pool=False):
         """
         Forward pass
 
         Args:
+            x (torch.tensor): (n_vertices,), (n_vertices, features) or (batch, n_vertices, features) tensor.
             center_pool (bool): default is max pool, set center_pool to true to do center pool
         """
+        vertex_dim = 1 if x.dim() == 3 else 0
         if center_pool:
-            x = x[: len(self.neigh_indices)]
+            x = x.narrow(vertex_dim, 0, len(self.neigh_indices))
         else:
-            x = x[self.neigh_indices]
-            x = torch.max(x, dim=1)[0]
+            x = torch.index_select(x, vertex_dim, self.neigh_indices.reshape(-1))
+            x = x.view(*x.shape[:vertex_dim], len(self.neigh_indices), -1, *x.shape[vertex_dim + 1 :])
+            x = torch.max(x, dim=vertex_dim + 1)[0]
         return x
 
 
@@ -481,15 +495,18 @@ class HexUnpool(nn.Module):
 
     def __init__(self, upsample_indices, target_size):
         super(HexUnpool, self).__init__()
-        self.upsample_indices = upsample_indices
+        self.register_buffer("upsample_indices", upsample_indices, persistent=False)
         self.target_size = target_size
 
     def forward(self, x, device):
-        limit = int(x.shape[0])
-        new_x = torch.zeros(self.target_size, x.shape[1]).to(device)
-        new_x[:limit] = x
-        new_x[limit:] = torch.mean(x[self.upsample_indices], dim=1)
-        return new_x
+        """
+        Args:
+            x (torch.tensor): (n_vertices, features) or (batch, n_vertices, features) tensor.
+        """
+        # new vertices are appended after the vertices of x
+        upsampled = torch.index_select(x, x.dim() - 2, self.upsample_indices.reshape(-1))
+        upsampled = torch.mean(upsampled.view(*x.shape[:-2], -1, 2, x.shape[-1]), dim=-2)
+        return torch.cat([x, upsampled], dim=-2)
 
 
 class HexSmoothSparse(nn.Module):
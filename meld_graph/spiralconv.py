@@ -1,18 +1,51 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import logging
 from torch_geometric.nn import InstanceNorm
 
 
+def batch_instance_norm(norm, x):
+    """
+    Apply torch_geometric InstanceNorm norm to x, normalising every sample of a batch separately.
+
+    Args:
+        norm (InstanceNorm): instance norm layer.
+        x (torch.tensor): (n_nodes, channels) or (batch_size, n_nodes, channels) tensor.
+    """
+    if x.dim() == 2:
+        return norm(x)
+    x = F.instance_norm(
+        x.transpose(1, 2),
+        norm.running_mean,
+        norm.running_var,
+        norm.weight,
+        norm.bias,
+        norm.training or not norm.track_running_stats,
+        norm.momentum,
+        norm.eps,
+    )
+    return x.transpose(1, 2)
+
+
 class SpiralConv(nn.Module):
     """
     Spiral convolution, adapted from https://github.com/sw-gong/spiralnet_plus/blob/master/conv/spiralconv.py
+
+    Spiral indices are a non-persistent buffer, that is moved to the device of the module once,
+    and the state dict only contains the weights of the linear layer.
+    Without gradients (e.g. prediction), spiral neighbours are gathered and multiplied with the weights in chunks
+    of chunk_size vertices, bounding the size of the gathered (n_nodes, seq_length * in_channels) matrix.
+    For training, the whole matrix is gathered, as it is kept for the backward pass anyways.
     """
 
+    # number of vertices gathered at once without gradients
+    chunk_size = 16384
+
     def __init__(self, in_channels, out_channels, indices, norm=None):
         super(SpiralConv, self).__init__()
         self.log = logging.getLogger(__name__)
-        self.indices = indices
+        self.register_buffer("indices", indices.contiguous(), persistent=False)
         self.in_channels = in_channels
         self.out_channels = out_channels
         self.seq_length = indices.size(1)
@@ -39,17 +72,30 @@ class SpiralConv(nn.Module):
         torch.nn.init.constant_(self.layer.bias, 0)
 
     def forward(self, x, device):
-        n_nodes, _ = self.indices.size()
-        if x.dim() == 2:
-            x = torch.index_select(x, 0, self.indices.contiguous().to(device).view(-1))
-            x = x.view(n_nodes, -1)
-        else:
+        """
+        Args:
+            x (torch.tensor): (n_nodes, in_channels) or (batch_size, n_nodes, in_channels) tensor.
+            device: unused, indices are on the device of the module.
+        """
+        if x.dim() not in [2, 3]:
             raise RuntimeError(
-                'x.dim() is expected to be 2, but received {}'.format(
+                'x.dim() is expected to be 2 or 3, but received {}'.format(
                     x.dim()))
-        x = self.layer(x)
+        vertex_dim = x.dim() - 2
+        n_nodes = self.indices.size(0)
+        flat_indices = self.indices.view(-1)
+        if torch.is_grad_enabled() and (x.requires_grad or self.layer.weight.requires_grad):
+            x = torch.index_select(x, vertex_dim, flat_indices)
+            x = self.layer(x.view(*x.shape[:vertex_dim], n_nodes, -1))
+        else:
+            out = []
+            for start in range(0, n_nodes, self.chunk_size):
+                stop = min(start + self.chunk_size, n_nodes)
+                chunk = torch.index_select(x, vertex_dim, flat_indices[start * self.seq_length : stop * self.seq_length])
+                out.append(self.layer(chunk.view(*x.shape[:vertex_dim], stop - start, -1)))
+            x = torch.cat(out, dim=vertex_dim)
         if self.norm is not None:
-            x = self.norm(x)
+            x = batch_instance_norm(self.norm, x)
         return x
 
     def __repr__(self):
@@ -2,13 +2,19 @@
 # tested functions:
 #   load_combined_hemisphere_data
 #   Dataset - behaviour with different flags, active selection
+#   Dataset - preprocessed data cache
+#   Dataset - loading subjects with worker processes
+#   SharedDataList
+#   Dataset - pooled labels and distances of output levels
+#   Dataset - streaming mode
+#   BatchAugment
 # NOTE:
 #   these tests require a test dataset, that is created with get_test_data()
 #   executing this function may take a while the first time (while the test data is being created)
 # MISSING TESTS:
 #   Dataset - test asserting correct handling of boundary zones in Dataset
 
-from meld_graph.dataset import GraphDataset
+from meld_graph.dataset import GraphDataset, SharedDataList
 from meld_graph.download_data import get_test_data
 from meld_graph.meld_cohort import MeldSubject, MeldCohort
 import pytest
@@ -16,6 +22,8 @@ from meld_graph.paths import NVERT, DEFAULT_HDF5_FILE_ROOT
 # from meld_graph.network_tools import build_model
 from meld_graph.test.utils import create_test_demos
 import numpy as np
+import torch
+import torch_geometric
 from copy import deepcopy
 
 
@@ -90,4 +98,181 @@ def test_dataset_flags(data_parameters):
         i=i+1
         assert (data.x.shape[1]==len(features_list))
         assert (data.x.shape[0]==NVERT)
-    assert i==len(subject_ids*2)
\ No newline at end of file
+    assert i==len(subject_ids*2)
+
+def test_dataset_cache(data_parameters, tmp_path):
+    """test that dataset built from preprocessed data cache equals dataset built from hdf5"""
+    create_test_demos()
+    c = MeldCohort(hdf5_file_root=data_parameters["hdf5_file_root"])
+    subject_ids = c.get_subject_ids(**data_parameters)[0:3]
+    features_list = c.get_features(features_to_exclude=data_parameters["features_to_exclude"])
+    cur_data_params = dict(data_parameters, features=features_list, cache_dir=str(tmp_path))
+    dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="val")
+    assert dataset.cache.stats()["writes"] == len(subject_ids)
+    cached_dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="val")
+    assert cached_dataset.cache.stats()["hits"] == len(subject_ids)
+    for d, cached_d in zip(dataset.data_list, cached_dataset.data_list):
+        assert d.keys() == cached_d.keys()
+        for key in d.keys():
+            assert (d[key] == cached_d[key]).all()
+    # changing parameters results in new entries
+    cur_data_params["smooth_labels"] = not cur_data_params["smooth_labels"]
+    dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="val")
+    assert dataset.cache.stats()["misses"] == len(subject_ids)
+    # clearing the cache removes all entries
+    assert dataset.cache.clear() == 2 * len(subject_ids)
+    assert dataset.cache.stats()["entries"] == 0
+
+
+def test_dataset_num_workers(data_parameters):
+    """test that dataset loaded with worker processes is identical to dataset loaded in main process"""
+    create_test_demos()
+    c = MeldCohort(hdf5_file_root=data_parameters["hdf5_file_root"])
+    subject_ids = c.get_subject_ids(**data_parameters)[0:4]
+    features_list = c.get_features(features_to_exclude=data_parameters["features_to_exclude"])
+    cur_data_params = dict(data_parameters, features=features_list)
+    dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="val", num_workers=0)
+    parallel_dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="val", num_workers=2)
+    assert len(dataset.data_list) == len(parallel_dataset.data_list)
+    for d, parallel_d in zip(dataset.data_list, parallel_dataset.data_list):
+        assert d.keys() == parallel_d.keys()
+        for key in d.keys():
+            assert np.array_equal(d[key], parallel_d[key])
+
+
+def test_shared_data_list():
+    """test that SharedDataList returns read-only views of the packed data dicts, and survives pickling"""
+    import pickle
+
+    data_list = [
+        {
+            "features": np.random.normal(size=(100, 3)).astype(np.float32),
+            "labels": np.random.randint(0, 2, 100),
+            "distances": np.random.uniform(0, 300, 100).astype(np.float32),
+        }
+        for _ in range(4)
+    ]
+    expected = deepcopy(data_list)
+    shared = SharedDataList(data_list)
+    assert len(shared) == 4
+    assert shared.arrays["features"].shape == (4, 100, 3)
+    for d, expected_d in zip(shared, expected):
+        assert d.keys() == expected_d.keys()
+        for key in d.keys():
+            assert np.array_equal(d[key], expected_d[key])
+            assert d[key].dtype == expected_d[key].dtype
+    assert np.array_equal(shared[-1]["labels"], expected[-1]["labels"])
+    with pytest.raises(ValueError):
+        shared[0]["features"][0, 0] = 1
+    with pytest.raises(IndexError):
+        shared[4]
+    unpickled = pickle.loads(pickle.dumps(shared))
+    assert np.array_equal(unpickled.arrays["features"], shared.arrays["features"])
+
+
+def test_shared_data_list_compact():
+    """test that compact SharedDataList stores fields in compact dtypes and restores values within quantisation error"""
+    data_list = [
+        {
+            "features": np.random.normal(size=(100, 3)),
+            "labels": np.random.randint(0, 2, 100),
+            "smooth_labels": np.random.uniform(0, 1, 100).astype(np.float32),
+            "distances": np.random.uniform(-50, 350, 100).astype(np.float32),
+        }
+        for _ in range(4)
+    ]
+    expected = deepcopy(data_list)
+    shared = SharedDataList(data_list, compact=True)
+    assert {field: array.dtype for field, array in shared.arrays.items()} == {
+        "features": np.float16,
+        "labels": np.uint8,
+        "smooth_labels": np.uint8,
+        "distances": np.uint16,
+    }
+    for d, expected_d in zip(shared, expected):
+        for key in d.keys():
+            assert d[key].dtype == expected_d[key].dtype
+        assert np.allclose(d["features"], expected_d["features"], rtol=1e-3, atol=1e-3)
+        assert np.array_equal(d["labels"], expected_d["labels"])
+        assert np.abs(d["smooth_labels"] - expected_d["smooth_labels"]).max() <= 0.5 / 255 + 1e-6
+        assert np.abs(d["distances"] - np.clip(expected_d["distances"], -300, 300)).max() <= 0.005 + 1e-4
+    # values that do not fit compact dtype are stored as they are
+    shared = SharedDataList([{"labels": np.array([0, 1000])}], compact=True)
+    assert shared.arrays["labels"].dtype == np.int64
+
+
+def test_dataset_output_levels(data_parameters):
+    """test that cached label pyramids and sliced distances equal pooling from level 7"""
+    create_test_demos()
+    c = MeldCohort(hdf5_file_root=data_parameters["hdf5_file_root"])
+    subject_ids = c.get_subject_ids(**data_parameters)[0:3]
+    features_list = c.get_features(features_to_exclude=data_parameters["features_to_exclude"])
+    cur_data_params = dict(data_parameters, features=features_list)
+    output_levels = [4, 6]
+    dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="val", output_levels=output_levels)
+    assert "labels_level4" in dataset.data_list[0]
+    for i in range(len(dataset)):
+        data = dataset.get(i)
+        labels_pooled = {7: data.y}
+        dists_pooled = {7: data.distance_map}
+        for level in range(min(output_levels), 7)[::-1]:
+            labels_pooled[level] = dataset.pool_layers[level](labels_pooled[level + 1])
+            dists_pooled[level] = dataset.pool_layers[level](dists_pooled[level + 1], center_pool=True)
+        for level in output_levels:
+            assert torch.equal(getattr(data, f"output_level{level}"), labels_pooled[level])
+            assert torch.equal(getattr(data, f"output_level{level}_distance_map"), dists_pooled[level])
+
+
+def test_dataset_streaming(data_parameters):
+    """test that streamed dataset returns the same data and lesional_idxs as preloaded dataset"""
+    create_test_demos()
+    c = MeldCohort(hdf5_file_root=data_parameters["hdf5_file_root"])
+    subject_ids = c.get_subject_ids(**data_parameters)[0:4]
+    features_list = c.get_features(features_to_exclude=data_parameters["features_to_exclude"])
+    cur_data_params = dict(data_parameters, features=features_list)
+    dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="val", output_levels=[6])
+    streamed_dataset = GraphDataset(
+        subject_ids,
+        cohort=c,
+        params=dict(cur_data_params, streaming=True, streaming_cache_size=1),
+        mode="val",
+        output_levels=[6],
+    )
+    assert len(dataset) == len(streamed_dataset)
+    assert np.array_equal(dataset.lesional_idxs, streamed_dataset.lesional_idxs)
+    for i in np.random.permutation(len(dataset)):
+        data = dataset.get(i)
+        streamed_data = streamed_dataset.get(i)
+        for key in ["x", "y", "distance_map", "output_level6", "output_level6_distance_map"]:
+            assert torch.equal(data[key], streamed_data[key])
+    assert len(streamed_dataset.data_list._items) == 1
+
+
+def test_batch_augment(data_parameters):
+    """test that batched spinning permutes all fields of each sample, and that output levels are recomputed"""
+    create_test_demos()
+    c = MeldCohort(hdf5_file_root=data_parameters["hdf5_file_root"])
+    subject_ids = c.get_subject_ids(**data_parameters)[0:2]
+    features_list = c.get_features(features_to_exclude=data_parameters["features_to_exclude"])
+    spinning = dict(data_parameters["augment_data"]["spinning"], p=1)
+    cur_data_params = dict(
+        data_parameters, features=features_list, augment_data={"spinning": spinning}, batch_augmentation=True
+    )
+    dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="train", output_levels=[6])
+    val_dataset = GraphDataset(subject_ids, cohort=c, params=cur_data_params, mode="val", output_levels=[6])
+    assert val_dataset.batch_augment is None
+    batch_size = len(dataset)
+    data = next(iter(torch_geometric.loader.DataLoader(dataset, batch_size=batch_size)))
+    # samples are not augmented by the dataset
+    val_data = next(iter(torch_geometric.loader.DataLoader(val_dataset, batch_size=batch_size)))
+    assert torch.equal(data.x, val_data.x)
+    data = dataset.batch_augment.apply(data)
+    spin_indices = dataset.batch_augment.transforms["spinning"].indices
+    x = data.x.view(batch_size, -1, data.x.shape[1])
+    y = data.y.view(batch_size, -1)
+    for i in range(batch_size):
+        val_sample = val_data.get_example(i)
+        transforms = [indices for indices in spin_indices if torch.equal(x[i], val_sample.x[indices])]
+        assert len(transforms) == 1
+        assert torch.equal(y[i], val_sample.y[transforms[0]])
+        assert torch.equal(data.output_level6.view(batch_size, -1)[i], dataset.pool_labels(y[i])[6])
@@ -0,0 +1,82 @@
+#### tests for FeatureStore ####
+# tested functions:
+#   import_hdf5 / export_hdf5
+#   MeldCohort and MeldSubject reading from and writing to FeatureStores
+#   MeldCohort.get_feature_matrix
+# NOTE:
+#   these tests require a test dataset, that is created with get_test_data()
+
+import os
+import tempfile
+import h5py
+import numpy as np
+from meld_graph.meld_cohort import MeldCohort, MeldSubject
+from meld_graph.feature_store import get_feature_store
+from meld_graph.paths import DEFAULT_HDF5_FILE_ROOT, BASE_PATH
+from meld_graph.test.utils import create_test_demos
+
+create_test_demos()
+
+STORE_FILE_ROOT = "{site_code}_{group}_featurematrix_combat.store"
+
+
+def create_test_store(data_dir):
+    """import TEST site hdf5 files into FeatureStores in data_dir"""
+    c = MeldCohort(hdf5_file_root=DEFAULT_HDF5_FILE_ROOT)
+    for group in ["patient", "control"]:
+        store = get_feature_store(
+            os.path.join(data_dir, "MELD_TEST", STORE_FILE_ROOT.format(site_code="TEST", group=group)),
+            cortex_label=c.cortex_label,
+        )
+        store.import_hdf5(
+            os.path.join(BASE_PATH, "MELD_TEST", DEFAULT_HDF5_FILE_ROOT.format(site_code="TEST", group=group))
+        )
+    return c, MeldCohort(hdf5_file_root=STORE_FILE_ROOT, data_dir=data_dir)
+
+
+def test_feature_store_cohort():
+    """test that cohort stored in FeatureStores returns the same subjects and features as hdf5 cohort"""
+    with tempfile.TemporaryDirectory() as data_dir:
+        c, c_store = create_test_store(data_dir)
+        subject_ids = c.get_subject_ids(lesional_only=False)
+        assert sorted(subject_ids) == sorted(c_store.get_subject_ids(lesional_only=False))
+        assert c.full_feature_list == c_store.full_feature_list
+        features = c.full_feature_list
+        for subj_id in subject_ids:
+            subj = MeldSubject(subj_id, cohort=c)
+            subj_store = MeldSubject(subj_id, cohort=c_store)
+            assert subj.get_lesion_hemisphere() == subj_store.get_lesion_hemisphere()
+            assert sorted(subj.get_feature_list("rh")) == sorted(subj_store.get_feature_list("rh"))
+            values, lesion = subj.load_feature_block(features, cortex_only=True)
+            values_store, lesion_store = subj_store.load_feature_block(features, cortex_only=True)
+            assert (values == values_store).all()
+            assert (lesion == lesion_store).all()
+
+        # vertex ranges of several subjects
+        matrix = c_store.get_feature_matrix(features[0], subject_ids, vertices=slice(100, 200))
+        assert matrix.shape == (len(subject_ids), 2, 100)
+        assert (matrix == c.get_feature_matrix(features[0], subject_ids, vertices=slice(100, 200))).all()
+
+        # write new feature, which is picked up by new cohorts
+        subj_store = MeldSubject(subject_ids[0], cohort=c_store)
+        n_cortex = len(c.cortex_label)
+        subj_store.write_feature_values(".on_lh.test_feature.mgh", np.arange(2 * n_cortex, dtype=np.float32))
+        values, _ = subj_store.load_feature_block([".on_lh.test_feature.mgh"], cortex_only=True)
+        assert (values.ravel() == np.arange(2 * n_cortex)).all()
+        c_store = MeldCohort(hdf5_file_root=STORE_FILE_ROOT, data_dir=data_dir)
+        assert ".on_lh.test_feature.mgh" in c_store.full_feature_list
+
+
+def test_feature_store_export():
+    """test that exporting FeatureStore to hdf5 restores cortex values"""
+    with tempfile.TemporaryDirectory() as data_dir:
+        c, c_store = create_test_store(data_dir)
+        hdf5_file = os.path.join(data_dir, "export.hdf5")
+        store = c_store._site_feature_store("TEST", "patient")
+        store.export_hdf5(hdf5_file, "TEST", "patient")
+        with h5py.File(hdf5_file, "r") as f:
+            for subj_id in c.get_subject_ids(group="patient"):
+                subj = MeldSubject(subj_id, cohort=c)
+                for feature in subj.get_feature_list():
+                    values = f[os.path.join(subj.surf_dir_path("lh"), feature)][:]
+                    assert (values[c.cortex_mask] == subj.load_feature_values(feature)[c.cortex_mask]).all()
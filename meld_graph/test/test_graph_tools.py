@@ -0,0 +1,166 @@
+#### tests for graph_tools.py (GraphTools class) ####
+# tested functions:
+#   GraphTools.upsample_operator
+#   GraphTools.upsample
+#   GraphTools.batch_geodesics - geodesic backends
+#   GraphTools.smooth_labels
+#   get_graph_tools, get_icospheres - shared instances
+#   IcoSpheres - icosphere cache and lazy loading of levels
+#   IcoSpheres - creating the icosphere cache on first use, and again if its source files changed
+#   IcoSpheres.get_neighbours_from_tris, calculate_exact_edge_attrs, calculate_spirals
+# NOTE:
+#   these tests require the icospheres of the test data
+
+import os
+import shutil
+import numpy as np
+import torch
+import pytest
+from meld_graph.icospheres import IcoSpheres, IcoSphereCache, get_icospheres, ICOSPHERE_CACHE_FILE
+from meld_graph.graph_tools import GraphTools, get_graph_tools
+from meld_graph.data_preprocessing import Preprocess
+
+
+def test_upsample_operator():
+    """test that cached upsampling operator equals repeated unpooling"""
+    icospheres = IcoSpheres()
+    gt = GraphTools(icospheres)
+    data = np.random.normal(size=(len(icospheres.icospheres[2]["coords"]), 2))
+    upsampled = torch.from_numpy(data)
+    for level in range(3, 8):
+        upsampled = gt.unpool(level=level)(upsampled, device=None)
+    assert np.allclose(gt.upsample(data, source_level=2, target_level=7), upsampled.numpy(), atol=1e-5)
+    assert gt.upsample_operator(2, 7) is gt.upsample_operator(2, 7)
+    # vertices of the source level keep their values
+    assert np.allclose(gt.upsample(data, source_level=2, target_level=4)[: len(data)], data)
+
+
+def test_batch_geodesics():
+    """test that batched distances equal single lesion distances, and that backends agree with pp3d"""
+    icospheres = IcoSpheres()
+    gt = GraphTools(icospheres, distance_mask_medial_wall=True)
+    lesions, _ = Preprocess(cohort=gt.cohort).create_lesion_masks_sphere(0.5, icospheres.icospheres[7]["coords"], 3)
+    lesions = np.vstack([lesions * gt.cohort.cortex_mask, np.zeros(lesions.shape[1])])
+    distances = gt.batch_geodesics(lesions)
+    for lesion, lesion_distances in zip(lesions[:-1], distances):
+        assert np.allclose(gt.fast_geodesics(lesion), lesion_distances)
+        assert (lesion_distances[lesion == 1] <= 0).all()
+    assert (distances[-1] == 300).all()
+    for backend, tolerance in [("heat", 0.5), ("dijkstra", 10)]:
+        backend_gt = GraphTools(icospheres, distance_mask_medial_wall=True, geodesic_backend=backend)
+        backend_distances = backend_gt.batch_geodesics(lesions)
+        # compare distances around lesions
+        near = np.abs(distances) < 100
+        assert np.abs(backend_distances - distances)[near].mean() < tolerance
+
+
+def test_smooth_labels():
+    """test that batched smoothing with the cached operators equals iterated smoothing"""
+    icospheres = IcoSpheres()
+    gt = GraphTools(icospheres)
+    labels = (np.random.rand(3, len(icospheres.icospheres[7]["coords"])) > 0.99).astype(int)
+    smoothed = gt.smooth_labels(labels, iteration=10)
+    assert smoothed.dtype == np.float32
+    for sample_labels, sample_smoothed in zip(labels, smoothed):
+        assert np.allclose(gt.smoothing(sample_labels, iteration=10), sample_smoothed, atol=1e-6)
+    assert np.allclose(gt.smooth_labels(labels[0]), smoothed[0])
+    assert np.allclose(gt.smooth_labels(torch.from_numpy(labels)).numpy(), smoothed, atol=1e-6)
+    assert gt.smoothing_operator_torch() is gt.smoothing_operator_torch()
+
+
+def test_shared_registry():
+    """test that icospheres and graph tools are shared, and that shared icosphere arrays are read-only"""
+    icospheres = get_icospheres()
+    assert get_icospheres(icosphere_path="data/icospheres") is icospheres
+    assert get_icospheres(distance_type="exact") is not icospheres
+    with pytest.raises(ValueError):
+        icospheres.icospheres[7]["coords"][0] = 0
+    gt = get_graph_tools(icospheres, distance_mask_medial_wall=True)
+    assert get_graph_tools(icospheres, distance_mask_medial_wall=True) is gt
+    assert get_graph_tools(icospheres, distance_mask_medial_wall=False) is not gt
+
+
+@pytest.mark.parametrize("distance_type,conv_type", [("pseudo", "GMMConv"), ("exact", "SpiralConv")])
+def test_icosphere_cache(tmp_path, distance_type, conv_type):
+    """test that levels loaded lazily from the icosphere cache equal levels loaded from the icosphere files"""
+    for file in os.listdir("data/icospheres/"):
+        if not file.endswith(".cache"):
+            shutil.copy(os.path.join("data/icospheres/", file), tmp_path)
+    icospheres = IcoSpheres(icosphere_path=str(tmp_path), distance_type=distance_type, conv_type=conv_type)
+    # no level is loaded before it is used
+    assert len(icospheres.icospheres) == 0
+    for level in range(1, 8):
+        surf = icospheres.icospheres[level]
+        expected = IcoSpheres(icosphere_path=str(tmp_path), distance_type=distance_type, conv_type=conv_type)
+        expected_surf = expected.load_one_level_from_files(level)
+        for key, value in expected_surf.items():
+            if key == "neighbours":
+                for n, expected_n in zip(surf[key], value):
+                    assert np.array_equal(n, expected_n)
+            elif isinstance(value, torch.Tensor):
+                assert torch.equal(surf[key], value)
+            else:
+                assert np.array_equal(surf[key], value)
+        assert (surf["adj_mat"] != expected_surf["adj_mat"]).nnz == 0
+        expected_neighbours = np.tile(np.arange(len(surf["coords"])), (7, 1)).T
+        for v, n in enumerate(expected_surf["neighbours"]):
+            expected_neighbours[v, -len(n) :] = n
+        assert np.array_equal(icospheres.get_neighbours(level).numpy(), expected_neighbours)
+    assert os.path.isfile(os.path.join(tmp_path, ICOSPHERE_CACHE_FILE))
+    with pytest.raises(KeyError):
+        icospheres.icospheres[8]
+
+
+def test_icosphere_cache_creation(tmp_path):
+    """test that levels are read-only and on the device of the icospheres after creating the cache, and that
+    the cache is created again when its source files change"""
+    for file in os.listdir("data/icospheres/"):
+        if not file.endswith(".cache"):
+            shutil.copy(os.path.join("data/icospheres/", file), tmp_path)
+    icospheres = IcoSpheres(icosphere_path=str(tmp_path), distance_type="exact", conv_type="SpiralConv", read_only=True)
+    # meta tensors show that tensors are moved, without needing a gpu
+    icospheres.to(torch.device("meta"))
+    icospheres.icospheres[3]
+    # creating the cache does not load levels
+    assert list(icospheres.icospheres.keys()) == [3]
+    for level in range(1, 8):
+        surf = icospheres.icospheres[level]
+        for key, value in surf.items():
+            if isinstance(value, np.ndarray):
+                assert not value.flags.writeable, f"level {level} {key} is writeable"
+        assert surf["spirals"].device.type == "meta"
+        assert surf["t_edges"].device.type == "meta"
+
+    path = os.path.join(tmp_path, ICOSPHERE_CACHE_FILE)
+    sources = IcoSphereCache(path).sources
+    assert sources["ico7.surf.gii"] is not None
+    # unchanged source files reuse the cache
+    IcoSpheres(icosphere_path=str(tmp_path)).cache
+    assert IcoSphereCache(path).sources == sources
+    # changed source files create the cache again
+    gii = os.path.join(tmp_path, "ico5.surf.gii")
+    os.utime(gii, ns=(sources["ico5.surf.gii"][0] + 10**9, sources["ico5.surf.gii"][0] + 10**9))
+    IcoSpheres(icosphere_path=str(tmp_path)).cache
+    assert IcoSphereCache(path).sources["ico5.surf.gii"][0] == sources["ico5.surf.gii"][0] + 10**9
+
+
+def test_icosphere_topology():
+    """test that vectorised neighbours, exact edge attributes and spirals equal building them vertex by vertex"""
+    icospheres = IcoSpheres()
+    for level in [1, 4]:
+        surf = icospheres.icospheres[level]
+        neighbours = icospheres.get_neighbours_from_tris(surf["faces"])
+        expected_neighbours = [[] for _ in range(len(surf["coords"]))]
+        for tri in surf["faces"]:
+            expected_neighbours[tri[0]].append([tri[1], tri[2]])
+            expected_neighbours[tri[2]].append([tri[0], tri[1]])
+            expected_neighbours[tri[1]].append([tri[2], tri[0]])
+        for n, edges in zip(neighbours, expected_neighbours):
+            assert np.array_equal(n, icospheres.sort_neighbours(edges))
+
+        expected_edge_attrs = np.vstack([icospheres.vertex_attributes(surf, v) for v in range(len(surf["coords"]))])
+        assert np.array_equal(icospheres.calculate_exact_edge_attrs(level), expected_edge_attrs)
+
+        spirals = icospheres.calculate_spirals(level, size=20)
+        for v in range(len(surf["coords"])):
+            assert np.array_equal(spirals[v], icospheres.get_spiral_for_vertex(surf["neighbours"], vertex=v, size=20))
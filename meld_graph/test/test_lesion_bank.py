@@ -0,0 +1,81 @@
+#### tests for synthetic lesions: SyntheticLesionBank and lesion generation ####
+# tested functions:
+#   SyntheticLesionBank.create
+#   SyntheticLesionBank.sample
+#   Preprocess.add_lesion with lesion bank
+#   Preprocess.create_lesion_masks_sphere
+#   Preprocess.generate_synthetic_data_batch
+# NOTE:
+#   these tests require the icospheres and the cortex label of the test data
+
+import numpy as np
+from meld_graph.meld_cohort import MeldCohort
+from meld_graph.lesion_bank import SyntheticLesionBank
+from meld_graph.data_preprocessing import Preprocess
+from meld_graph.icospheres import IcoSpheres, get_icospheres
+from meld_graph.graph_tools import get_graph_tools
+
+SYNTH_PARAMS = {
+    "radius": 0.5,
+    "smooth_lesion": True,
+    "bias": 1,
+    "jitter_factor": 2,
+    "proportion_features_abnormal": 1,
+}
+
+
+def test_lesion_bank(tmp_path):
+    """test that lesions sampled from the bank are inside cortex and have consistent distances"""
+    c = MeldCohort()
+    bank = SyntheticLesionBank.create(str(tmp_path), cohort=c, n_lesions=3, radius=0.5, n_rotations=5)
+    assert bank.n_lesions == 3
+    assert bank.rotations.shape == (5, len(c.cortex_mask))
+    gt = get_graph_tools(get_icospheres(), cohort=c, distance_mask_medial_wall=True)
+    for _ in range(10):
+        lesion = bank.sample()
+        assert lesion["labels"].any()
+        assert not lesion["labels"][~c.cortex_mask].any()
+        assert (lesion["smoothed"][~c.cortex_mask] == 0).all()
+        # distances are negative inside the lesion
+        assert (lesion["distances"][lesion["labels"] == 1] <= 0).all()
+        assert (lesion["distances"][~c.cortex_mask] == 300).all()
+        # rotated distances match distances of the rotated lesion, up to nearest vertex resampling
+        distances = gt.fast_geodesics(lesion["labels"].astype(int))
+        assert np.percentile(np.abs(lesion["distances"] - distances)[c.cortex_mask], 99) < 10
+
+    # add_lesion returns lesion from the bank, with distances and smoothed labels
+    prep = Preprocess(cohort=c)
+    prep.lesion_bank = bank
+    n_features = 3
+    features = np.random.normal(size=(len(c.cortex_mask), n_features))
+    synth_dict = prep.add_lesion(features, None, n_features, SYNTH_PARAMS, histo_type_seed=0)
+    assert set(synth_dict.keys()) == {"features", "labels", "distances", "smooth_labels"}
+    assert synth_dict["features"].shape == features.shape
+    # features are only changed around the lesion
+    assert not np.allclose(synth_dict["features"], features)
+    assert np.allclose(synth_dict["features"][~c.cortex_mask], features[~c.cortex_mask])
+
+
+def test_synthetic_lesions_sphere():
+    """test that batched on-sphere lesion generation returns lesions in cortex, and features with lesions added"""
+    c = MeldCohort()
+    prep = Preprocess(cohort=c)
+    coords = IcoSpheres().icospheres[7]["coords"]
+    lesions, smoothed = prep.create_lesion_masks_sphere(0.5, coords, 5)
+    assert lesions.shape == smoothed.shape == (5, len(coords))
+    assert lesions[:, c.cortex_mask].any(axis=1).all()
+    assert ((smoothed >= 0) & (smoothed <= 1)).all()
+    # smoothed masks are high inside and low outside of lesions
+    assert (smoothed[lesions == 1] >= 0.5).all()
+    assert (smoothed[lesions == 0] <= 0.5).all()
+    # lat-long grid is not needed
+    assert prep.distances is None
+
+    synth_params = dict(SYNTH_PARAMS, lesion_shape="sphere", proportion_hemispheres_lesional=1)
+    features = np.random.normal(size=(4, len(coords), 3))
+    synth_dicts = prep.generate_synthetic_data_batch(coords, 3, synth_params, [0, 1, 2, 3], features=features)
+    assert len(synth_dicts) == 4
+    for synth_dict, hemi_features in zip(synth_dicts, features):
+        assert synth_dict["labels"].any()
+        assert not synth_dict["labels"][~c.cortex_mask].any()
+        assert np.allclose(synth_dict["features"][~c.cortex_mask], hemi_features[~c.cortex_mask])
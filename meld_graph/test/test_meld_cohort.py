@@ -5,6 +5,10 @@
 #   get_sites
 #   split_hemispheres
 #   cortex_label attribute
+#   hdf5 file pool (2 tests)
+#   subject manifest
+#   write_cohort_features with storage policies
+#   rewriting features with a different storage policy
 # NOTE:
 #   these tests require a test dataset, that is created with get_test_data()
 #   executing this function may take a while the first time (while the test data is being created)
@@ -12,13 +16,16 @@
 #   test getting / filtering features?
 
 import pytest
-from meld_graph.meld_cohort import MeldCohort, MeldSubject
+from meld_graph.meld_cohort import MeldCohort, MeldSubject, SubjectManifest, HDF5StoragePolicy, HDF5FilePool
+import os
 from meld_graph.paths import NVERT, BASE_PATH, DEFAULT_HDF5_FILE_ROOT
 import numpy as np
 import warnings
 from meld_graph.download_data import get_test_data
 import tempfile
 import pandas as pd
+import pickle
+import h5py
 from meld_graph.test.utils import create_test_demos
 
 # @pytest.fixture(autouse=True)
@@ -190,3 +197,112 @@ def test_split_hemispheres():
     input_data = np.zeros(100)
     with pytest.raises(AssertionError):
         c.split_hemispheres(input_data)
+
+
+def test_hdf5_pool():
+    c = MeldCohort(hdf5_file_root=DEFAULT_HDF5_FILE_ROOT)
+    c.close_hdf5_files()
+    # file stays open between calls
+    with c._site_hdf5("TEST", "patient") as f:
+        f_id = f.id
+    with c._site_hdf5("TEST", "patient") as f:
+        assert f.id == f_id
+        assert f.mode == "r"
+    # non-existing files are not opened
+    with c._site_hdf5("TEST", "unknown_group") as f:
+        assert f is None
+    # handles are not pickled
+    c_copy = pickle.loads(pickle.dumps(c))
+    assert len(c_copy.hdf5_pool._handles) == 0
+    c.close_hdf5_files()
+    assert len(c.hdf5_pool._handles) == 0
+
+
+def test_hdf5_pool_write_while_reading(tmp_path):
+    """read handles that are in use are not closed by a write"""
+    pool = HDF5FilePool()
+    path = str(tmp_path / "test.hdf5")
+    with pool.file(path, write=True) as f:
+        f.create_dataset("x", data=np.arange(3))
+    pool.close()
+    with pool.file(path) as f:
+        with pytest.raises(RuntimeError):
+            with pool.file(path, write=True):
+                pass
+        assert f.id.valid
+        assert (f["x"][:] == np.arange(3)).all()
+    # handle is reopened for writing once it is released
+    with pool.file(path, write=True) as f:
+        assert f.mode == "r+"
+        # reading inside a write block uses the write handle
+        with pool.file(path) as f_read:
+            assert f_read.id == f.id
+    pool.close()
+
+
+def test_subject_manifest():
+    c = MeldCohort(hdf5_file_root=DEFAULT_HDF5_FILE_ROOT)
+    subjects = c.subject_manifest.get_table(["TEST"], features=c.full_feature_list)
+    assert len(subjects["subject_id"]) > 0
+    # manifest agrees with information in hdf5 files
+    for i, subj_id in enumerate(subjects["subject_id"]):
+        subj = MeldSubject(subj_id, cohort=c)
+        assert subjects["scanner"][i] == subj.scanner
+        assert subjects["group"][i] == subj.group
+        assert (subjects["lesion_hemi"][i] or None) == subj.get_lesion_hemisphere()
+        assert (subjects["features"][i] == np.isin(c.full_feature_list, subj.get_feature_list())).all()
+    # manifest is written to disk and read again without changes
+    manifest = SubjectManifest(c)
+    assert set(manifest.files.keys()) == set(c.subject_manifest.files.keys())
+    subjects_reloaded = manifest.get_table(["TEST"], features=c.full_feature_list)
+    for col in subjects.keys():
+        assert (subjects_reloaded[col] == subjects[col]).all()
+
+
+@pytest.mark.parametrize(
+    "storage_policy",
+    [
+        HDF5StoragePolicy(),
+        HDF5StoragePolicy(compression="lzf", cortex_only=True),
+        HDF5StoragePolicy(compression=None, cortex_only=True, dtype="float16"),
+    ],
+)
+def test_write_cohort_features(storage_policy):
+    """test that features written with storage policies are read back"""
+    c = MeldCohort(hdf5_file_root=DEFAULT_HDF5_FILE_ROOT)
+    subject_ids = c.get_subject_ids(site_codes="TEST")[:4]
+    n_cortex = len(c.cortex_label)
+    values = np.random.default_rng(0).normal(size=(len(subject_ids), 2 * n_cortex)).astype(np.float16)
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.makedirs(os.path.join(data_dir, "MELD_TEST"))
+        c_out = MeldCohort(hdf5_file_root=DEFAULT_HDF5_FILE_ROOT, data_dir=data_dir, storage_policy=storage_policy)
+        c_out.write_cohort_features(".on_lh.test_feature.mgh", values, subject_ids)
+        for subj_id, subj_values in zip(subject_ids, values):
+            subj = MeldSubject(subj_id, cohort=c_out)
+            block, _ = subj.load_feature_block([".on_lh.test_feature.mgh"])
+            assert (block[:, ~c_out.cortex_mask] == 0).all()
+            assert (block[:, c_out.cortex_mask, 0].ravel() == subj_values).all()
+            lh_values = subj.load_feature_values(".on_lh.test_feature.mgh", hemi="lh")
+            assert (lh_values[c_out.cortex_mask] == subj_values[:n_cortex]).all()
+        c_out.close_hdf5_files()
+
+
+def test_storage_policy_rewrite(tmp_path):
+    """existing datasets are recreated when they were written with a different compression"""
+    cortex_mask = np.zeros(NVERT, dtype=bool)
+    cortex_mask[::2] = True
+    values = np.arange(cortex_mask.sum(), dtype=np.float32)
+    with h5py.File(tmp_path / "test.hdf5", "w") as f:
+        group = f.create_group("lh")
+        for policy in [
+            HDF5StoragePolicy(),
+            HDF5StoragePolicy(compression_level=1),
+            HDF5StoragePolicy(compression="lzf"),
+            HDF5StoragePolicy(compression=None),
+        ]:
+            policy.write(group, "feature", values, cortex_mask)
+            dset = group["feature"]
+            assert dset.compression == policy.compression
+            if policy.compression == "gzip":
+                assert dset.compression_opts == policy.compression_level
+            assert (dset[:][cortex_mask] == values).all()
@@ -1,8 +1,10 @@
 #### tests for MeldSubject ####
 # tested functions:
 #   attributes: site_code, scanner, group
+#   demographics index (shared between subjects, reloaded on csv change)
 #   get_lesion_hemishpere
 #   load_feature_lesion_data
+#   load_feature_block
 #   other MeldSubject functions (just syntax)
 # NOTE:
 #   these tests require a test dataset, that is created with get_test_data()
@@ -13,8 +15,9 @@
 import pytest
 from meld_graph.meld_cohort import MeldCohort, MeldSubject
 import numpy as np
+import os
 from meld_graph.download_data import get_test_data
-from meld_graph.paths import DEFAULT_HDF5_FILE_ROOT
+from meld_graph.paths import DEFAULT_HDF5_FILE_ROOT, NVERT
 from meld_graph.test.utils import create_test_demos
 
 create_test_demos()
@@ -30,6 +33,24 @@ def test_subject_parse():
     assert subj.group == "patient"
 
 
+def test_demographics_index():
+    """
+    test that demographics are read once per cohort and reloaded when the csv file changes
+    """
+    c = MeldCohort(hdf5_file_root=DEFAULT_HDF5_FILE_ROOT)
+    subj = MeldSubject("MELD_TEST_15T_FCD_0002", c)
+    assert subj.scanner == "15T"
+    index = c.get_demographics_index()
+    # index is shared between subjects
+    assert MeldSubject("MELD_TEST_3T_C_0001", c).scanner == "3T"
+    assert c.get_demographics_index() is index
+    # modifying the csv file invalidates the index
+    st = os.stat(index.csv_path)
+    os.utime(index.csv_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert c.get_demographics_index() is not index
+    assert subj.group == "patient"
+
+
 def test_get_lesion_hemisphere():
     c = MeldCohort(hdf5_file_root=DEFAULT_HDF5_FILE_ROOT)
     # ensure that patients have a lesional hemisphere
@@ -89,3 +110,25 @@ def test_load_feature_lesion_data(subj_id, hdf5_file_root):
             assert sum(lesion) > 0
         else:
             assert sum(lesion) == 0
+
+
+@pytest.mark.parametrize("subj_id,hdf5_file_root", testdata)
+def test_load_feature_block(subj_id, hdf5_file_root):
+    c = MeldCohort(hdf5_file_root=hdf5_file_root)
+    subj = MeldSubject(subj_id, cohort=c)
+    features = c.full_feature_list[:3] + ["missing_feature"]
+    block, lesion = subj.load_feature_block(features, hemis=("lh", "rh"))
+    assert block.shape == (2, NVERT, len(features))
+    assert block.dtype == np.float32
+    for h, hemi in enumerate(["lh", "rh"]):
+        for i, feature in enumerate(features[:3]):
+            assert np.all(block[h, :, i] == subj.load_feature_values(feature, hemi=hemi))
+        lesion_values = np.ceil(subj.load_feature_values(".on_lh.lesion.mgh", hemi=hemi)).astype(int)
+        assert np.all(lesion[h] == lesion_values)
+    # missing features are 0
+    assert np.all(block[:, :, -1] == 0)
+    # cortex only into preallocated buffer
+    out = np.empty((2, len(c.cortex_label), len(features)), dtype=np.float32)
+    cortex_block, _ = subj.load_feature_block(features, cortex_only=True, out=out)
+    assert cortex_block is out
+    assert np.all(cortex_block == block[:, c.cortex_mask])
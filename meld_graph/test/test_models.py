@@ -0,0 +1,160 @@
+#### tests for models.py ####
+# tested functions:
+#   deepcopy_model
+#   MoNetUnet.to - index tensors move with the model, shared icospheres stay on cpu
+#   MoNetUnet.forward - batched forward
+#   SpiralConv - chunked forward without gradients
+#   Ensemble - vectorised forward, state dict
+#   calculate_loss - distillation of an Ensemble into a single model
+# NOTE:
+#   these tests require the icospheres of the test data
+
+import torch
+import pytest
+from meld_graph.models import MoNetUnet, deepcopy_model
+from meld_graph.spiralconv import SpiralConv
+from meld_graph.ensemble import Ensemble, count_ensemble_members
+from meld_graph.icospheres import get_icospheres
+from meld_graph.training import calculate_loss
+
+ICOSPHERE_PARAMS = {"icosphere_path": "data/icospheres/", "distance_type": "exact", "conv_type": "SpiralConv"}
+
+
+def test_deepcopy_model():
+    """test that copied models share icospheres and index tensors, but not weights"""
+    model = MoNetUnet(
+        num_features=3,
+        layer_sizes=[[8], [8], [8]],
+        icosphere_params=ICOSPHERE_PARAMS,
+        conv_type="SpiralConv",
+        deep_supervision=[6],
+    )
+    copied_model = deepcopy_model(model)
+    assert copied_model.icospheres is model.icospheres
+    conv, copied_conv = model.encoder_conv_layers[0][0], copied_model.encoder_conv_layers[0][0]
+    assert copied_conv.indices is conv.indices
+    assert copied_conv.layer.weight is not conv.layer.weight
+    assert torch.equal(copied_conv.layer.weight, conv.layer.weight)
+    with torch.no_grad():
+        copied_conv.layer.weight.add_(1)
+    assert not torch.equal(copied_conv.layer.weight, conv.layer.weight)
+
+
+@pytest.mark.parametrize("conv_type", ["SpiralConv", "GMMConv"])
+def test_model_to(conv_type):
+    """test that moving a model moves its index tensors, but not the shared icospheres or other models"""
+    icosphere_params = dict(ICOSPHERE_PARAMS, conv_type=conv_type)
+    model_kwargs = dict(num_features=3, layer_sizes=[[8], [8]], icosphere_params=icosphere_params, conv_type=conv_type)
+    model = MoNetUnet(**model_kwargs)
+    other_model = MoNetUnet(**model_kwargs)
+    assert model.icospheres is other_model.icospheres
+    # meta tensors show that tensors are moved, without needing a gpu
+    assert model.to(torch.device("meta")) is model
+    index_buffers = [
+        name for module in model.modules() for name in module._non_persistent_buffers_set
+    ]
+    assert {"indices", "edges", "neigh_indices", "upsample_indices"} & set(index_buffers)
+    assert all(buffer.device.type == "meta" for buffer in model.buffers())
+    assert all(buffer.device.type == "cpu" for buffer in other_model.buffers())
+    icospheres = model.icospheres
+    assert icospheres.get_edges(level=7).device.type == "cpu"
+    assert icospheres.get_neighbours(level=7).device.type == "cpu"
+    with pytest.raises(AssertionError):
+        icospheres.to(torch.device("meta"))
+
+
+@pytest.mark.parametrize("conv_type,norm", [("SpiralConv", "instance"), ("SpiralConv", None), ("GMMConv", "instance")])
+def test_batched_forward(conv_type, norm):
+    """test that forward of a batch equals forward of every sample of the batch"""
+    model = MoNetUnet(
+        num_features=3,
+        layer_sizes=[[8], [8], [16]],
+        icosphere_params=dict(ICOSPHERE_PARAMS, conv_type=conv_type, distance_type="pseudo"),
+        conv_type=conv_type,
+        norm=norm,
+        deep_supervision=[6],
+        classification_head=True,
+        object_detection_head=True,
+        distance_head=True,
+    )
+    batch_size = 3
+    x = torch.randn(batch_size * model.n_vertices, 3)
+    with torch.no_grad():
+        outputs = model(x)
+        sample_outputs = [model(sample) for sample in x.split(model.n_vertices)]
+    for key, output in outputs.items():
+        expected = torch.cat([sample_output[key] for sample_output in sample_outputs])
+        assert output.shape == expected.shape
+        assert torch.allclose(output, expected, atol=1e-6)
+
+
+def test_spiral_conv():
+    """test that chunked SpiralConv without gradients equals SpiralConv with gradients, and state dict only has weights"""
+    indices = get_icospheres(**ICOSPHERE_PARAMS).get_spirals(level=5)[:, :7]
+    conv = SpiralConv(4, 8, indices=indices, norm="instance")
+    conv.chunk_size = 1000
+    assert set(conv.state_dict().keys()) == {"layer.weight", "layer.bias"}
+    x = torch.randn(2, len(indices), 4)
+    expected = conv(x, device="cpu")
+    assert expected.requires_grad
+    with torch.no_grad():
+        assert torch.allclose(conv(x, device="cpu"), expected, atol=1e-6)
+        assert torch.allclose(conv(x[1], device="cpu"), expected[1], atol=1e-6)
+
+
+def test_ensemble():
+    """test that vectorised ensemble equals running members one by one, and loads state dicts of other ensembles"""
+    model_kwargs = dict(
+        num_features=3,
+        layer_sizes=[[8], [8]],
+        icosphere_params=ICOSPHERE_PARAMS,
+        conv_type="SpiralConv",
+        classification_head=True,
+    )
+    members = [MoNetUnet(**model_kwargs) for _ in range(3)]
+    model = MoNetUnet(**model_kwargs)
+    ensemble = Ensemble(members, vectorised=False)
+    state_dict = ensemble.state_dict()
+    assert count_ensemble_members(state_dict) == 3
+    vectorised_ensemble = Ensemble([deepcopy_model(model) for _ in range(3)], vectorised=True)
+    vectorised_ensemble.load_state_dict(state_dict)
+    x = torch.randn(2 * model.n_vertices, 3)
+    with torch.no_grad():
+        expected = ensemble(x)
+        estimates = vectorised_ensemble(x)
+    assert set(estimates.keys()) == {"log_softmax", "hemi_log_softmax", "non_lesion_logits"}
+    for key, estimate in estimates.items():
+        assert torch.allclose(estimate, expected[key], atol=1e-5)
+
+
+def test_distillation_loss():
+    """test that distillation loss is zero for a student equal to the teacher, and only trains the student"""
+    model_kwargs = dict(
+        num_features=3,
+        icosphere_params=ICOSPHERE_PARAMS,
+        conv_type="SpiralConv",
+        deep_supervision=[6],
+    )
+    student = MoNetUnet(layer_sizes=[[8], [8]], **model_kwargs)
+    teacher = Ensemble([deepcopy_model(student) for _ in range(2)])
+    loss_dict = {"distillation": {"weight": 1, "temperature": 2, "distance_weight": 1}}
+    x = torch.randn(2 * student.n_vertices, 3)
+    labels = torch.zeros(len(x), dtype=torch.long)
+    with torch.no_grad():
+        teacher_estimates = teacher(x)
+    losses = calculate_loss(
+        loss_dict, student(x), labels, n_vertices=student.n_vertices, teacher_estimates=teacher_estimates
+    )
+    assert losses["distillation"].item() == pytest.approx(0, abs=1e-6)
+    # no distillation on deep supervision levels
+    assert calculate_loss(loss_dict, student(x), labels, deep_supervision_level=6, teacher_estimates=teacher_estimates) == {}
+
+    # smaller student
+    student = MoNetUnet(layer_sizes=[[4], [4]], **model_kwargs)
+    losses = calculate_loss(
+        loss_dict, student(x), labels, n_vertices=student.n_vertices, teacher_estimates=teacher_estimates
+    )
+    assert losses["distillation"].item() > 0
+    losses["distillation"].backward()
+    assert student.encoder_conv_layers[0][0].layer.weight.grad is not None
+    assert all(param.grad is None for param in teacher.parameters())
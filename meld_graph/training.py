@@ -201,6 +201,36 @@ class FocalLoss(torch.nn.Module):
             return loss.sum()
 
 
+class DistillationLoss(torch.nn.Module):
+    """
+    Knowledge distillation loss, training a student model on the soft outputs of a teacher (e.g. an Ensemble).
+    KL divergence of the temperature softened student and teacher log_softmax (scaled by temperature**2),
+    plus distance_weight times the mean squared error of student and teacher non_lesion_logits.
+
+    Args:
+        params (dict): loss dict from experiment_config.py
+    """
+
+    def __init__(self, params):
+        super(DistillationLoss, self).__init__()
+        params = params.get("distillation", {})
+        self.temperature = params.get("temperature", 1)
+        self.distance_weight = params.get("distance_weight", 1)
+
+    def forward(self, inputs, targets, **kwargs):
+        # inputs are the estimates of the student, targets the estimates of the teacher
+        # log_softmax(log_softmax(x) / t) equals log_softmax(x / t)
+        student = torch.log_softmax(inputs["log_softmax"] / self.temperature, dim=-1)
+        teacher = torch.log_softmax(targets["log_softmax"] / self.temperature, dim=-1)
+        kl = torch.sum(torch.exp(teacher) * (teacher - student), dim=-1)
+        loss = torch.mean(kl) * self.temperature**2
+        if self.distance_weight and "non_lesion_logits" in targets:
+            loss = loss + self.distance_weight * torch.mean(
+                torch.square(inputs["non_lesion_logits"] - targets["non_lesion_logits"])
+            )
+        return loss
+
+
 def get_sensitivity(pred, target):
     """
     Sample-level sensitivity.
@@ -225,7 +255,8 @@ def tp_fp_fn_tn(pred, target):
 
 def calculate_loss(loss_dict, estimates_dict, labels,
                     distance_map=None, xyzr=None,
-                    deep_supervision_level=None, device=None, n_vertices=None):
+                    deep_supervision_level=None, device=None, n_vertices=None,
+                    teacher_estimates=None):
     """ 
     Calculate loss. Can combine losses with weights defined in loss_dict
 
@@ -236,7 +267,8 @@ def calculate_loss(loss_dict, estimates_dict, labels,
         'focal_loss':{'weight':1, 'alpha':0.4, 'gamma':4},
         'dice':{'weight': 1, 'class_weights': [0.0, 1.0]},
         'distance_regression': {'weight': 1, 'weigh_by_gt': True},
-        'lesion_classification': {'weight': 1, 'apply_to_bottleneck': True}
+        'lesion_classification': {'weight': 1, 'apply_to_bottleneck': True},
+        'distillation': {'weight': 1, 'teacher_path': '23-10-30_LVHZ_dcp/fold_all', 'temperature': 1},
         }
     ```
     NOTE Estimates are the logSoftmax output of the model. For some losses, applying torch.exp is necessary!
@@ -251,6 +283,7 @@ def calculate_loss(loss_dict, estimates_dict, labels,
             This arg indicates which level we are currenly at.
             Used to get the correct outputs from estimates_dict.
         n_vertices: number of vertices at current level.
+        teacher_estimates (optional, dict): outputs of the teacher model, for the distillation loss.
     """
     loss_functions = {
         'dice': partial(DiceLoss(loss_weight_dictionary=loss_dict),
@@ -261,7 +294,8 @@ def calculate_loss(loss_dict, estimates_dict, labels,
         'distance_regression': DistanceRegressionLoss(loss_dict),
         'lesion_classification': CrossEntropyLoss(),
         'mae_loss': MAELoss(),
-        'object_detection': SmoothL1Loss()
+        'object_detection': SmoothL1Loss(),
+        'distillation': DistillationLoss(loss_dict),
     }
     if distance_map is not None:
         distance_map.to(device)
@@ -285,6 +319,12 @@ def calculate_loss(loss_dict, estimates_dict, labels,
             else:
                 cur_estimates = estimates_dict['object_detection_linear']
                 cur_labels = torch.any(labels.view(labels.shape[0]//n_vertices, -1), dim=1).long()
+        elif loss_def == 'distillation':
+            # teacher outputs are only available on the highest level
+            if deep_supervision_level is not None:
+                continue
+            cur_estimates = estimates_dict
+            cur_labels = teacher_estimates
         elif loss_def == 'lesion_classification':
             if loss_dict[loss_def].get('apply_to_bottleneck', False):
                 # if apply lc to bottleneck, do not apply it on deep supervision levels
@@ -458,6 +498,45 @@ class Trainer:
             init_weights = os.path.join(EXPERIMENT_PATH, init_weights)
             assert os.path.isfile(init_weights), f"Weights file {init_weights} does not exist"
         self.init_weights = init_weights
+        # distillation: train on the outputs of a teacher model, loaded with self.teacher
+        self.distillation = self.params["loss_dictionary"].get("distillation", None)
+        self._teacher = None
+
+    @property
+    def teacher(self):
+        """
+        Teacher model of the distillation loss, in eval mode.
+        Loaded from the experiment folder loss_dictionary["distillation"]["teacher_path"] (relative to EXPERIMENT_PATH).
+        Ensembles (fold_all) are loaded as Ensemble. None if there is no distillation loss.
+        """
+        if self._teacher is None and self.distillation is not None:
+            # avoid circular import
+            from meld_graph.experiment import Experiment
+
+            teacher_path = os.path.join(EXPERIMENT_PATH, self.distillation["teacher_path"])
+            model_name = self.distillation.get("model_name", "best_model")
+            checkpoint_path = os.path.join(teacher_path, f"{model_name}.pt")
+            assert os.path.isfile(checkpoint_path), f"Teacher checkpoint {checkpoint_path} does not exist"
+            self.log.info(f"Loading distillation teacher {checkpoint_path}")
+            teacher_experiment = Experiment.from_folder(teacher_path, init_logging=False)
+            assert teacher_experiment.data_parameters["features"] == self.experiment.get_features()[0], (
+                "Teacher needs to be trained on the same features as the student"
+            )
+            teacher_experiment.load_model(checkpoint_path=checkpoint_path)
+            device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+            self._teacher = teacher_experiment.model
+            self._teacher.to(device)
+            self._teacher.eval()
+            for param in self._teacher.parameters():
+                param.requires_grad = False
+        return self._teacher
+
+    def teacher_estimates(self, x):
+        """outputs of the teacher model for distillation, None if there is no distillation loss"""
+        if self.teacher is None:
+            return None
+        with torch.no_grad():
+            return self.teacher(x)
 
     def train_epoch(self, data_loader, optimiser):
         """
@@ -483,18 +562,23 @@ class Trainer:
             for level in self.deep_supervision["levels"]:
                 running_losses[f"ds{level}_{key}"] = []
         running_losses["loss"] = []
+        # batched data augmentation, if the dataset uses batch_augmentation
+        batch_augment = getattr(data_loader.dataset, "batch_augment", None)
         for i, data in enumerate(data_loader):
             data = data.to(device)
+            if batch_augment is not None:
+                data = batch_augment.apply(data)
             model.train()
             optimiser.zero_grad()
             estimates = model(data.x)
+            teacher_estimates = self.teacher_estimates(data.x)
             labels = data.y.squeeze()
             distance_map = getattr(data, "distance_map", None)
             xyzr = getattr(data, "xyzr", None)
             losses = calculate_loss(self.params['loss_dictionary'], estimates, labels,
                                      distance_map=distance_map,xyzr=xyzr,
                                        deep_supervision_level=None, device=device, 
-                n_vertices=self.experiment.model.n_vertices)
+                n_vertices=self.experiment.model.n_vertices, teacher_estimates=teacher_estimates)
             # add deep supervision outputs
             for i, level in enumerate(sorted(self.deep_supervision["levels"])):
                 cur_labels = getattr(data, f"output_level{level}")
@@ -524,6 +608,9 @@ class Trainer:
                 if model.object_detection_head and key=='object_detection':
                     # no ds for object detection in this case
                     continue
+                if key == "distillation":
+                    # no ds for distillation, teacher outputs are only available on the highest level
+                    continue
                 for level in self.deep_supervision['levels']:
                     running_losses[f'ds{level}_{key}'].append(losses[f'ds{level}_{key}'].item())
             running_losses['loss'].append(loss.item())
@@ -571,13 +658,14 @@ class Trainer:
             for i, data in enumerate(data_loader):
                 data = data.to(device)
                 estimates = model(data.x)
+                teacher_estimates = self.teacher_estimates(data.x)
                 labels = data.y.squeeze()
                 distance_map = getattr(data, "distance_map", None)
                 xyzr = getattr(data, "xyzr", None)
                 losses = calculate_loss(self.params['loss_dictionary'], estimates, labels, 
                                         distance_map=distance_map, xyzr=xyzr,
                                         deep_supervision_level=None, device=device, 
-                    n_vertices=self.experiment.model.n_vertices)
+                    n_vertices=self.experiment.model.n_vertices, teacher_estimates=teacher_estimates)
                 # add deep supervision outputs
                 for i, level in enumerate(sorted(self.deep_supervision["levels"])):
                     cur_labels = getattr(data, f"output_level{level}")
@@ -606,6 +694,9 @@ class Trainer:
                     if model.object_detection_head and key=='object_detection':
                         # no ds for object detection in this case
                         continue
+                    if key == "distillation":
+                        # no ds for distillation
+                        continue
                     for level in self.deep_supervision["levels"]:
                         running_losses[f"ds{level}_{key}"].append(losses[f"ds{level}_{key}"].item())
                 running_losses["loss"].append(loss.item())
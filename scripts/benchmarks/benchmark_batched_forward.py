@@ -0,0 +1,73 @@
+## Benchmark throughput of MoNetUnet.forward on batches of hemispheres,
+## comparing the batched forward with a forward pass for every hemisphere of the batch
+
+import time
+import argparse
+import pandas as pd
+import torch
+from meld_graph.models import MoNetUnet
+
+# model architecture of example_experiment_config.py
+LAYER_SIZES = [[32, 32, 32], [32, 32, 32], [64, 64, 64], [64, 64, 64], [128, 128, 128], [128, 128, 128], [256, 256, 256]]
+
+
+def hemispheres_per_second(function, x, n_hemispheres, n_repeats):
+    function(x)
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        function(x)
+    return n_hemispheres * n_repeats / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare throughput of batched and per hemisphere MoNetUnet.forward")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8], help="batch sizes")
+    parser.add_argument("--conv_type", default="SpiralConv", help="SpiralConv or GMMConv")
+    parser.add_argument("--norm", default=None, help="None or instance")
+    parser.add_argument("--n_repeats", type=int, default=3, help="number of forward passes per batch size")
+    parser.add_argument("--train", action="store_true", default=False, help="include backward pass")
+    args = parser.parse_args()
+
+    model = MoNetUnet(
+        num_features=15,
+        layer_sizes=LAYER_SIZES,
+        conv_type=args.conv_type,
+        norm=args.norm,
+        deep_supervision=[2, 3, 4, 5, 6],
+        classification_head=True,
+        distance_head=True,
+        icosphere_params={"distance_type": "pseudo", "conv_type": args.conv_type},
+    )
+    model.to(model.device)
+
+    def forward(x):
+        if args.train:
+            outputs = model(x)
+            sum(output.sum() for output in outputs.values()).backward()
+        else:
+            with torch.no_grad():
+                outputs = model(x)
+        return outputs
+
+    def forward_per_hemisphere(x):
+        return [forward(sample) for sample in x.split(model.n_vertices)]
+
+    results = {}
+    for batch_size in args.batch_sizes:
+        x = torch.randn(batch_size * model.n_vertices, 15, device=model.device)
+        with torch.no_grad():
+            outputs = model(x)
+            sample_outputs = [model(sample) for sample in x.split(model.n_vertices)]
+        max_difference = max(
+            (outputs[key] - torch.cat([o[key] for o in sample_outputs])).abs().max().item() for key in outputs
+        )
+        batched = hemispheres_per_second(forward, x, batch_size, args.n_repeats)
+        per_hemisphere = hemispheres_per_second(forward_per_hemisphere, x, batch_size, args.n_repeats)
+        results[batch_size] = {
+            "hemispheres/s batched": batched,
+            "hemispheres/s per hemisphere": per_hemisphere,
+            "speedup": batched / per_hemisphere,
+            "max abs difference": max_difference,
+        }
+    print(f"torch threads: {torch.get_num_threads()}, device: {model.device}")
+    print(pd.DataFrame(results).T.rename_axis("batch size").to_string())
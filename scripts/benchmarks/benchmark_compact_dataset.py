@@ -0,0 +1,45 @@
+## Benchmark memory usage of the preloaded GraphDataset with and without compact_storage,
+## and check that validation metrics of a trained model are unchanged
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import torch_geometric
+import meld_graph.experiment
+from meld_graph.dataset import GraphDataset
+from meld_graph.training import Trainer
+
+
+def validation_scores(exp, compact_storage, seed=0):
+    """memory usage of val dataset and scores of Trainer.val_epoch"""
+    exp.data_parameters["compact_storage"] = compact_storage
+    dataset = GraphDataset.from_experiment(exp, mode="val")
+    data_loader = torch_geometric.loader.DataLoader(dataset, shuffle=False, batch_size=2)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    scores = Trainer(exp).val_epoch(data_loader)
+    scores["dataset MB"] = dataset.data_list.nbytes / 1e6
+    return scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare dataset memory usage and validation metrics with and without compact_storage"
+    )
+    parser.add_argument("--model_path", help="path to trained experiment folder")
+    parser.add_argument("--model_name", default="best_model", help="name of the model checkpoint to load")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    exp = meld_graph.experiment.Experiment.from_folder(args.model_path)
+    exp.data_parameters["augment_data"] = {}
+    exp.load_model(checkpoint_path=os.path.join(args.model_path, f"{args.model_name}.pt"))
+    results = {
+        "float32": validation_scores(exp, compact_storage=False, seed=args.seed),
+        "compact": validation_scores(exp, compact_storage=True, seed=args.seed),
+    }
+    df = pd.DataFrame(results)
+    df["difference"] = df["compact"] - df["float32"]
+    print(df)
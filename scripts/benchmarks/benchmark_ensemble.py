@@ -0,0 +1,42 @@
+## Benchmark prediction time of an ensemble, running members one after the other
+## or all members in one vectorised pass (Ensemble vectorised), and check that both give the same estimates
+
+import os
+import time
+import argparse
+import pandas as pd
+import torch
+import meld_graph.experiment
+
+
+def seconds_per_hemisphere(model, x, n_hemispheres, n_repeats):
+    with torch.no_grad():
+        estimates = model(x)
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            model(x)
+    return (time.perf_counter() - start) / (n_repeats * n_hemispheres), estimates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ensemble prediction with and without vectorised members")
+    parser.add_argument("--model_path", help="path to ensemble experiment folder (fold_all)")
+    parser.add_argument("--model_name", default="best_model", help="name of the model checkpoint to load")
+    parser.add_argument("--batch_size", type=int, default=1, help="number of hemispheres per forward pass")
+    parser.add_argument("--n_repeats", type=int, default=3, help="number of forward passes")
+    args = parser.parse_args()
+
+    exp = meld_graph.experiment.Experiment.from_folder(args.model_path)
+    exp.load_ensemble_model(checkpoint_path=os.path.join(args.model_path, f"{args.model_name}.pt"))
+    ensemble = exp.model
+    member = ensemble.models[0]
+    x = torch.randn(args.batch_size * member.n_vertices, member.num_features, device=member.device)
+    results = {}
+    estimates = {}
+    for vectorised in [False, True]:
+        ensemble.vectorised = vectorised
+        seconds, estimates[vectorised] = seconds_per_hemisphere(ensemble, x, args.batch_size, args.n_repeats)
+        results["vectorised" if vectorised else "one by one"] = {"s per hemisphere": seconds}
+    max_difference = max((estimates[True][key] - estimates[False][key]).abs().max().item() for key in estimates[False])
+    print(f"{ensemble.n_members} members, device: {member.device}, max abs difference: {max_difference:.2e}")
+    print(pd.DataFrame(results).T.to_string())
@@ -0,0 +1,75 @@
+## Benchmark write / read throughput and file size of hdf5 storage policies for features
+## Writes the same synthetic features with each HDF5StoragePolicy, using one open file per policy as save_cohort_features does
+
+import os
+import time
+import argparse
+import tempfile
+import h5py
+import numpy as np
+import pandas as pd
+from meld_graph.meld_cohort import MeldCohort, HDF5StoragePolicy, read_hdf5_feature
+from meld_graph.paths import NVERT
+
+POLICIES = {
+    "gzip9 (default)": HDF5StoragePolicy(compression="gzip", compression_level=9),
+    "gzip4": HDF5StoragePolicy(compression="gzip", compression_level=4),
+    "gzip4 cortex": HDF5StoragePolicy(compression="gzip", compression_level=4, cortex_only=True),
+    "lzf cortex": HDF5StoragePolicy(compression="lzf", cortex_only=True),
+    "none cortex": HDF5StoragePolicy(compression=None, cortex_only=True),
+    "lzf cortex float16": HDF5StoragePolicy(compression="lzf", cortex_only=True, dtype="float16"),
+}
+
+
+def synthetic_features(n_subjects, n_cortex, seed=0):
+    """smooth random features, to get compression ratios closer to real features than white noise"""
+    rng = np.random.default_rng(seed)
+    values = np.cumsum(rng.normal(size=(n_subjects, 2 * n_cortex)), axis=1).astype(np.float32)
+    return values / np.abs(values).max(axis=1, keepdims=True)
+
+
+def benchmark_policy(policy, values, cortex_mask, hdf5_file, n_features):
+    n_cortex = cortex_mask.sum()
+    # write
+    start = time.perf_counter()
+    with h5py.File(hdf5_file, "w") as f:
+        for s, subject_values in enumerate(values):
+            for fi in range(n_features):
+                for h, hemi in enumerate(["lh", "rh"]):
+                    group = f.require_group(f"SITE/3T/patient/subject_{s}/{hemi}")
+                    policy.write(group, f"feature_{fi}", subject_values[h * n_cortex : (h + 1) * n_cortex], cortex_mask)
+    write_time = time.perf_counter() - start
+    # read
+    buffer = np.empty(NVERT, dtype=np.float32)
+    start = time.perf_counter()
+    with h5py.File(hdf5_file, "r") as f:
+        for s in range(len(values)):
+            for fi in range(n_features):
+                for hemi in ["lh", "rh"]:
+                    read_hdf5_feature(f[f"SITE/3T/patient/subject_{s}/{hemi}/feature_{fi}"], cortex_mask, buffer)
+    read_time = time.perf_counter() - start
+    n_values = len(values) * n_features * 2 * n_cortex
+    return {
+        "write MB/s": n_values * 4 / 1e6 / write_time,
+        "read MB/s": n_values * 4 / 1e6 / read_time,
+        "file size MB": os.path.getsize(hdf5_file) / 1e6,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare write / read throughput and file size of HDF5StoragePolicies")
+    parser.add_argument("--n_subjects", type=int, default=20, help="number of synthetic subjects")
+    parser.add_argument("--n_features", type=int, default=5, help="number of features per subject")
+    args = parser.parse_args()
+
+    cortex_mask = MeldCohort().cortex_mask
+    values = synthetic_features(args.n_subjects, cortex_mask.sum())
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, policy in POLICIES.items():
+            results[name] = benchmark_policy(
+                policy, values, cortex_mask, os.path.join(tmp_dir, "features.hdf5"), args.n_features
+            )
+            print(name, results[name])
+    # throughput is given in MB of float32 cortex values
+    print(pd.DataFrame(results).T.round(1))
@@ -0,0 +1,53 @@
+## Benchmark speed and accuracy of the geodesic backends of GraphTools against the heat method of potpourri3d,
+## on random synthetic lesions
+
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from meld_graph.icospheres import IcoSpheres
+from meld_graph.graph_tools import GraphTools
+from meld_graph.meld_cohort import MeldCohort
+from meld_graph.data_preprocessing import Preprocess
+from meld_graph.geodesics import GEODESIC_SOLVERS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare geodesic distance backends of GraphTools")
+    parser.add_argument("--n_lesions", type=int, default=64, help="number of synthetic lesions")
+    parser.add_argument("--radius", type=float, default=0.5, help="mean lesion radius, as synthetic_data radius")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    icospheres = IcoSpheres()
+    cohort = MeldCohort()
+    lesions, _ = Preprocess(cohort=cohort).create_lesion_masks_sphere(
+        args.radius, icospheres.icospheres[7]["coords"], args.n_lesions
+    )
+    lesions = lesions * cohort.cortex_mask
+
+    results = {}
+    for backend in GEODESIC_SOLVERS:
+        gt = GraphTools(icospheres, cohort=cohort, distance_mask_medial_wall=True, geodesic_backend=backend)
+        start = time.perf_counter()
+        single_distances = np.stack([gt.fast_geodesics(lesion) for lesion in lesions])
+        single_time = (time.perf_counter() - start) / args.n_lesions
+        start = time.perf_counter()
+        distances = gt.batch_geodesics(lesions)
+        batch_time = (time.perf_counter() - start) / args.n_lesions
+        assert np.allclose(single_distances, distances)
+        if backend == "pp3d":
+            reference = distances
+        errors = np.abs(distances - reference)
+        # distances within 20 define the borderzone used in training and evaluation
+        borderzone = np.abs(reference) <= 20
+        results[backend] = {
+            "ms per lesion (single)": 1000 * single_time,
+            "ms per lesion (batch)": 1000 * batch_time,
+            "mean abs error": errors[:, cohort.cortex_mask].mean(),
+            "max abs error": errors[:, cohort.cortex_mask].max(),
+            "mean abs error borderzone": errors[borderzone].mean(),
+            "borderzone agreement": ((np.abs(distances) <= 20) == borderzone)[:, cohort.cortex_mask].mean(),
+        }
+    print(pd.DataFrame(results).round(4))
@@ -0,0 +1,75 @@
+## Benchmark build time of icosphere neighbours, exact edge attributes and spirals per level,
+## comparing the vectorised builders of IcoSpheres with building them vertex by vertex
+
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from meld_graph.icospheres import IcoSpheres
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def neighbours_per_vertex(icospheres, tris):
+    """neighbours from tris, sorted vertex by vertex with sort_neighbours"""
+    neighbours = [[] for i in range(np.max(tris) + 1)]
+    for tri in tris:
+        neighbours[tri[0]].append([tri[1], tri[2]])
+        neighbours[tri[2]].append([tri[0], tri[1]])
+        neighbours[tri[1]].append([tri[2], tri[0]])
+    return [icospheres.sort_neighbours(edges) for edges in neighbours]
+
+
+def exact_edge_attrs_per_vertex(icospheres, level):
+    surf = icospheres.icospheres[level]
+    return np.vstack([icospheres.vertex_attributes(surf, v) for v in np.arange(len(surf["coords"]))])
+
+
+def spirals_per_vertex(icospheres, level, size=20):
+    neighbours = icospheres.icospheres[level]["neighbours"]
+    return np.array([icospheres.get_spiral_for_vertex(neighbours, vertex=v, size=size) for v in range(len(neighbours))])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare build time of vectorised and per vertex icosphere topology")
+    parser.add_argument("--icosphere_path", default="data/icospheres/", help="directory of icosphere files")
+    parser.add_argument("--max_per_vertex_level", type=int, default=6, help="highest level built vertex by vertex")
+    args = parser.parse_args()
+
+    results = {}
+    for level in range(1, 8):
+        icospheres = IcoSpheres(icosphere_path=args.icosphere_path)
+        surf = icospheres.load_one_level_from_files(level)
+        neighbours, neighbours_time = timed(icospheres.get_neighbours_from_tris, surf["faces"])
+        edge_attrs, edge_attrs_time = timed(icospheres.calculate_exact_edge_attrs, level)
+        spirals, spirals_time = timed(icospheres.calculate_spirals, level)
+        result = {
+            "vertices": len(surf["coords"]),
+            "neighbours s": neighbours_time,
+            "edge attrs s": edge_attrs_time,
+            "spirals s": spirals_time,
+        }
+        # compare with the files used to load icospheres, if they exist
+        spirals_file = os.path.join(args.icosphere_path, f"ico{level}.spirals.npy")
+        identical = all(np.array_equal(n, m) for n, m in zip(neighbours, surf["neighbours"]))
+        identical &= np.array_equal(edge_attrs, np.hstack([surf["edges"], surf["exact_edge_attr"]]))
+        if os.path.isfile(spirals_file):
+            identical &= np.array_equal(spirals, np.load(spirals_file))
+        if level <= args.max_per_vertex_level:
+            reference_neighbours, time_per_vertex = timed(neighbours_per_vertex, icospheres, surf["faces"])
+            reference_edge_attrs, edge_attrs_per_vertex_time = timed(exact_edge_attrs_per_vertex, icospheres, level)
+            reference_spirals, spirals_per_vertex_time = timed(spirals_per_vertex, icospheres, level)
+            time_per_vertex += edge_attrs_per_vertex_time + spirals_per_vertex_time
+            identical &= all(np.array_equal(n, m) for n, m in zip(neighbours, reference_neighbours))
+            identical &= np.array_equal(edge_attrs, reference_edge_attrs)
+            identical &= np.array_equal(spirals, reference_spirals)
+            result["per vertex total s"] = time_per_vertex
+            result["speedup"] = time_per_vertex / (neighbours_time + edge_attrs_time + spirals_time)
+        result["identical"] = identical
+        results[f"ico{level}"] = result
+    print(pd.DataFrame(results).T.round(3).to_string())
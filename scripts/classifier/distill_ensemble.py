@@ -0,0 +1,43 @@
+## Train a single student model on the outputs of a trained ensemble (teacher), using the distillation loss
+## Evaluate speedup and agreement with the teacher with evaluate_distillation.py
+
+import json
+import logging
+import argparse
+import meld_graph.experiment
+from meld_graph.paths import MODEL_PATH
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distil a trained ensemble into a single student model")
+    parser.add_argument("--name", help="experiment name of the student")
+    parser.add_argument(
+        "--teacher_path", default=MODEL_PATH, help="path to teacher experiment folder, relative to EXPERIMENT_PATH"
+    )
+    parser.add_argument("--model_name", default="best_model", help="name of the teacher checkpoint")
+    parser.add_argument("--fold", type=int, default=0, help="fold used for the train / val split of the student")
+    parser.add_argument(
+        "--layer_sizes",
+        default=None,
+        help='layer_sizes of the student as json, e.g. "[[16,16],[32,32],[64,64],[128,128],[128,128],[256,256],[256,256]]". Default: same as teacher',
+    )
+    parser.add_argument("--temperature", type=float, default=1, help="temperature of the distillation loss")
+    parser.add_argument(
+        "--distance_weight", type=float, default=1, help="weight of the non_lesion_logits term of the distillation loss"
+    )
+    parser.add_argument("--wandb_logging", action="store_true", help="enable wandb logging.")
+    args = parser.parse_args()
+
+    model_parameters = {}
+    if args.layer_sizes is not None:
+        model_parameters["layer_sizes"] = json.loads(args.layer_sizes)
+    exp = meld_graph.experiment.Experiment.for_distillation(
+        args.teacher_path,
+        args.name,
+        model_name=args.model_name,
+        fold_n=args.fold,
+        model_parameters=model_parameters,
+        distillation_parameters={"temperature": args.temperature, "distance_weight": args.distance_weight},
+        verbose=logging.INFO,
+    )
+    exp.train(wandb_logging=args.wandb_logging)
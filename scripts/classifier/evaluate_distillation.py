@@ -0,0 +1,112 @@
+## Compare a distilled student model (distill_ensemble.py) with its teacher ensemble:
+## prediction time per hemisphere (speedup) and agreement of thresholded clusters on the val or test subjects
+## The student is thresholded with the thresholds of the teacher. If the student does not have thresholds yet,
+## the two_thresholds.csv of the teacher is copied to the results folder of the student.
+
+import os
+import time
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import meld_graph.experiment
+from meld_graph.evaluation import Evaluator, cluster_agreement
+from meld_graph.paths import EXPERIMENT_PATH
+
+
+def seconds_per_hemisphere(model, x, n_repeats):
+    with torch.no_grad():
+        model(x)
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            model(x)
+    return (time.perf_counter() - start) / n_repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare distilled student model with its teacher")
+    parser.add_argument("--student_path", help="path to student experiment folder, relative to EXPERIMENT_PATH")
+    parser.add_argument("--model_name", default="best_model", help="name of the student checkpoint")
+    parser.add_argument("--split", default="val", choices=["val", "test"], help="subjects of the student to compare on")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=None,
+        help="threshold for predictions of both models. Default: two_threshold of the teacher",
+    )
+    parser.add_argument("--min_area_threshold", type=int, default=100, help="minimum cluster size")
+    parser.add_argument("--n_repeats", type=int, default=3, help="number of forward passes for timing")
+    args = parser.parse_args()
+
+    student_path = os.path.join(EXPERIMENT_PATH, args.student_path)
+    student_exp = meld_graph.experiment.Experiment.from_folder(student_path)
+    distillation = student_exp.network_parameters["training_parameters"]["loss_dictionary"]["distillation"]
+    teacher_path = os.path.join(EXPERIMENT_PATH, distillation["teacher_path"])
+    teacher_model_name = distillation.get("model_name", "best_model")
+    teacher_exp = meld_graph.experiment.Experiment.from_folder(teacher_path, init_logging=False)
+    train_ids, val_ids, test_ids = student_exp.get_train_val_test_ids()
+    subject_ids = val_ids if args.split == "val" else test_ids
+
+    threshold = "two_threshold" if args.threshold is None else args.threshold
+    if args.threshold is None:
+        teacher_thresholds = os.path.join(teacher_path, f"results_{teacher_model_name}", "two_thresholds.csv")
+        student_thresholds = os.path.join(student_path, f"results_{args.model_name}", "two_thresholds.csv")
+        if not os.path.isfile(student_thresholds):
+            print(f"Copying thresholds of the teacher to {student_thresholds}")
+            os.makedirs(os.path.dirname(student_thresholds), exist_ok=True)
+            shutil.copyfile(teacher_thresholds, student_thresholds)
+    evaluators = {}
+    # results of the teacher on the subjects of the student are saved in the student folder
+    for name, exp, model_name, save_dir in [
+        ("teacher", teacher_exp, teacher_model_name, os.path.join(student_path, "teacher")),
+        ("student", student_exp, args.model_name, None),
+    ]:
+        evaluators[name] = Evaluator(
+            exp,
+            mode=args.split,
+            checkpoint_path=exp.experiment_path,
+            threshold=threshold,
+            min_area_threshold=args.min_area_threshold,
+            subject_ids=subject_ids,
+            save_dir=save_dir,
+            model_name=model_name,
+        )
+
+    # prediction time
+    results = {}
+    for name, evaluator in evaluators.items():
+        model = evaluator.experiment.model
+        model.eval()
+        n_vertices = model.models[0].n_vertices if hasattr(model, "models") else model.n_vertices
+        num_features = model.models[0].num_features if hasattr(model, "models") else model.num_features
+        x = torch.randn(n_vertices, num_features, device=next(model.parameters()).device)
+        results[name] = {"s per hemisphere": seconds_per_hemisphere(model, x, args.n_repeats)}
+    results = pd.DataFrame(results).T
+    results["speedup"] = results.loc["teacher", "s per hemisphere"] / results["s per hemisphere"]
+    print(results.to_string())
+
+    # agreement of thresholded clusters
+    data_dictionaries = {}
+    for name, evaluator in evaluators.items():
+        evaluator.load_predict_data(roc_curves_thresholds=None, save_prediction=False)
+        data_dictionaries[name] = evaluator.threshold_and_cluster(
+            data_dictionary=evaluator.data_dictionary, save_prediction=False
+        )
+    agreement = pd.DataFrame(
+        [
+            cluster_agreement(
+                data_dictionaries["student"][subj_id]["cluster_thresholded"],
+                data_dictionaries["teacher"][subj_id]["cluster_thresholded"],
+            )
+            for subj_id in subject_ids
+        ],
+        index=subject_ids,
+    )
+    n_reference = agreement["n_reference_clusters"].sum()
+    n_clusters = agreement["n_clusters"].sum()
+    print(f"{len(subject_ids)} {args.split} subjects")
+    print(f"mean dice of cluster masks: {agreement['dice'].mean():.3f}")
+    print(f"teacher clusters found by student: {agreement['n_matched_reference_clusters'].sum()} / {n_reference}")
+    print(f"student clusters found by teacher: {agreement['n_matched_clusters'].sum()} / {n_clusters}")
+    print(f"subjects with the same number of clusters: {np.mean(agreement['n_clusters'] == agreement['n_reference_clusters']):.3f}")
@@ -60,6 +60,12 @@ network_parameters = {
         #       losses for distance_regression: mse, mae, mle (mean log error)
         #   "lesion_classifiction": classify lesional / nonlesional hemisphere. Loss will be cross entropy.
         #        NOTE this will only work for model MoNetUnet
+        #   "distillation": train on the outputs of a trained teacher model, e.g. an ensemble (fold_all).
+        #       KL divergence to the teacher log_softmax + distance_weight * mse to the teacher non_lesion_logits.
+        #       teacher_path: teacher experiment folder, relative to EXPERIMENT_PATH. model_name: teacher checkpoint.
+        #       temperature: softens log_softmax of student and teacher. distance_weight: default 1.
+        #       Only applied to the highest level (not to deep supervision levels).
+        #       Set up with Experiment.for_distillation or scripts/classifier/distill_ensemble.py
         # values: dict with keys: "weight" and loss arguments (alpha/gamma for focal_loss, class_weights for dice, apply_to_bottleneck for lesion_classification)
         "loss_dictionary": {
             #'cross_entropy':{'weight':1},
@@ -67,6 +73,7 @@ network_parameters = {
             "dice": {"weight": 1, "class_weights": [0.0, 1.0]},
             #'distance_regression': {'weight': 1, 'weigh_by_gt': True},
             "lesion_classification": {"weight": 1, "apply_to_bottleneck": True},
+            #'distillation': {'weight': 1, 'teacher_path': '23-10-30_LVHZ_dcp/fold_all', 'model_name': 'best_model', 'temperature': 1, 'distance_weight': 1},
         },
         # metrics: list of metrics that should be printed during training
         # possible values: dice_lesion, dice_nonlesion, precision, recall, tp, fp, fn, tn, auroc, sub_auroc, cl_precision, cl_recall
@@ -101,6 +108,8 @@ network_parameters = {
 
 # data parameters, passed to GraphDataset and Preprocess
 data_parameters = {
+    # hdf5_file_root: feature files of each site and group. Roots ending in ".store" are read from memory-mapped
+    # FeatureStores (see scripts/data_preparation/convert_feature_store.py) instead of hdf5 files
     'hdf5_file_root': "{site_code}_{group}_featurematrix_combat_6_kernels_noCombat.hdf5",
     'site_codes': [
        "H1",
@@ -179,6 +188,23 @@ data_parameters = {
     # distance_mask_medial_wall: how to treat medial wall for distance prediction task.
     # If True, distances inside medial wall are masked to maximum distance (300).
     "distance_mask_medial_wall": True,
+    # cache_dir: directory (relative to BASE_PATH) of the preprocessed data cache. If None, data is not cached.
+    # Cached subjects are not read from the hdf5 files again, and their distances are not recomputed.
+    # Use scripts/data_preparation/manage_dataset_cache.py to show statistics or clear the cache.
+    "cache_dir": None,
+    # num_workers: number of processes used to load and preprocess subjects when creating a GraphDataset.
+    # Each worker calculates distances and smoothed labels with its own GraphTools. 0: load in main process.
+    "num_workers": 0,
+    # compact_storage: keep preloaded data in memory as float16 features, uint8 labels and smoothed labels,
+    # and uint16 distances (0.01mm steps). Values are converted back to their original dtype when accessed.
+    # See scripts/benchmarks/benchmark_compact_dataset.py for memory savings and effect on validation metrics.
+    "compact_storage": False,
+    # streaming: do not preload all subjects, but load them when accessed. For cohorts that do not fit in memory.
+    # Only the accessed hemisphere is loaded, and its distances and smoothed labels are computed on every access.
+    # Set cache_dir to avoid recomputing them every epoch. Not supported with combine_hemis.
+    # Each DataLoader worker keeps the last streaming_cache_size hemispheres in memory.
+    "streaming": False,
+    "streaming_cache_size": 16,
     # preprocessing_parameters: params for data_preprocessing
     "preprocessing_parameters": {
         "scaling": None,  # "scaling_params_GDL.json"
@@ -210,6 +236,15 @@ data_parameters = {
         "flipping": {"p": 0.5, "file": "data/flipping/flipping_ico7_3.npy"},
         "augment_lesion": {"p": 0.3},
     },
+    # batch_augmentation: apply augment_data (except augment_lesion) to collated training batches with torch,
+    # instead of to each sample in the DataLoader workers. Augmentation runs on the training device.
+    "batch_augmentation": False,
+    # geodesic_backend: solver of geodesic distances to lesion boundaries (distance maps, lesion augmentation)
+    # "pp3d": heat method of potpourri3d, one lesion at a time
+    # "heat": heat method, solved for all lesions of a subject / batch at once
+    # "dijkstra": approximate, shortest paths along mesh edges. Fastest, but overestimates distances by up to ~10%
+    # see scripts/benchmarks/benchmark_geodesics.py for speed and accuracy of the backends
+    "geodesic_backend": "pp3d",
     # combine_hemis: how to combine hemisphere data, one of: None, stack
     # None: no combination of hemispheres.
     # "stack": stack features of both hemispheres.
@@ -250,5 +285,13 @@ data_parameters = {
         # smooth_lesion: True / False, if True, returns smoothed lesion features
         # for better transitions between non-lesion and lesional data
         "smooth_lesion": False,
+        # lesion_shape: how lesions are created.
+        # "polygon": random polygon on a lat-long grid, interpolated to the mesh (default for older configs).
+        # "sphere": random star-shaped lesion evaluated directly on the icosphere. Vectorised and much faster.
+        "lesion_shape": "sphere",
+        # lesion_bank: directory (relative to BASE_PATH) of a SyntheticLesionBank created with
+        # scripts/data_preparation/create_lesion_bank.py. Lesions (with distances and smoothed labels) are
+        # sampled from the bank instead of being generated for every sample. None: generate lesions.
+        "lesion_bank": None,
     },
 }
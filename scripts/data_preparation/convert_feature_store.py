@@ -0,0 +1,42 @@
+## Script to convert hdf5 feature matrix files to memory-mapped FeatureStores and back
+## A cohort created with hdf5_file_root ending in ".store" reads features from the FeatureStores
+
+import os
+import argparse
+from meld_graph.meld_cohort import MeldCohort
+from meld_graph.feature_store import get_feature_store, is_feature_store_root
+from meld_graph.paths import BASE_PATH
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+        Copy features of all subjects from hdf5 files to FeatureStores (or from FeatureStores to hdf5 files).
+        Conversion direction is determined by the file roots, one of which needs to end with ".store"."""
+    )
+    parser.add_argument("--input_root", help="file root to read, e.g. {site_code}_{group}_featurematrix_combat.hdf5")
+    parser.add_argument("--output_root", help="file root to write, e.g. {site_code}_{group}_featurematrix_combat.store")
+    parser.add_argument("--site_codes", nargs="+", default=None, help="sites to convert. Default: all sites")
+    parser.add_argument("--data_dir", default=BASE_PATH, help="directory containing the MELD_{site_code} folders")
+    args = parser.parse_args()
+    assert is_feature_store_root(args.input_root) != is_feature_store_root(
+        args.output_root
+    ), "exactly one of input_root and output_root needs to end with .store"
+
+    cohort = MeldCohort(hdf5_file_root=args.input_root, data_dir=args.data_dir)
+    site_codes = args.site_codes if args.site_codes is not None else cohort.get_sites()
+    for site_code in site_codes:
+        for group in ["patient", "control"]:
+            input_path = os.path.join(
+                args.data_dir, f"MELD_{site_code}", args.input_root.format(site_code=site_code, group=group)
+            )
+            output_path = os.path.join(
+                args.data_dir, f"MELD_{site_code}", args.output_root.format(site_code=site_code, group=group)
+            )
+            if not os.path.exists(input_path):
+                continue
+            print(f"converting {input_path} to {output_path}")
+            if is_feature_store_root(args.output_root):
+                get_feature_store(output_path, cortex_label=cohort.cortex_label).import_hdf5(input_path)
+            else:
+                get_feature_store(input_path).export_hdf5(output_path, site_code, group)
@@ -0,0 +1,27 @@
+## Script to create the icosphere cache, that IcoSpheres loads levels from
+## The cache is otherwise created when icospheres are first used, which needs write access to the icosphere directory
+
+import os
+import time
+import argparse
+from meld_graph.icospheres import IcoSpheres, ICOSPHERE_CACHE_FILE
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create single file cache of all icosphere levels")
+    parser.add_argument("--icosphere_path", default="data/icospheres/", help="directory of icosphere files")
+    parser.add_argument("--force", action="store_true", default=False, help="recreate cache, even if it is up to date")
+    args = parser.parse_args()
+
+    path = os.path.join(args.icosphere_path, ICOSPHERE_CACHE_FILE)
+    start = time.perf_counter()
+    if args.force:
+        IcoSpheres(icosphere_path=args.icosphere_path).create_cache(path)
+    else:
+        # created if it does not exist or its source files changed
+        IcoSpheres(icosphere_path=args.icosphere_path).cache
+    print(f"{path} is up to date ({time.perf_counter() - start:.1f}s)")
+    # compare with loading the icospheres
+    start = time.perf_counter()
+    IcoSpheres(icosphere_path=args.icosphere_path).load_all_levels()
+    print(f"loaded all levels from cache in {time.perf_counter() - start:.3f}s")
@@ -0,0 +1,48 @@
+## Script to create a SyntheticLesionBank of precomputed synthetic lesions
+## Set data_parameters["synthetic_data"]["lesion_bank"] to the output directory to sample lesions from the bank
+
+import os
+import time
+import argparse
+from meld_graph.meld_cohort import MeldCohort
+from meld_graph.lesion_bank import SyntheticLesionBank
+from meld_graph.paths import BASE_PATH
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create a bank of synthetic lesions, distance maps and smoothed labels")
+    parser.add_argument("--output_dir", help="bank directory, relative to BASE_PATH")
+    parser.add_argument("--n_lesions", type=int, default=1000, help="number of lesions")
+    parser.add_argument("--radius", type=float, default=0.5, help="mean lesion radius, as synthetic_data radius")
+    parser.add_argument("--no_smooth_lesion", action="store_true", default=False, help="do not smooth lesion masks")
+    parser.add_argument(
+        "--no_distance_mask_medial_wall",
+        action="store_true",
+        default=False,
+        help="do not mask medial wall in distance maps",
+    )
+    parser.add_argument("--n_rotations", type=int, default=100, help="number of random rotations")
+    parser.add_argument("--num_workers", type=int, default=0, help="number of processes creating lesions")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    bank = SyntheticLesionBank.create(
+        os.path.join(BASE_PATH, args.output_dir),
+        cohort=MeldCohort(),
+        n_lesions=args.n_lesions,
+        radius=args.radius,
+        smooth_lesion=not args.no_smooth_lesion,
+        distance_mask_medial_wall=not args.no_distance_mask_medial_wall,
+        n_rotations=args.n_rotations,
+        num_workers=args.num_workers,
+        seed=args.seed,
+    )
+    # compare with sampling from the bank
+    n_samples = 100
+    start = time.perf_counter()
+    for _ in range(n_samples):
+        bank.sample()
+    sample_time = (time.perf_counter() - start) / n_samples
+    create_time = bank.info["seconds_per_lesion"] * max(args.num_workers, 1)
+    print(f"created {bank.n_lesions} lesions in {bank.path}")
+    print(f"creating a lesion: {create_time:.3f}s, sampling from bank: {sample_time:.4f}s ({create_time / sample_time:.0f}x)")
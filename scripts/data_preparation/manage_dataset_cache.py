@@ -0,0 +1,25 @@
+## Script to show statistics of the preprocessed data cache of GraphDataset, or to invalidate cache entries
+
+import os
+import argparse
+from meld_graph.dataset_cache import PreprocessedDataCache
+from meld_graph.paths import BASE_PATH
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""
+        Show statistics of the preprocessed data cache (data_parameters["cache_dir"]),
+        or remove entries of all or selected subjects."""
+    )
+    parser.add_argument("--cache_dir", help="cache directory, relative to BASE_PATH")
+    parser.add_argument("--clear", action="store_true", default=False, help="remove cache entries")
+    parser.add_argument("--subject_ids", nargs="+", default=None, help="only remove entries of these subjects")
+    args = parser.parse_args()
+
+    cache = PreprocessedDataCache(os.path.join(BASE_PATH, args.cache_dir))
+    if args.clear:
+        n_removed = cache.clear(subject_ids=args.subject_ids)
+        print(f"removed {n_removed} cache entries")
+    stats = cache.stats()
+    print(f"{cache.cache_dir}: {stats['entries']} entries of {stats['subjects']} subjects, {stats['size_mb']} MB")